@@ -1,15 +1,32 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g, url_for
+from flask import Flask, render_template, request, flash, redirect, session, g, url_for, abort, jsonify
 from functools import wraps
 from flask_debugtoolbar import DebugToolbarExtension
+from markupsafe import Markup
+from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.util import identity_key
 
+from assets import Assets
+from cache import LocalCache
 from forms import UserAddForm, LoginForm, MessageForm, UserUpdateForm, changePassword
-from models import db, connect_db, User, Message
+from http_cache import HttpCache
+from listener import Listener
+from metrics import Metrics
+import migrations
+from passwords import PasswordsBusy
+from querylog import QueryLog
+from replicas import Replicas, read_only
+import query_plans
+from models import db, connect_db, passwords, User, Message, Follows, Likes, TimelineEntry
 
 CURR_USER_KEY = "curr_user"
+CURR_USER_VERSION_KEY = "curr_user_version"
+PAGE_SIZE = 100
+USERS_PAGE_SIZE = 60
+MAX_USERS_PAGE = 20
 
 app = Flask(__name__)
 
@@ -18,19 +35,189 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
 
+# Connection pool settings (see connect_db); set DB_PGBOUNCER=1 when
+# DATABASE_URL points at pgbouncer in transaction pooling mode
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+app.config['DB_POOL_TIMEOUT'] = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+app.config['DB_PGBOUNCER'] = os.environ.get('DB_PGBOUNCER', '0') == '1'
+# Where each worker listens for the others' notifications (see listener.py);
+# needed with DB_PGBOUNCER, whose pooled connections can't LISTEN
+app.config['LISTEN_DATABASE_URL'] = os.environ.get('LISTEN_DATABASE_URL')
+# Comma-separated; read-only pages are served from these (see replicas.py)
+app.config['REPLICA_DATABASE_URIS'] = [
+    uri for uri in os.environ.get('REPLICA_DATABASE_URLS', '').split(',')
+    if uri]
+app.config['REPLICA_PIN_SECONDS'] = int(
+    os.environ.get('REPLICA_PIN_SECONDS', 5))
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 60))
+app.config['FRAGMENT_CACHE_TTL'] = int(
+    os.environ.get('FRAGMENT_CACHE_TTL', 3600))
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+# 'push' or 'pull'; see home_timeline
+app.config['TIMELINE_ENGINE'] = os.environ.get('TIMELINE_ENGINE', 'push')
+app.config['FOLLOWEE_CACHE_TTL'] = int(
+    os.environ.get('FOLLOWEE_CACHE_TTL', 300))
+# 0 turns the pull engine's followee cache off
+app.config['FOLLOWEE_CACHE_MAX'] = int(
+    os.environ.get('FOLLOWEE_CACHE_MAX', 100))
 toolbar = DebugToolbarExtension(app)
 # app.debug = True
 
+app.logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+
 connect_db(app)
 
+# Registered before the other request hooks, so it sees all their queries
+query_log = QueryLog(app)
+
+# Sends read-only GETs to replica databases, if there are any
+replicas = Replicas(db, app)
+
+# Snapshots of logged-in users, keyed by user id (see load_current_user)
+user_cache = LocalCache(ttl=app.config['USER_CACHE_TTL'])
+
+# Ids of users deleted since this worker started listening, so snapshots of
+# them aren't trusted, even when reloaded from a lagging replica
+deleted_users = LocalCache(ttl=app.config['USER_CACHE_TTL'])
+
+# Rendered message bodies, keyed by (message id, author profile_version)
+# (see message_fragment)
+fragment_cache = LocalCache(maxsize=50000,
+                            ttl=app.config['FRAGMENT_CACHE_TTL'])
+
+# Ids of the users each user follows, keyed by (user id, following_count)
+# (see followee_ids)
+followee_cache = LocalCache(ttl=app.config['FOLLOWEE_CACHE_TTL'])
+
+
+@event.listens_for(db.metadata, 'after_drop')
+def clear_caches(*args, **kwargs):
+    """Ids and versions start over in recreated tables, so nothing cached
+    from the dropped ones can be trusted."""
+
+    user_cache.clear()
+    deleted_users.clear()
+    fragment_cache.clear()
+    followee_cache.clear()
+
+
+# Hears from other workers, through the database (see listener.py)
+listener = Listener(app)
+# notifications sent while it wasn't listening were missed
+listener.on_reconnect = user_cache.clear
+
+
+@listener.on('users_deleted')
+def forget_deleted_user(payload):
+    """Stop trusting snapshots of a user deleted in any worker."""
+
+    user_id = int(payload)
+    deleted_users.set(user_id, True)
+    user_cache.delete(user_id)
+
+
+# Served at /metrics; under gunicorn, point METRICS_DIR at a directory
+# shared by the workers so the numbers cover all of them
+metrics = Metrics(app)
+metrics.track_engine(db.get_engine(app))
+metrics.track_cache('users', user_cache)
+metrics.track_cache('message_fragments', fragment_cache)
+metrics.track_cache('followees', followee_cache)
+passwords.on_timing = lambda operation, seconds: metrics.observe(
+    'warbler_bcrypt_duration_seconds', {'operation': operation}, seconds)
+
+http_cache = HttpCache(app)
+
+# Built with `python assets.py`; see assets.py
+assets = Assets(app, http_cache)
+
+##############################################################################
+# Keyset pagination helpers
+
+
+def make_cursor(message):
+    """Encode the position of `message` as a `?before=` cursor."""
+
+    return str(message.id)
+
+
+def parse_cursor(cursor):
+    """Decode a `?before=` cursor into a message id.
+
+    Returns None if no cursor was given; aborts with 400 if it's malformed.
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        return int(cursor)
+    except ValueError:
+        abort(400)
+
+
+def paginate(query, id_col=Message.id):
+    """Return one page of messages from `query`, newest first, and the cursor
+    for the next page (None on the last page).
+
+    Message ids are time-ordered, so pages are keyed on the id alone rather
+    than an offset, and every page is a single index range scan however
+    deep it is.
+    """
+
+    before = parse_cursor(request.args.get('before'))
+    if before is not None:
+        query = query.filter(id_col < before)
+        if id_col is not Message.id:
+            # bound the messages side of the join too, or Postgres may
+            # merge join from the newest message there is
+            query = query.filter(Message.id < before)
+
+    messages = (query
+                .order_by(id_col.desc())
+                .limit(PAGE_SIZE + 1)
+                .all())
+
+    if len(messages) > PAGE_SIZE:
+        messages = messages[:PAGE_SIZE]
+        return messages, make_cursor(messages[-1])
+
+    return messages, None
+
+
+@app.template_global()
+def next_page_url(cursor):
+    """URL of the page after `cursor`, keeping the current query args."""
+
+    args = request.args.to_dict()
+    args['before'] = cursor
+    return url_for(request.endpoint, **request.view_args, **args)
+
+
 @app.errorhandler(404)
 def handle_resource_not_found(e):
+    if request.path.startswith('/api/'):
+        return jsonify(error="Not found."), 404
 
     return render_template("404.html", e=e), 404
+
+
+@app.errorhandler(PasswordsBusy)
+def handle_passwords_busy(e):
+    """Shed load when the password hashing pool is saturated."""
+
+    return ("Warbler is busy right now, please try again in a moment.",
+            503, {'Retry-After': '1'})
+
+
 ##############################################################################
 # User signup/login/logout
 
@@ -39,13 +226,89 @@ def handle_resource_not_found(e):
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
+    g.follow_state = {}
+
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = load_current_user(session[CURR_USER_KEY],
+                                   session.get(CURR_USER_VERSION_KEY))
+        if g.user is None:
+            # deleted since this session logged in
+            do_logout()
 
     else:
         g.user = None
 
 
+@app.template_global()
+def followed_ids(users):
+    """Which of `users` does the logged-in user follow?
+
+    Returns a set of user ids. Follow state is looked up in one query for
+    any ids not seen yet and memoized for the rest of the request, so a
+    page of user cards costs one query rather than one per card.
+    """
+
+    if g.user is None:
+        return set()
+
+    known = g.follow_state
+    unseen = [user.id for user in users if user.id not in known]
+    if unseen:
+        following = g.user.following_ids(unseen)
+        known.update((user_id, user_id in following) for user_id in unseen)
+
+    return {user.id for user in users if known[user.id]}
+
+
+def followee_ids(user):
+    """The ids of everyone `user` follows, cached.
+
+    The cache is keyed on following_count, which the counter triggers keep
+    current, so a follow or unfollow made through any worker is seen on
+    the next read; only an unfollow and a follow between two reads goes
+    unnoticed, until the entry expires.
+    """
+
+    key = (user.id, user.following_count)
+    ids = followee_cache.get(key)
+    if ids is None:
+        ids = user.following_user_ids()
+        followee_cache.set(key, ids)
+    return ids
+
+
+def viewer_version():
+    """Who's looking, and as which version of their profile; part of the
+    ETag of any page that shows the navbar."""
+
+    if g.user is None:
+        return None
+    return g.user.id, g.user.profile_version
+
+
+@app.template_global()
+def message_fragment(message):
+    """The viewer-independent markup for `message`: its author's avatar
+    and username, its date and its text.
+
+    Messages never change and their authors only change by bumping
+    profile_version, so fragments are cached under the message id and the
+    author's profile_version; a profile edit moves every one of that
+    author's messages to new keys. Like buttons depend on the viewer and
+    are rendered around this in messages/message.html.
+    """
+
+    key = (message.id, message.user.profile_version)
+    fragment = fragment_cache.get(key)
+
+    if fragment is None:
+        template = app.jinja_env.get_template('messages/message_body.html')
+        fragment = Markup(template.render(message=message))
+        fragment_cache.set(key, fragment)
+
+    return fragment
+
+
 def check_logged_in(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -55,10 +318,63 @@ def check_logged_in(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def load_current_user(user_id, version):
+    """Get the logged-in user, from the snapshot cache when possible.
+
+    A cached snapshot is only used if its profile_version matches the one
+    stored in the session, so a profile edit or password change shows up
+    at once for the session that made it (in any worker). Other sessions
+    may see the old profile for up to USER_CACHE_TTL seconds.
+
+    Returns None for a user deleted in any worker: each worker hears of
+    deletions through the listener (see forget_deleted_user), so that
+    costs no query here.
+    """
+
+    if deleted_users.get(user_id):
+        return None
+
+    if identity_key(User, user_id) in db.session.identity_map:
+        return User.query.get(user_id)
+
+    snapshot = user_cache.get(user_id)
+    if (version is not None and snapshot is not None
+            and snapshot['profile_version'] == version):
+        return User.from_snapshot(snapshot)
+
+    user = User.query.get(user_id)
+    if user:
+        remember_user(user)
+    return user
+
+
+def remember_user(user):
+    """Cache a fresh snapshot of `user` and pin the session to its version."""
+
+    snapshot = user.snapshot()
+    user_cache.set(user.id, snapshot)
+    if session.get(CURR_USER_KEY) == user.id:
+        session[CURR_USER_VERSION_KEY] = snapshot['profile_version']
+
+
+def user_changed():
+    """Note that a write changed counters in the logged-in user's snapshot:
+    drop this worker's snapshot, and unpin the session so that whichever
+    worker serves its next request reloads the row.
+
+    Goes after the commit, and uses the session's user id rather than
+    g.user's, which the commit has expired.
+    """
+
+    user_cache.delete(session.get(CURR_USER_KEY))
+    session.pop(CURR_USER_VERSION_KEY, None)
+
+
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    remember_user(user)
 
 
 def do_logout():
@@ -66,6 +382,7 @@ def do_logout():
 
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
+    session.pop(CURR_USER_VERSION_KEY, None)
 
 
 @app.route('/signup', methods=["GET", "POST"])
@@ -139,37 +456,69 @@ def logout():
 # General user routes:
 
 @app.route('/users')
+@read_only
 @check_logged_in
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username, bio and
+    location, and a 'page' param. Relevance order has no stable key to
+    page on, so listings stop at MAX_USERS_PAGE rather than offsetting
+    arbitrarily deep.
     """
     search = request.args.get('q')
+    page = min(max(request.args.get('page', 1, type=int), 1), MAX_USERS_PAGE)
 
     if not search:
-        users = User.query.all()
+        query = User.query.order_by(User.id.desc())
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
-    return render_template('users/index.html', users=users)
+        query = User.search(search)
+
+    users = (query
+             .offset((page - 1) * USERS_PAGE_SIZE)
+             .limit(USERS_PAGE_SIZE + 1)
+             .all())
+    has_next = len(users) > USERS_PAGE_SIZE and page < MAX_USERS_PAGE
+
+    return render_template('users/index.html', users=users[:USERS_PAGE_SIZE],
+                           search=search, page=page, has_next=has_next)
 
 
 @app.route('/users/<int:user_id>')
+@read_only
 @check_logged_in
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile.
+
+    Posting or deleting a message changes its author's messages_count or
+    newest message id, and liking one changes likes_version for the liker
+    and the author, so those tag the page and a browser that already has
+    it gets its 304 before the messages are queried.
+    """
 
     user = User.query.get_or_404(user_id)
+
+    etag = http_cache.etag(
+        viewer_version(), g.user.likes_version, user.id, user.profile_version,
+        user.messages_count, user.newest_message_id(), user.following_count,
+        user.followers_count, user.likes_count, user.likes_version,
+        user.id in followed_ids([user]))
+    not_modified = http_cache.not_modified(etag)
+    if not_modified:
+        return not_modified
+
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
+    messages, next_cursor = paginate(Message
+                                     .query
+                                     .filter(Message.user_id == user_id))
     
-    return render_template('users/show.html', user=user, messages=messages)
+    liked_ids = g.user.liked_message_ids(messages)
+
+    return http_cache.render_if_modified(etag, 'users/show.html', user=user,
+                                         messages=messages,
+                                         next_cursor=next_cursor,
+                                         liked_ids=liked_ids)
 
 @app.route('/users/change-password', methods=['GET','POST'])
 @check_logged_in
@@ -185,12 +534,14 @@ def update_password():
         if not user:
             flash('Incorrect credentials', 'danger')
             return redirect(url_for('update_password'))
+        remember_user(user)
         flash('Password updated successfully', 'success')
         return redirect(url_for('users_show', user_id=g.user.id))
 
     return render_template('users/change.html', form=form)
 
 @app.route('/users/<int:user_id>/following')
+@read_only
 @check_logged_in
 def show_following(user_id):
     """Show list of people this user is following."""
@@ -200,6 +551,7 @@ def show_following(user_id):
 
 
 @app.route('/users/<int:user_id>/followers')
+@read_only
 @check_logged_in
 def users_followers(user_id):
     """Show list of followers of this user."""
@@ -215,7 +567,10 @@ def add_follow(follow_id):
 
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.append(followed_user)
+    db.session.flush()
+    TimelineEntry.backfill(g.user.id, followed_user.id)
     db.session.commit()
+    user_changed()
 
     return redirect(url_for('show_following', user_id=g.user.id))
 
@@ -227,7 +582,9 @@ def stop_following(follow_id):
 
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.remove(followed_user)
+    TimelineEntry.prune(g.user.id, followed_user.id)
     db.session.commit()
+    user_changed()
 
     return redirect(url_for('show_following', user_id=g.user.id))
 
@@ -252,8 +609,11 @@ def profile():
         user.image_url = form.image_url.data 
         user.header_image_url = form.header_image_url.data 
         user.bio = form.bio.data 
+        # also moves this user's cached message fragments to new keys
+        user.bump_version()
 
         db.session.commit()
+        remember_user(user)
         return redirect(url_for('users_show', user_id=user.id))
 
     return render_template('/users/edit.html', form=form)
@@ -265,18 +625,53 @@ def delete_user():
 
     do_logout()
 
+    user_cache.delete(g.user.id)
     db.session.delete(g.user)
     db.session.commit()
 
     return redirect(url_for('signup'))
 
 @app.route('/users/<int:user_id>/likes')
+@read_only
 @check_logged_in
 def user_likes(user_id):
-    """Show list of liked warbles"""
+    """Show list of liked warbles.
+
+    The messages are other people's, whose like counts and profiles can
+    change without touching this user, so the page is tagged from just the
+    ids, like counts and author versions of its messages; the messages
+    themselves are only loaded when the browser doesn't have that version.
+    """
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/show.html',user=user, messages=user.likes)
+    keys, next_cursor = paginate(db.session
+                                 .query(Message.id, Message.like_count,
+                                        User.profile_version)
+                                 .join(Likes, Likes.message_id == Message.id)
+                                 .join(User, User.id == Message.user_id)
+                                 .filter(Likes.user_id == user_id))
+
+    etag = http_cache.etag(
+        viewer_version(), g.user.likes_version, user.id, user.profile_version,
+        user.messages_count, user.following_count, user.followers_count,
+        user.likes_count, user.id in followed_ids([user]),
+        [tuple(key) for key in keys], next_cursor)
+    not_modified = http_cache.not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    messages = (Message
+                .query
+                .options(joinedload(Message.user))
+                .filter(Message.id.in_([key.id for key in keys]))
+                .order_by(Message.id.desc())
+                .all())
+    liked_ids = g.user.liked_message_ids(messages)
+
+    return http_cache.render_if_modified(etag, 'users/show.html', user=user,
+                                         messages=messages,
+                                         next_cursor=next_cursor,
+                                         liked_ids=liked_ids)
 
 ##############################################################################
 # Messages routes:
@@ -292,17 +687,16 @@ def handle_like(msg_id):
     msg = Message.query.get_or_404(msg_id)
 
     # If message already liked by user, un-like message
-    if g.user in msg.liked_by:
-        msg.liked_by.remove(g.user)
-
+    if Likes.remove(g.user.id, msg.id):
         db.session.commit()
-        
+        user_changed()
+
         flash(f"Unliked {msg.user.username}'s warble", 'warning')
     else:
-        msg.liked_by.append(g.user)
-
+        Likes.add(g.user.id, msg.id)
         db.session.commit()
-        
+        user_changed()
+
         flash(f"Liked {msg.user.username}'s warble", 'success')
 
     return redirect(url_for('homepage'))
@@ -320,18 +714,59 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        TimelineEntry.fan_out(msg)
         db.session.commit()
+        user_changed()
+        if wants_json():
+            return jsonify(messages_json([msg])), 201
         return redirect(url_for('users_show', user_id=g.user.id))
 
+    if request.method == 'POST' and wants_json():
+        return jsonify(errors=form.errors), 400
+
     return render_template('/messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+@read_only
+@check_logged_in
+def messages_search():
+    """Search warbles by text, newest first.
+
+    Takes 'q' for the search terms, 'following' to only include people the
+    logged-in user follows, and a 'before' cursor for older results.
+    """
+
+    search = request.args.get('q', '').strip()
+    following = bool(request.args.get('following'))
+    messages, next_cursor = [], None
+
+    if search:
+        query = Message.search(search,
+                               followed_by=g.user.id if following else None)
+        messages, next_cursor = paginate(query)
+
+    return render_template('messages/search.html', messages=messages,
+                           next_cursor=next_cursor, search=search,
+                           following=following,
+                           liked_ids=g.user.liked_message_ids(messages))
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@read_only
 def messages_show(message_id):
     """Show a message."""
 
     msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+
+    # messages never change, so this page only changes with its author's
+    # profile and whether the viewer follows them
+    etag = http_cache.etag(viewer_version(), msg.id, msg.user.profile_version,
+                           msg.user.id in followed_ids([msg.user]))
+
+    return http_cache.render_if_modified(etag, 'messages/show.html',
+                                         public=g.user is None, message=msg)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -344,61 +779,277 @@ def messages_destroy(message_id):
         flash("Access unauthorized", "danger")
         return redirect(url_for('homepage'))
 
+    TimelineEntry.remove_message(msg.id)
+    fragment_cache.delete((msg.id, msg.user.profile_version))
     db.session.delete(msg)
     db.session.commit()
+    user_changed()
 
     return redirect(url_for('users_show', user_id=g.user.id))
 
 
+##############################################################################
+# JSON API
+#
+# Pages of messages as JSON, for the front end to add to pages it has
+# already rendered. Each page's authors are listed once, under "users",
+# rather than with every message.
+
+
+def wants_json():
+    """Did the client ask for JSON rather than a page?"""
+
+    return (request.accept_mimetypes.best_match(['text/html',
+                                                 'application/json'])
+            == 'application/json')
+
+
+def api_login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if g.user is None:
+            return jsonify(error="Login required."), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def messages_json(messages, next_cursor=None):
+    """Serialize a page of `messages`, with the `before` cursor of the
+    next page (null on the last)."""
+
+    liked_ids = g.user.liked_message_ids(messages) if g.user else set()
+
+    return {
+        'messages': [
+            {'id': message.id,
+             'text': message.text,
+             'timestamp': message.timestamp.isoformat(),
+             'user_id': message.user_id,
+             'like_count': message.like_count,
+             'liked': message.id in liked_ids}
+            for message in messages],
+        'users': {
+            message.user.id: {'username': message.user.username,
+                              'image_url': message.user.image_url}
+            for message in messages},
+        'next_cursor': next_cursor,
+    }
+
+
+# Pages whose next pages the JSON API can load, by endpoint
+API_PAGES = {
+    'homepage': 'api_timeline',
+    'users_show': 'api_user_messages',
+}
+
+
+@app.template_global()
+def api_page_url(cursor):
+    """The JSON API URL of the page after `cursor`, or None if this page
+    has no API counterpart."""
+
+    endpoint = API_PAGES.get(request.endpoint)
+    if endpoint is None:
+        return None
+    return url_for(endpoint, **request.view_args, before=cursor)
+
+
+@app.route('/api/timeline')
+@read_only
+@api_login_required
+def api_timeline():
+    """The logged-in user's home timeline, newest first."""
+
+    return jsonify(messages_json(*home_timeline()))
+
+
+@app.route('/api/users/<int:user_id>/messages')
+@read_only
+@api_login_required
+def api_user_messages(user_id):
+    """A user's messages, newest first."""
+
+    User.query.get_or_404(user_id)
+    return jsonify(messages_json(*paginate(
+        Message
+        .query
+        .options(joinedload(Message.user))
+        .filter(Message.user_id == user_id))))
+
+
+@app.route('/api/messages/<int:message_id>')
+@read_only
+def api_message(message_id):
+    """A single message."""
+
+    return jsonify(messages_json([Message.query.get_or_404(message_id)]))
+
+
+@app.route('/api/messages/<int:message_id>/like', methods=['PUT', 'DELETE'])
+@api_login_required
+def api_like(message_id):
+    """Like (PUT) or stop liking (DELETE) a message.
+
+    Either can be repeated safely: each is one insert that skips an
+    existing like, or one delete. Responds with whether the logged-in user
+    now likes the message and how many people do, and nothing else.
+    """
+
+    if request.method == 'PUT':
+        try:
+            Likes.add(g.user.id, message_id)
+        except IntegrityError:
+            # no such message
+            db.session.rollback()
+            abort(404)
+    else:
+        Likes.remove(g.user.id, message_id)
+
+    # the counter trigger has already updated it
+    like_count = (db.session
+                  .query(Message.like_count)
+                  .filter(Message.id == message_id)
+                  .scalar())
+    if like_count is None:
+        abort(404)
+    db.session.commit()
+    user_changed()
+
+    liked = request.method == 'PUT'
+    return jsonify(id=message_id, liked=liked, like_count=like_count)
+
+
 ##############################################################################
 # Homepage and error pages
 
 
+def home_timeline():
+    """One page of the logged-in user's home timeline, and the cursor for
+    the next page.
+
+    With TIMELINE_ENGINE 'push', the page is read from the timeline
+    materialized as messages were posted (TimelineEntry). With 'pull', it's
+    queried at read time from the messages of everyone the user follows,
+    who are looked up by the query itself (Message.by_followed); for
+    users following at most FOLLOWEE_CACHE_MAX people, their ids are
+    cached and sent instead (Message.by_authors). Timelines are
+    materialized either way, so the setting can be changed at any time.
+    """
+
+    if app.config['TIMELINE_ENGINE'] == 'pull':
+        following_count = g.user.following_count
+        if 0 < following_count <= app.config['FOLLOWEE_CACHE_MAX']:
+            # few enough to cache, and send as an array
+            following = followee_ids(g.user)
+            return paginate(Message.by_authors(following + [g.user.id]))
+        if following_count:
+            return paginate(Message.by_followed(g.user.id, following_count))
+
+    else:
+        follows_anyone = (db.session
+                          .query(Follows.query
+                                 .filter(Follows.user_following_id == g.user.id)
+                                 .exists())
+                          .scalar())
+        if follows_anyone:
+            # precomputed on write by TimelineEntry.fan_out/backfill
+            return paginate(TimelineEntry.feed(g.user.id),
+                            TimelineEntry.message_id)
+
+    # following nobody: everyone's messages
+    return paginate(Message
+                    .query
+                    .options(joinedload(Message.user)))
+
+
 @app.route('/')
+@read_only
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, with a
+      `?before=` cursor to page further back
 
     """
 
     if g.user:
-        if len(g.user.following) == 0:
-            messages = (Message
-                        .query
-                        .options(joinedload(Message.user))  
-                        .order_by(Message.timestamp.desc())
-                        .limit(100)
-                        .all())
-        else:
-            messages = (Message
-                        .query
-                        .options(joinedload(Message.user))
-                        .filter((Message.user_id==g.user.id) | (Message.user_id.in_([f.id for f in g.user.following])))
-                        .order_by(Message.timestamp.desc())
-                        .limit(100)
-                        .all())
-            
-        return render_template('home.html', messages=messages)
+        messages, next_cursor = home_timeline()
+        return render_template('home.html', messages=messages,
+                               next_cursor=next_cursor,
+                               liked_ids=g.user.liked_message_ids(messages))
 
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Maintenance commands
+
 
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    """Recompute every user's materialized home timeline."""
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+    count = TimelineEntry.rebuild()
+    db.session.commit()
+    print(f"Rebuilt home timelines ({count} entries).")
+
+
+@app.cli.command('reconcile-user-stats')
+def reconcile_user_stats():
+    """Repair drift in the denormalized user and message stat counters."""
+
+    users = User.reconcile_counts()
+    messages = Message.reconcile_like_counts()
+    db.session.commit()
+    print(f"Reconciled stats for {users} users and {messages} messages.")
+
+
+@app.cli.command('db-upgrade')
+def db_upgrade():
+    """Apply any schema migrations this database hasn't had."""
+
+    try:
+        applied = migrations.upgrade()
+    except RuntimeError as error:
+        raise SystemExit(str(error))
+    for version in applied:
+        print(f"Applied migration {version}.")
+    if not applied:
+        print("Already up to date.")
+
+
+@app.cli.command('db-status')
+def db_status():
+    """List the schema migrations and whether each has been applied."""
+
+    applied = migrations.applied_versions()
+    for version, step in migrations.MIGRATIONS:
+        state = 'applied' if version in applied else 'pending'
+        print(f"{version:>4}  {state:<8} {step.__doc__.splitlines()[0]}")
+
+
+@app.cli.command('check-query-plans')
+def check_query_plans():
+    """Fail if any hot query (see query_plans.py) plans a sequential scan,
+    for a user following a typical number of people."""
+
+    # not the heaviest user: for someone who follows most of the site,
+    # scanning follows really is cheapest
+    typical = (db.session
+               .query(db.func.percentile_disc(0.5)
+                      .within_group(User.following_count))
+               .filter(User.following_count > 0)
+               .scalar())
+    user = User.query.filter(User.following_count == typical).first()
+    if user is None:
+        print("No one follows anyone yet: nothing to check.")
+        return
+
+    scans = query_plans.seq_scans(user)
+    for name, tables in scans.items():
+        print(f"{name}: sequential scan of {', '.join(tables)}")
+    if scans:
+        raise SystemExit(1)
+    print(f"All {len(query_plans.HOT_QUERIES)} hot queries use indexes.")
@@ -0,0 +1,322 @@
+"""Build Warbler's static assets into fingerprinted, precompressed bundles.
+
+Each bundle in BUNDLES is its source files (ours, and third-party ones
+vendored from VENDOR into static/vendor) concatenated and minified into
+static/dist/<name>.<hash><ext>, alongside .gz and .br copies. URLs in
+stylesheets are rewritten to point at the (fingerprinted) files they
+referred to. static/dist/manifest.json maps each bundle name to its file,
+and templates link bundles through it with `asset_urls()`.
+
+Without a build, pages link every source file separately instead. Until
+the vendored files are fetched, pages load them from their CDNs, which
+templates link with `cdn_urls()`, and a warning is logged at startup.
+
+run it like:
+
+    python assets.py
+
+Vendored files are fetched the first time and kept in static/vendor; commit
+them, so builds don't depend on the CDNs. static/dist is built on deploy.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+import shutil
+import urllib.request
+
+import brotli
+import rcssmin
+import rjsmin
+from flask import request, send_from_directory, url_for
+
+from http_cache import STATIC_MAX_AGE, file_hash
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'static')
+STATIC_URL = '/static'
+
+FONT_AWESOME = 'https://use.fontawesome.com/releases/v5.3.1'
+
+# Third-party files, by where they're kept under static/vendor
+VENDOR = {
+    'jquery/jquery.min.js':
+        'https://cdnjs.cloudflare.com/ajax/libs/jquery/3.7.1/jquery.min.js',
+    'bootstrap/bootstrap.min.css':
+        'https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/'
+        'bootstrap.min.css',
+    # Bootstrap with Popper, which its dropdowns and tooltips need
+    'bootstrap/bootstrap.bundle.min.js':
+        'https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/js/'
+        'bootstrap.bundle.min.js',
+    'fontawesome/css/all.css': f"{FONT_AWESOME}/css/all.css",
+}
+VENDOR.update({
+    f"fontawesome/webfonts/fa-{style}.{ext}":
+        f"{FONT_AWESOME}/webfonts/fa-{style}.{ext}"
+    for style in ('brands-400', 'regular-400', 'solid-900')
+    for ext in ('eot', 'svg', 'ttf', 'woff', 'woff2')
+})
+
+# Source files of each bundle, in order, relative to the static folder
+BUNDLES = {
+    'app.css': [
+        'vendor/bootstrap/bootstrap.min.css',
+        'vendor/fontawesome/css/all.css',
+        'stylesheets/style.css',
+    ],
+    'app.js': [
+        'vendor/jquery/jquery.min.js',
+        'vendor/bootstrap/bootstrap.bundle.min.js',
+        'app.js',
+    ],
+}
+
+MANIFEST = 'manifest.json'
+
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+MIMETYPES = {'.css': 'text/css', '.js': 'application/javascript'}
+
+
+def fetch_vendor(static_folder=STATIC_FOLDER):
+    """Download whichever VENDOR files aren't in static/vendor yet."""
+
+    for path, url in VENDOR.items():
+        target = os.path.join(static_folder, 'vendor', path)
+        if os.path.exists(target):
+            continue
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            with urllib.request.urlopen(url) as response, \
+                    open(target + '.part', 'wb') as f:
+                shutil.copyfileobj(response, f)
+        except OSError as error:
+            raise SystemExit(
+                f"Couldn't fetch {path} from {url} ({error}). Run this once "
+                f"where the CDNs are reachable and commit static/vendor.")
+        os.replace(target + '.part', target)
+        print(f"Fetched {path}")
+
+
+def rewrite_css_urls(css, source, static_folder, static_url=STATIC_URL):
+    """Point the URLs in stylesheet `source` (relative to the static
+    folder) at fingerprinted static URLs, so they still work from wherever
+    the bundle is served."""
+
+    def rewrite(match):
+        url = match.group(2)
+        if url.startswith(('data:', 'http:', 'https:', '//', '#')):
+            return match.group(0)
+
+        # keep any query or fragment, like the ?#iefix fonts use
+        path, sep, suffix = (re.split(r'([?#])', url, 1) + ['', ''])[:3]
+
+        if path.startswith(static_url + '/'):
+            path = path[len(static_url) + 1:]
+        elif path.startswith('/'):
+            return match.group(0)
+        else:
+            path = posixpath.normpath(
+                posixpath.join(posixpath.dirname(source), path))
+
+        local = os.path.join(static_folder, path)
+        if os.path.isfile(local):
+            version = f"v={file_hash(local)}"
+            if sep == '?':
+                suffix = f"?{version}&{suffix}"
+            else:
+                suffix = f"?{version}{sep}{suffix}"
+        else:
+            suffix = sep + suffix
+
+        return f'url("{static_url}/{path}{suffix}")'
+
+    return CSS_URL.sub(rewrite, css)
+
+
+def bundle(name, sources, static_folder):
+    """Return the minified contents of bundle `name`."""
+
+    parts = []
+    for source in sources:
+        with open(os.path.join(static_folder, source),
+                  encoding='utf-8') as f:
+            text = f.read()
+
+        if name.endswith('.css'):
+            text = rewrite_css_urls(text, source, static_folder)
+            parts.append(rcssmin.cssmin(text, keep_bang_comments=True))
+        else:
+            parts.append(rjsmin.jsmin(text, keep_bang_comments=True))
+
+    # a script missing its last semicolon mustn't run into the next one
+    return (';\n' if name.endswith('.js') else '\n').join(parts)
+
+
+def build(static_folder=STATIC_FOLDER, bundles=BUNDLES):
+    """Build every bundle into static/dist, with gzip and brotli copies
+    and a manifest; return the manifest."""
+
+    out = os.path.join(static_folder, 'dist')
+    os.makedirs(out, exist_ok=True)
+
+    manifest = {}
+    for name, sources in bundles.items():
+        data = bundle(name, sources, static_folder).encode()
+        stem, ext = os.path.splitext(name)
+        filename = f"{stem}.{hashlib.sha1(data).hexdigest()[:12]}{ext}"
+        path = os.path.join(out, filename)
+
+        with open(path, 'wb') as f:
+            f.write(data)
+        with open(path + '.gz', 'wb') as f:
+            f.write(gzip.compress(data, 9))
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(data))
+
+        manifest[name] = filename
+        print(f"Built {filename} ({len(data):,} bytes)")
+
+    partial = os.path.join(out, MANIFEST + '.part')
+    with open(partial, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(partial, os.path.join(out, MANIFEST))
+
+    # bundles the new manifest doesn't mention are from old builds
+    keep = set(manifest.values())
+    for filename in os.listdir(out):
+        base = re.sub(r'\.(gz|br)$', '', filename)
+        if filename != MANIFEST and base not in keep:
+            os.remove(os.path.join(out, filename))
+
+    return manifest
+
+
+class Assets:
+    """Link and serve the bundles `build()` makes.
+
+    `asset_urls(name)` in a template gives the URLs to load bundle `name`
+    from: its built file if there's a manifest, or else each of its sources
+    that's here. `cdn_urls(name)` gives the CDN URLs of the vendored files
+    it's missing, to load before those (vendored files lead each bundle).
+
+    Built files are served from /static/dist as brotli or gzip when the
+    browser accepts them, and cached for good, since a changed bundle gets
+    a new name. (A front-end server can serve them the same way, e.g.
+    nginx with gzip_static and brotli_static.)
+    """
+
+    def __init__(self, app=None, http_cache=None):
+        self._manifest = (None, {})
+
+        if app is not None:
+            self.init_app(app, http_cache)
+
+    def init_app(self, app, http_cache):
+        """Add the `asset_urls()` and `cdn_urls()` template globals and the
+        /static/dist endpoint."""
+
+        self.http_cache = http_cache
+        self.static_folder = app.static_folder
+        self.directory = os.path.join(app.static_folder, 'dist')
+
+        app.add_template_global(self.asset_urls, 'asset_urls')
+        app.add_template_global(self.cdn_urls, 'cdn_urls')
+        app.add_url_rule(f"{app.static_url_path}/dist/<path:filename>",
+                         'asset', self.serve)
+
+        missing = self.missing_vendor()
+        if missing and not self.manifest:
+            app.logger.warning(
+                "%d vendored files aren't in static/vendor, so pages load "
+                "them from their CDNs; run `python assets.py` to fetch them",
+                len(missing))
+
+    @property
+    def manifest(self):
+        """The built bundles, reread whenever the manifest changes."""
+
+        path = os.path.join(self.directory, MANIFEST)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return {}
+
+        if self._manifest[0] != mtime:
+            with open(path) as f:
+                self._manifest = (mtime, json.load(f))
+        return self._manifest[1]
+
+    def asset_urls(self, name):
+        """The URLs to load bundle `name` from, in order."""
+
+        built = self.manifest.get(name)
+        if built:
+            return [url_for('asset', filename=built)]
+
+        missing = self.missing_vendor()
+        return [self.http_cache.static_url(source)
+                for source in BUNDLES[name]
+                if source[len('vendor/'):] not in missing]
+
+    def cdn_urls(self, name):
+        """The CDN URLs of the vendored sources of bundle `name` that
+        haven't been fetched, in order; none once it's built."""
+
+        if self.manifest.get(name):
+            return []
+
+        missing = self.missing_vendor()
+        return [VENDOR[source[len('vendor/'):]] for source in BUNDLES[name]
+                if source[len('vendor/'):] in missing]
+
+    def missing_vendor(self):
+        """The VENDOR paths not fetched into static/vendor yet."""
+
+        return {path for path in VENDOR if not os.path.exists(
+            os.path.join(self.static_folder, 'vendor', path))}
+
+    def serve(self, filename):
+        """Send built file `filename`, precompressed if the browser takes
+        that."""
+
+        mimetype = MIMETYPES.get(os.path.splitext(filename)[1])
+        response = None
+
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            compressed = os.path.join(self.directory, filename + suffix)
+            if request.accept_encodings[encoding] and os.path.isfile(
+                    compressed):
+                response = send_from_directory(
+                    self.directory, filename + suffix, mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+                break
+
+        if response is None:
+            response = send_from_directory(self.directory, filename,
+                                           mimetype=mimetype)
+
+        response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = (
+            f"public, max-age={STATIC_MAX_AGE}, immutable")
+        return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--static', default=STATIC_FOLDER,
+                        help="static folder to build in")
+    args = parser.parse_args()
+
+    fetch_vendor(args.static)
+    build(args.static)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Benchmark login throughput at different bcrypt costs.
+
+Login time is dominated by one bcrypt check, so this times
+Passwords.check directly for a range of BCRYPT_LOG_ROUNDS values. Each
+cost is run at 1 worker and at every CPU, and the report gives logins per
+second in total and per core.
+
+run it like:
+
+    python benchmarks/bcrypt_cost.py
+    python benchmarks/bcrypt_cost.py --rounds 10 12 14 --seconds 5
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from passwords import Passwords
+
+
+def logins_per_second(passwords, hashed, clients, seconds):
+    """Check `hashed` from `clients` threads for `seconds`; return rate."""
+
+    deadline = time.perf_counter() + seconds
+
+    def client():
+        done = 0
+        while time.perf_counter() < deadline:
+            passwords.check(hashed, 'correct horse battery staple')
+            done += 1
+        return done
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        total = sum(pool.map(lambda _: client(), range(clients)))
+
+    return total / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, nargs='+',
+                        default=[8, 10, 11, 12, 13])
+    parser.add_argument('--seconds', type=float, default=3)
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    print(f"{'cost':>4}  {'workers':>7}  {'logins/s':>9}  {'per core':>9}")
+
+    for rounds in args.rounds:
+        for workers in sorted({1, cores}):
+            passwords = Passwords()
+            passwords.rounds = rounds
+            passwords.workers = workers
+            passwords.max_pending = workers * 8
+            hashed = passwords.hash('correct horse battery staple')
+
+            rate = logins_per_second(passwords, hashed, workers * 2,
+                                     args.seconds)
+            print(f"{rounds:>4}  {workers:>7}  {rate:>9.1f}  "
+                  f"{rate / workers:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,392 @@
+"""Load test Warbler with scripted user journeys.
+
+Each virtual user logs in as a seeded user, then keeps picking a journey
+at random (weighted by JOURNEYS) until the time is up: browsing the home
+timeline and profiles, liking, posting, following and unfollowing, and
+searching. Every request is timed and reported by endpoint with its
+throughput and p50/p95/p99 latency, and the results are written to a JSON
+file so runs on different commits can be compared.
+
+Requests go to the app in-process through Flask's test client by default,
+or over HTTP to a running server with --url, or to a gunicorn this starts
+with --gunicorn. Users and messages to act on are sampled from the
+database in DATABASE_URL, which should be the one the server is using
+and seeded (see seed.py, bulk_load.py and generator/create_csvs.py).
+
+run it like:
+
+    python benchmarks/load_harness.py --users 20 --seconds 60
+    python benchmarks/load_harness.py --gunicorn 4 --users 50 --out after.json \\
+        --baseline before.json
+"""
+
+import argparse
+import json
+import math
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.cookiejar import CookieJar
+from random import Random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import app
+from models import db, User, Message
+
+# Every seeded user's password (see generator/create_csvs.py)
+PASSWORD = 'password'
+
+# How often each journey is picked, relative to the others
+JOURNEYS = {
+    'browse': 40,
+    'search': 20,
+    'like': 20,
+    'post': 10,
+    'follow': 10,
+}
+
+SAMPLE_SIZE = 1000
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class InProcessClient:
+    """Sends requests straight to the app with Flask's test client."""
+
+    def __init__(self):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        """Send a request; return (status code, body text)."""
+
+        response = self.client.open(path, method=method, data=data)
+        return response.status_code, response.get_data(as_text=True)
+
+
+class NoRedirects(urllib.request.HTTPRedirectHandler):
+    """Leave redirects unfollowed, so each request is timed on its own."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpClient:
+    """Sends requests over HTTP to a running server, keeping cookies."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(CookieJar()), NoRedirects())
+
+    def request(self, method, path, data=None):
+        """Send a request; return (status code, body text)."""
+
+        body = urllib.parse.urlencode(data).encode() if data else None
+        req = urllib.request.Request(self.base_url + path, data=body,
+                                     method=method)
+        try:
+            with self.opener.open(req) as response:
+                return response.status, response.read().decode()
+        except urllib.error.HTTPError as error:
+            return error.code, error.read().decode()
+
+
+class Recorder:
+    """Collects the latency of every request, by endpoint."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, seconds, ok):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def summary(self, elapsed):
+        """Return {endpoint: stats} with latencies in milliseconds."""
+
+        stats = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            stats[endpoint] = {
+                'requests': len(latencies),
+                'errors': self.errors[endpoint],
+                'throughput': len(latencies) / elapsed,
+                'mean_ms': 1000 * sum(latencies) / len(latencies),
+                'p50_ms': 1000 * percentile(latencies, 50),
+                'p95_ms': 1000 * percentile(latencies, 95),
+                'p99_ms': 1000 * percentile(latencies, 99),
+                'max_ms': 1000 * latencies[-1],
+            }
+        return stats
+
+
+def percentile(ordered, p):
+    """Return the nearest-rank `p`th percentile of sorted `ordered`."""
+
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+class VirtualUser:
+    """One simulated person, logged in and working through journeys."""
+
+    def __init__(self, client, recorder, rng, sample):
+        self.client = client
+        self.recorder = recorder
+        self.rng = rng
+        self.sample = sample
+        self.csrf_token = None
+        self.liked = set()
+
+    def call(self, endpoint, method, path, data=None, expect=None):
+        """Send a timed request, recorded under `endpoint`.
+
+        It counts as an error if it fails, or isn't the `expect` status.
+        """
+
+        start = time.perf_counter()
+        status, body = self.client.request(method, path, data)
+        ok = status < 400 and expect in (None, status)
+        self.recorder.add(endpoint, time.perf_counter() - start, ok)
+        return body
+
+    def form(self, endpoint, path, data):
+        """POST a WTForms form at `path`, with a CSRF token.
+
+        A valid form redirects; one that's re-rendered was rejected.
+        """
+
+        if self.csrf_token is None:
+            status, body = self.client.request('GET', path)
+            match = CSRF_TOKEN.search(body)
+            self.csrf_token = match.group(1) if match else ''
+
+        if self.csrf_token:
+            data = dict(data, csrf_token=self.csrf_token)
+        return self.call(endpoint, 'POST', path, data, expect=302)
+
+    def login(self, username):
+        self.form('login', '/login',
+                  {'username': username, 'password': PASSWORD})
+        # the token is tied to the session, which login just replaced
+        self.csrf_token = None
+
+    def browse(self):
+        self.call('homepage', 'GET', '/')
+        self.call('users_show', 'GET',
+                  f"/users/{self.rng.choice(self.sample['user_ids'])}")
+
+    def search(self):
+        term = self.rng.choice(self.sample['usernames'])[:3]
+        self.call('list_users', 'GET', f"/users?q={urllib.parse.quote(term)}")
+
+        word = self.rng.choice(self.sample['words'])
+        self.call('messages_search', 'GET',
+                  f"/messages/search?q={urllib.parse.quote(word)}")
+
+    def like(self):
+        """Toggle a like the way app.js does, through the JSON API."""
+
+        self.call('homepage', 'GET', '/')
+        message_id = self.rng.choice(self.sample['message_ids'])
+        if message_id in self.liked:
+            self.liked.discard(message_id)
+            method = 'DELETE'
+        else:
+            self.liked.add(message_id)
+            method = 'PUT'
+        self.call('api_like', method, f"/api/messages/{message_id}/like",
+                  expect=200)
+
+    def post(self):
+        words = self.rng.choices(self.sample['words'], k=8)
+        self.form('messages_add', '/messages/new',
+                  {'text': ' '.join(words).capitalize()[:140]})
+
+    def follow(self):
+        user_id = self.rng.choice(self.sample['user_ids'])
+        self.call('add_follow', 'POST', f"/users/follow/{user_id}")
+        self.call('users_show', 'GET', f"/users/{user_id}")
+        self.call('stop_following', 'POST', f"/users/stop-following/{user_id}")
+
+    def run(self, deadline):
+        journeys = list(JOURNEYS)
+        weights = list(JOURNEYS.values())
+
+        while time.perf_counter() < deadline:
+            journey = self.rng.choices(journeys, weights)[0]
+            getattr(self, journey)()
+
+
+def sample_data(rng):
+    """Pick users, messages and search words to drive the journeys with."""
+
+    with app.app_context():
+        users = (db.session.query(User.id, User.username)
+                 .order_by(db.func.random())
+                 .limit(SAMPLE_SIZE)
+                 .all())
+        messages = (db.session.query(Message.id, Message.text)
+                    .order_by(db.func.random())
+                    .limit(SAMPLE_SIZE)
+                    .all())
+        db.session.remove()
+
+    if not users or not messages:
+        raise SystemExit("No users or messages to test with; seed the "
+                         "database in DATABASE_URL first.")
+
+    words = {word.strip('.,').lower()
+             for _, text in messages for word in text.split()}
+    return {
+        'user_ids': [id for id, _ in users],
+        'usernames': [username for _, username in users],
+        'message_ids': [id for id, _ in messages],
+        'words': sorted(word for word in words if len(word) > 3),
+    }
+
+
+def start_gunicorn(workers, port):
+    """Start gunicorn serving the app; return the process once it's up."""
+
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--bind',
+         f"127.0.0.1:{port}", 'app:app'],
+        cwd=os.path.join(os.path.dirname(__file__), '..'))
+
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/login")
+            return server
+        except OSError:
+            time.sleep(0.2)
+
+    server.terminate()
+    raise SystemExit("gunicorn didn't start within 30 seconds.")
+
+
+def git_commit():
+    """Return the current commit hash, or None outside a git checkout."""
+
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(__file__) or '.').decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(endpoints, baseline=None):
+    """Print a table of endpoint stats, with p95 against `baseline`."""
+
+    print(f"{'endpoint':<16} {'reqs':>7} {'errs':>5} {'req/s':>8} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+          + ("  p95 vs baseline" if baseline else ""))
+
+    for endpoint, stats in endpoints.items():
+        line = (f"{endpoint:<16} {stats['requests']:>7} {stats['errors']:>5} "
+                f"{stats['throughput']:>8.1f} {stats['p50_ms']:>8.1f} "
+                f"{stats['p95_ms']:>8.1f} {stats['p99_ms']:>8.1f}")
+
+        before = (baseline or {}).get(endpoint)
+        if before:
+            line += f"  {stats['p95_ms'] / before['p95_ms']:>6.2f}x"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10,
+                        help="virtual users running at once")
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--url', help="base URL of a running server")
+    target.add_argument('--gunicorn', type=int, metavar='WORKERS',
+                        help="start gunicorn with this many workers")
+    parser.add_argument('--port', type=int, default=8765,
+                        help="port for --gunicorn")
+    parser.add_argument('--out', default='load_harness.json')
+    parser.add_argument('--baseline',
+                        help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    rng = Random(args.seed)
+    sample = sample_data(rng)
+
+    server = None
+    if args.gunicorn:
+        server = start_gunicorn(args.gunicorn, args.port)
+        args.url = f"http://127.0.0.1:{args.port}"
+    elif not args.url:
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['DEBUG_TB_ENABLED'] = False
+
+    def make_client():
+        return HttpClient(args.url) if args.url else InProcessClient()
+
+    recorder = Recorder()
+    people = [VirtualUser(make_client(), recorder, Random(rng.random()),
+                          sample)
+              for _ in range(args.users)]
+
+    try:
+        # log everyone in before the clock starts
+        with ThreadPoolExecutor(max_workers=args.users) as pool:
+            list(pool.map(lambda person: person.login(
+                rng.choice(sample['usernames'])), people))
+
+        start = time.perf_counter()
+        deadline = start + args.seconds
+        with ThreadPoolExecutor(max_workers=args.users) as pool:
+            list(pool.map(lambda person: person.run(deadline), people))
+        elapsed = time.perf_counter() - start
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    endpoints = recorder.summary(elapsed)
+    total = sum(stats['requests'] for stats in endpoints.values())
+    results = {
+        'commit': git_commit(),
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'target': args.url or 'in-process',
+        'gunicorn_workers': args.gunicorn,
+        'virtual_users': args.users,
+        'seconds': elapsed,
+        'seed': args.seed,
+        'requests': total,
+        'throughput': total / elapsed,
+        'endpoints': endpoints,
+    }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['endpoints']
+
+    print_report(endpoints, baseline)
+    print(f"\n{total} requests in {elapsed:.1f}s "
+          f"({total / elapsed:.1f} req/s); results in {args.out}")
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
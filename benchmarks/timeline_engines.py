@@ -0,0 +1,168 @@
+"""Benchmark the push and pull home timeline engines.
+
+Builds a scratch database of --authors authors with --messages messages
+each, and one reader for each --followees count who follows that many of
+them, picked at random. Then,
+for every reader and TIMELINE_ENGINE, times home_timeline() for the first
+page and for a page from halfway back, reporting p50 and p95 in
+milliseconds. The pull engine is timed with its followee cache warm (as it
+mostly is) and cold.
+
+The data goes in BENCH_DATABASE_URL (default postgresql:///warbler-bench),
+whose tables are dropped and recreated (unless --reuse); create the
+database first.
+
+run it like:
+
+    createdb warbler-bench
+    python benchmarks/timeline_engines.py
+    python benchmarks/timeline_engines.py --followees 10 100 1000 10000 \\
+        --messages 50 --runs 50
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+os.environ['DATABASE_URL'] = os.environ.get('BENCH_DATABASE_URL',
+                                            'postgresql:///warbler-bench')
+
+from flask import g
+
+from app import app, followee_cache, home_timeline
+from models import db, User, Message, TimelineEntry
+
+ENGINES = [('push', True), ('pull', True), ('pull', False)]
+
+
+def build(authors, messages, followees):
+    """Recreate the tables with `authors` authors of `messages` messages
+    each; return {followee count: reader id}."""
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute("""
+        INSERT INTO users (email, username, password)
+        SELECT 'author' || n || '@bench.test', 'author' || n, 'unused'
+        FROM generate_series(1, :authors) n
+    """, {'authors': authors})
+
+    # spread over the last year; bulk inserts get legacy ids, so rekey
+    db.session.execute("""
+        INSERT INTO messages (text, timestamp, user_id)
+        SELECT 'Benchmark warble',
+               timezone('utc', now()) - random() * interval '365 days', id
+        FROM users CROSS JOIN generate_series(1, :messages)
+    """, {'messages': messages})
+    Message.rekey()
+
+    readers = {}
+    for count in followees:
+        reader = User(email=f"reader{count}@bench.test",
+                      username=f"reader{count}", password='unused')
+        db.session.add(reader)
+        db.session.flush()
+        db.session.execute("""
+            INSERT INTO follows (user_being_followed_id, user_following_id)
+            SELECT id, :reader FROM users
+            WHERE username LIKE 'author%' ORDER BY random() LIMIT :count
+        """, {'reader': reader.id, 'count': count})
+        readers[count] = reader.id
+
+    TimelineEntry.rebuild()
+    db.session.commit()
+    db.session.execute("ANALYZE")
+    db.session.commit()
+    return readers
+
+
+def timeline_ms(reader_id, before=None, warm=True):
+    """Time one call of home_timeline() for `reader_id`; return
+    (milliseconds, next cursor)."""
+
+    query_string = {'before': before} if before else {}
+    with app.test_request_context('/', query_string=query_string):
+        # as load_current_user has it: cached columns only, so the stat
+        # counters (like the pull engine's following_count) are queried
+        snapshot = User.query.get(reader_id).snapshot()
+        db.session.expunge_all()
+        g.user = User.from_snapshot(snapshot)
+        if not warm:
+            followee_cache.clear()
+
+        start = time.perf_counter()
+        _, cursor = home_timeline()
+        return (time.perf_counter() - start) * 1000, cursor
+
+
+def halfway_cursor(reader_id):
+    """A cursor for the page halfway back through `reader_id`'s
+    timeline."""
+
+    entries = TimelineEntry.query.filter_by(user_id=reader_id).count()
+    middle = (TimelineEntry.query
+              .filter_by(user_id=reader_id)
+              .order_by(TimelineEntry.message_id.desc())
+              .offset(entries // 2)
+              .first())
+    db.session.remove()
+    return str(middle.message_id)
+
+
+def percentiles(times):
+    times = sorted(times)
+    return statistics.median(times), times[int(len(times) * 0.95)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--followees', type=int, nargs='+',
+                        default=[10, 1000, 10000])
+    parser.add_argument('--authors', type=int, default=100000)
+    parser.add_argument('--messages', type=int, default=20,
+                        help="messages per author")
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--reuse', action='store_true',
+                        help="time the data from the last run again")
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.reuse:
+            readers = {count: User.query.filter_by(
+                           username=f"reader{count}").one().id
+                       for count in args.followees}
+        else:
+            print("Building data...", flush=True)
+            readers = build(args.authors, args.messages, args.followees)
+        db.session.remove()
+
+        print(f"{'followees':>9}  {'engine':<11}  {'first p50':>9}  "
+              f"{'first p95':>9}  {'deep p50':>9}  {'deep p95':>9}")
+
+        for count, reader_id in readers.items():
+            deep = halfway_cursor(reader_id)
+
+            for engine, warm in ENGINES:
+                app.config['TIMELINE_ENGINE'] = engine
+                # one untimed call to warm the caches
+                timeline_ms(reader_id)
+
+                first = [timeline_ms(reader_id, warm=warm)[0]
+                         for _ in range(args.runs)]
+                deeper = [timeline_ms(reader_id, deep, warm=warm)[0]
+                          for _ in range(args.runs)]
+
+                label = engine if warm else f"{engine} (cold)"
+                print(f"{count:>9}  {label:<11}  "
+                      f"{'  '.join(f'{ms:>9.2f}' for ms in percentiles(first))}  "
+                      f"{'  '.join(f'{ms:>9.2f}' for ms in percentiles(deeper))}",
+                      flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+"""Bulk load Warbler CSVs with PostgreSQL COPY.
+
+Each CSV is streamed into its table with COPY, in chunks, so memory use
+stays flat however large the files are. Before loading, foreign keys,
+unique constraints, secondary indexes and the counter triggers are set
+aside. That makes the tables independent, so they load in parallel on
+separate connections. Afterwards the loaded tables' indexes are rebuilt
+and the id sequences reset, loaded messages are given snowflake ids from
+their timestamps, user stats are recounted and home timelines are rebuilt
+(all of which read off those indexes), and only then are the timelines'
+indexes and the constraints put back.
+
+The statements that put them back are written to a restore file before
+anything is dropped. If the load fails they're run straight away; any that
+fail in turn (say, a foreign key the partly loaded data breaks) stay in the
+file to run with psql once the data is fixed, and no load starts while the
+file is there.
+
+run it like:
+
+    python bulk_load.py generator/
+    python bulk_load.py --fresh --workers 4 /data/fixtures/
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2.errors
+
+from app import db
+from models import User, Message, TimelineEntry
+
+# Tables the loader knows, in dependency order.
+TABLES = ['users', 'messages', 'follows', 'likes']
+
+CHUNK_SIZE = 1 << 20
+PROGRESS_EVERY = 2.0
+
+RESTORE_FILE = 'bulk_load_restore.sql'
+
+
+class ProgressReader:
+    """File wrapper that counts the lines COPY pulls through it and
+    reports rows/sec every PROGRESS_EVERY seconds.
+
+    Quoted newlines inside fields count too, so this is only an estimate;
+    the final count comes from COPY itself.
+    """
+
+    def __init__(self, table, f):
+        self.table = table
+        self.f = f
+        self.rows = -1      # the header line isn't a row
+        self.started = self.reported = time.perf_counter()
+
+    def read(self, size=CHUNK_SIZE):
+        chunk = self.f.read(size)
+        self.rows += chunk.count('\n')
+
+        now = time.perf_counter()
+        if now - self.reported >= PROGRESS_EVERY:
+            self.reported = now
+            report(self.table, self.rows, now - self.started)
+
+        return chunk
+
+
+def report(table, rows, elapsed, done=False):
+    """Print one progress line for `table`."""
+
+    state = 'loaded' if done else 'loading'
+    rate = rows / elapsed if elapsed else 0
+    print(f"{table:>10} {state}: {rows:,} rows ({rate:,.0f} rows/sec)",
+          flush=True)
+
+
+def deferred_constraints(cursor, tables):
+    """Return (name, table, definition) for the foreign keys and unique
+    constraints on `tables`, foreign keys first."""
+
+    cursor.execute("""
+        SELECT conname, conrelid::regclass::text, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE conrelid::regclass::text = ANY(%s) AND contype IN ('f', 'u')
+        ORDER BY contype = 'f' DESC, conname
+    """, (tables,))
+    return cursor.fetchall()
+
+
+def deferred_indexes(cursor, tables):
+    """Return (name, table, definition) for secondary indexes on `tables`
+    that don't back a constraint."""
+
+    cursor.execute("""
+        SELECT i.indexname, i.tablename, i.indexdef
+        FROM pg_indexes i
+        WHERE i.schemaname = current_schema()
+          AND i.tablename = ANY(%s)
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint c
+                          WHERE c.conname = i.indexname)
+        ORDER BY i.indexname
+    """, (tables,))
+    return cursor.fetchall()
+
+
+def serial_sequences(cursor, tables):
+    """Return (table, sequence) for each of `tables` with a serial id."""
+
+    cursor.execute("""
+        SELECT table_name, pg_get_serial_sequence(table_name, 'id')
+        FROM information_schema.columns
+        WHERE table_schema = current_schema()
+          AND table_name = ANY(%s) AND column_name = 'id'
+    """, (tables,))
+    return [row for row in cursor.fetchall() if row[1]]
+
+
+def restore_statements(constraints, indexes, tables):
+    """The statements putting back what the load sets aside: the triggers
+    of `tables`, then `indexes` (those on `tables` first), then
+    `constraints` (foreign keys last)."""
+
+    indexes = sorted(indexes, key=lambda index: index[1] not in tables)
+    return ([f"ALTER TABLE {table} ENABLE TRIGGER USER" for table in tables]
+            + [definition for _, _, definition in indexes]
+            + [f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}'
+               for name, table, definition in reversed(constraints)])
+
+
+def write_restore_file(path, statements):
+    with open(path, 'w') as f:
+        f.write("-- Written by bulk_load.py, to restore what a load set aside\n")
+        for statement in statements:
+            f.write(f"{statement};\n")
+
+
+def restore(cursor, statements):
+    """Run each of `statements` that's still needed; return those that
+    failed."""
+
+    failed = []
+    for statement in statements:
+        try:
+            cursor.execute(statement)
+        except (psycopg2.errors.DuplicateObject,
+                psycopg2.errors.DuplicateTable):
+            pass
+        except psycopg2.Error as e:
+            print(f"Couldn't restore: {statement}\n  {e}", flush=True)
+            failed.append(statement)
+    return failed
+
+
+def copy_table(table, path):
+    """Stream the CSV at `path` into `table` on a connection of its own."""
+
+    conn = db.engine.raw_connection()
+    try:
+        with open(path, newline='') as f:
+            columns = f.readline().strip()
+            f.seek(0)
+            reader = ProgressReader(table, f)
+            cursor = conn.cursor()
+            cursor.copy_expert(
+                f"COPY {table} ({columns}) FROM STDIN "
+                f"WITH (FORMAT csv, HEADER true)",
+                reader, size=CHUNK_SIZE)
+            rows = cursor.rowcount
+        conn.commit()
+    finally:
+        conn.close()
+
+    elapsed = time.perf_counter() - reader.started
+    report(table, rows, elapsed, done=True)
+    return rows
+
+
+def load_csvs(paths, workers=None, restore_file=RESTORE_FILE):
+    """COPY each {table: csv path} in `paths` into its table.
+
+    likes.csv refers to messages by their line in messages.csv, so likes
+    can only be loaded along with messages, into an empty messages table.
+    `restore_file` is where the statements to put back the dropped indexes
+    and constraints are kept until they've been run.
+
+    Returns {table: rows loaded}.
+    """
+
+    if os.path.exists(restore_file):
+        raise RuntimeError(
+            f"{restore_file} is left from a failed load: run it with psql, "
+            f"then delete it")
+
+    tables = [table for table in TABLES if table in paths]
+    started = time.perf_counter()
+
+    # timelines are rebuilt from the loaded tables, so defer theirs too
+    deferred = tables + ['timelines']
+
+    conn = db.engine.raw_connection()
+    conn.detach()
+    # the pool's pre-ping may have left a transaction open
+    conn.rollback()
+    conn.set_session(autocommit=True)
+    try:
+        cursor = conn.cursor()
+
+        if 'likes' in tables:
+            cursor.execute("SELECT EXISTS (SELECT 1 FROM messages)")
+            if 'messages' not in tables or cursor.fetchone()[0]:
+                raise ValueError(
+                    "likes.csv refers to messages by line number, so it can "
+                    "only be loaded with messages.csv into an empty table")
+            # so the messages load with their line numbers as ids
+            cursor.execute("ALTER SEQUENCE messages_id_seq RESTART")
+
+        constraints = deferred_constraints(cursor, deferred)
+        indexes = deferred_indexes(cursor, deferred)
+        statements = restore_statements(constraints, indexes, tables)
+        write_restore_file(restore_file, statements)
+
+        try:
+            for name, table, _ in constraints:
+                cursor.execute(
+                    f'ALTER TABLE {table} DROP CONSTRAINT "{name}"')
+            for name, _, _ in indexes:
+                cursor.execute(f'DROP INDEX "{name}"')
+            for table in tables:
+                cursor.execute(f"ALTER TABLE {table} DISABLE TRIGGER USER")
+
+            with ThreadPoolExecutor(
+                    max_workers=workers or len(tables)) as pool:
+                counts = dict(zip(tables, pool.map(
+                    lambda table: copy_table(table, paths[table]), tables)))
+
+            # triggers and the loaded tables' indexes: everything below
+            # reads off them. Timelines' indexes and the constraints wait.
+            print("Rebuilding indexes...", flush=True)
+            loaded_indexes = [index for index in indexes
+                              if index[1] in tables]
+            restore(cursor, statements[:len(tables) + len(loaded_indexes)])
+            for table, sequence in serial_sequences(cursor, tables):
+                cursor.execute(f"""
+                    SELECT setval(%s, coalesce(max(id), 1),
+                                  max(id) IS NOT NULL)
+                    FROM {table}
+                """, (sequence,))
+            cursor.execute("ANALYZE " + ", ".join(tables))
+
+            # likes loaded pointing at legacy ids; the foreign keys are
+            # gone, so rekeying fixes them up itself
+            print("Rekeying messages...", flush=True)
+            Message.rekey()
+
+            # the counter triggers and fan-out were skipped, so catch up
+            print("Recounting stats and rebuilding timelines...", flush=True)
+            User.reconcile_counts()
+            Message.reconcile_like_counts()
+            TimelineEntry.rebuild()
+            db.session.commit()
+
+            print("Rebuilding timeline indexes and constraints...",
+                  flush=True)
+        except BaseException:
+            db.session.rollback()
+            print("Load failed; restoring indexes and constraints...",
+                  flush=True)
+            failed = restore(cursor, statements)
+            if failed:
+                write_restore_file(restore_file, failed)
+                print(f"Run {restore_file} with psql once the data is "
+                      f"fixed.", flush=True)
+            else:
+                os.remove(restore_file)
+            raise
+
+        failed = restore(cursor, statements)
+        if failed:
+            write_restore_file(restore_file, failed)
+            raise RuntimeError(
+                f"Loaded, but couldn't restore everything: run "
+                f"{restore_file} with psql once the data is fixed")
+        os.remove(restore_file)
+        cursor.execute("ANALYZE " + ", ".join(deferred))
+    finally:
+        conn.close()
+
+    total = sum(counts.values())
+    elapsed = time.perf_counter() - started
+    print(f"Loaded {total:,} rows in {elapsed:.1f}s "
+          f"({total / elapsed:,.0f} rows/sec overall)", flush=True)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('directory',
+                        help="directory holding users.csv, messages.csv, "
+                             "follows.csv and (optionally) likes.csv")
+    parser.add_argument('--fresh', action='store_true',
+                        help="drop and recreate all tables first")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="tables to load at once (default: all)")
+    parser.add_argument('--restore-file', default=RESTORE_FILE,
+                        help="where to keep the statements restoring "
+                             f"indexes and constraints (default: "
+                             f"{RESTORE_FILE})")
+    args = parser.parse_args()
+
+    paths = {table: os.path.join(args.directory, f"{table}.csv")
+             for table in TABLES}
+    paths = {table: path for table, path in paths.items()
+             if os.path.exists(path)}
+
+    if args.fresh:
+        db.drop_all()
+        db.create_all()
+
+    load_csvs(paths, workers=args.workers, restore_file=args.restore_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""In-process caches for Warbler."""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalCache:
+    """A thread-safe LRU cache whose entries expire after `ttl` seconds.
+
+    Each gunicorn worker holds its own copy, so anything cached here must
+    either be fine to serve for up to `ttl` seconds after it changes, or
+    carry a version that readers check before trusting it.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the live value cached under `key`, or `default`."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """Cache `value` under `key`, evicting the least recently used
+        entries beyond `maxsize`."""
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Drop `key` from the cache, if it's there."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Drop every entry."""
+
+        with self._lock:
+            self._entries.clear()
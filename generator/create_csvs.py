@@ -3,26 +3,79 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+Everything is made locally, so this runs offline. Rows are generated in
+fixed-size chunks across several processes and streamed to disk, so memory
+use stays small at any size. Each chunk has its own seed, so the same
+--seed and --until give the same files whatever --processes is.
+
+Follower counts, following counts, posting and liking all follow power
+laws: a few users are followed by, follow, post and like far more than
+everyone else. Message times lean toward the recent past and the waking
+hours.
+
+run it like:
+
+    python generator/create_csvs.py
+    python generator/create_csvs.py --users 1000000 --messages 50000000 \\
+        --follows 200000000 --likes 100000000 --out /data/fixtures/
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import shutil
+import tempfile
+from array import array
+from datetime import datetime
+from functools import lru_cache
+from math import gcd
+from multiprocessing import Pool
+from random import Random
+
 from faker import Faker
-from helpers import get_random_datetime
+from faker.providers.lorem.en_US import Provider as Lorem
+from helpers import get_realistic_datetime
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+NUM_FOLLOWS = 5000
+NUM_LIKES = 3000
 
-fake = Faker()
+# Rows per chunk of users or messages, and users per chunk of follows or
+# likes. Changing these changes the output for a given seed.
+CHUNK_ROWS = 10000
+CHUNK_USERS = 1000
+
+# Faker is slow, so each chunk asks it for this many names, emails and
+# cities and mixes them; text is strung together from its word list.
+FAKER_POOL = 250
+
+# How lopsided each distribution is. Picks are made by rank, with rank
+# fraction drawn as random() ** skew, so larger values pile more of them
+# onto the top ranks. Exponents shape how many follows or likes each user
+# makes: the user ranked r gets a share proportional to r ** -exponent.
+FOLLOWED_SKEW = 3.0
+POSTING_SKEW = 2.5
+LIKED_SKEW = 3.0
+FOLLOWING_EXPONENT = 0.8
+LIKING_EXPONENT = 0.9
+
+# Offsets that decide which user ids rank highly, so the most followed,
+# most active and most liked users aren't all the same people.
+FOLLOWED_SALT = 0
+POSTING_SALT = 7919
+FOLLOWING_SALT = 104729
+LIKING_SALT = 1299709
+
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
 # Generate random profile image URLs to use for users
 
@@ -32,46 +85,246 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header image URLs to use for users; nothing is fetched to build these
 
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
+    f"https://picsum.photos/seed/warbler-{i}/1280/400"
     for i in range(1, 46)
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+@lru_cache()
+def stride_for(n):
+    """Return a step coprime to `n`, so stepping through ranks by it visits
+    every id exactly once."""
+
+    stride = 1000003
+    while gcd(stride, n) != 1:
+        stride += 2
+    return stride
+
+
+def id_for_rank(rank, n, salt):
+    """Map `rank` (0 is the top) to an id in 1..n.
+
+    The mapping is a bijection that scatters neighbouring ranks across the
+    id space, without holding a table of all `n` ids.
+    """
+
+    return (rank * stride_for(n) + salt) % n + 1
+
+
+def skewed_id(rng, n, skew, salt):
+    """Pick an id in 1..n, favouring top ranks according to `skew`."""
+
+    return id_for_rank(int(n * rng.random() ** skew), n, salt)
+
+
+def per_user_counts(num_users, total, exponent, cap, salt):
+    """Split `total` across users by a power law, at most `cap` each.
+
+    Returns an array indexed by user id - 1.
+    """
+
+    if total > num_users * cap:
+        raise SystemExit(f"Can't fit {total:,} rows: at most {cap:,} "
+                         f"per user across {num_users:,} users.")
+
+    weights = [(rank + 1) ** -exponent for rank in range(num_users)]
+    scale = total / sum(weights)
+    by_rank = array('q', (min(cap, int(w * scale)) for w in weights))
+
+    # hand out what rounding and the cap left over, busiest users first
+    left = total - sum(by_rank)
+    rank = 0
+    while left:
+        if by_rank[rank] < cap:
+            by_rank[rank] += 1
+            left -= 1
+        rank = (rank + 1) % num_users
+
+    counts = array('q', bytes(8 * num_users))
+    for rank, count in enumerate(by_rank):
+        counts[id_for_rank(rank, num_users, salt) - 1] = count
+    return counts
+
+
+def pick_distinct(rng, count, n, skew, salt, exclude=None):
+    """Pick `count` different ids in 1..n, skewed toward top ranks and
+    never `exclude`."""
+
+    available = n - (exclude is not None)
+
+    # near-complete picks would mostly hit ids already taken; pick evenly
+    if count * 2 > available:
+        ids = [i for i in range(1, n + 1) if i != exclude]
+        return rng.sample(ids, count)
+
+    picked = set()
+    while len(picked) < count:
+        picked.add(skewed_id(rng, n, skew, salt))
+        picked.discard(exclude)
+    return sorted(picked)
+
+
+def fake_pool(rng, make):
+    """Return FAKER_POOL values from `make(fake)` with a seeded Faker."""
+
+    fake = Faker()
+    fake.seed_instance(rng.getrandbits(32))
+    return [make(fake) for _ in range(FAKER_POOL)]
+
+
+def fake_sentence(rng):
+    """Return a random sentence of lorem words."""
+
+    words = rng.choices(Lorem.word_list, k=rng.randint(4, 12))
+    return ' '.join(words).capitalize() + '.'
+
+
+def fake_warble(rng):
+    """Return random text of up to MAX_WARBLER_LENGTH characters."""
+
+    text = ' '.join(fake_sentence(rng) for _ in range(rng.randint(1, 4)))
+    return text[:MAX_WARBLER_LENGTH]
+
+
+def users_rows(rng, start, stop, options):
+    """Yield users `start` to `stop` (ids start + 1 and on)."""
+
+    emails = fake_pool(rng, lambda fake: fake.email().split('@'))
+    usernames = fake_pool(rng, lambda fake: fake.user_name())
+    cities = fake_pool(rng, lambda fake: fake.city())
+
+    for user_id in range(start + 1, stop + 1):
+        local, domain = rng.choice(emails)
+
+        # suffixing the id keeps these unique at any scale
+        yield [
+            f"{local}.{user_id}@{domain}",
+            f"{rng.choice(usernames)}_{user_id}",
+            rng.choice(image_urls),
+            PASSWORD,
+            fake_sentence(rng),
+            rng.choice(header_image_urls),
+            rng.choice(cities),
+        ]
+
+
+def messages_rows(rng, start, stop, options):
+    """Yield messages `start` to `stop`."""
+
+    for _ in range(start, stop):
+        yield [
+            fake_warble(rng),
+            get_realistic_datetime(now=options['until'], rng=rng),
+            skewed_id(rng, options['users'], POSTING_SKEW, POSTING_SALT),
+        ]
+
+
+def follows_rows(rng, start, stop, options):
+    """Yield who users `start` + 1 to `stop` follow."""
+
+    for follower_id, count in enumerate(options['counts'], start + 1):
+        for followed_id in pick_distinct(rng, count, options['users'],
+                                         FOLLOWED_SKEW, FOLLOWED_SALT,
+                                         exclude=follower_id):
+            yield [followed_id, follower_id]
+
+
+def likes_rows(rng, start, stop, options):
+    """Yield what users `start` + 1 to `stop` like."""
+
+    for user_id, count in enumerate(options['counts'], start + 1):
+        for message_id in pick_distinct(rng, count, options['messages'],
+                                        LIKED_SKEW, LIKING_SALT):
+            yield [user_id, message_id]
+
+
+ROWS = {
+    'users': users_rows,
+    'messages': messages_rows,
+    'follows': follows_rows,
+    'likes': likes_rows,
+}
+
+
+def write_chunk(task):
+    """Write one chunk of a table to its own file; return its path."""
+
+    table, index, start, stop, options, tmpdir = task
+    rng = Random(f"{options['seed']}-{table}-{index}")
+    path = os.path.join(tmpdir, f"{table}-{index:08d}.csv")
+
+    with open(path, 'w', newline='') as f:
+        csv.writer(f).writerows(ROWS[table](rng, start, stop, options))
+
+    return path
+
+
+def chunk_tasks(table, total, size, options, tmpdir, counts=None):
+    """Split `total` rows (or users) of `table` into chunk tasks."""
+
+    for index, start in enumerate(range(0, total, size)):
+        stop = min(start + size, total)
+        chunk_options = dict(options)
+        if counts is not None:
+            chunk_options['counts'] = counts[start:stop]
+        yield table, index, start, stop, chunk_options, tmpdir
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLOWS)
+    parser.add_argument('--likes', type=int, default=NUM_LIKES,
+                        help="no likes.csv is written when this is 0")
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--until', default=datetime.now().date().isoformat(),
+                        help="latest message time, as YYYY-MM-DD "
+                             "(default: today)")
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--out', default=os.path.dirname(__file__) or '.')
+    args = parser.parse_args()
+
+    options = dict(users=args.users, messages=args.messages, seed=args.seed,
+                   until=datetime.fromisoformat(args.until))
+
+    tables = [
+        ('users', USERS_CSV_HEADERS, args.users, CHUNK_ROWS, None),
+        ('messages', MESSAGES_CSV_HEADERS, args.messages, CHUNK_ROWS, None),
+        ('follows', FOLLOWS_CSV_HEADERS, args.users, CHUNK_USERS,
+         per_user_counts(args.users, args.follows, FOLLOWING_EXPONENT,
+                         args.users - 1, FOLLOWING_SALT)),
+    ]
+    if args.likes:
+        tables.append(
+            ('likes', LIKES_CSV_HEADERS, args.users, CHUNK_USERS,
+             per_user_counts(args.users, args.likes, LIKING_EXPONENT,
+                             args.messages, LIKING_SALT)))
+
+    tmpdir = tempfile.mkdtemp(dir=args.out)
+    try:
+        with Pool(args.processes) as pool:
+            for table, headers, total, size, counts in tables:
+                tasks = chunk_tasks(table, total, size, options, tmpdir,
+                                    counts)
+
+                with open(os.path.join(args.out, f"{table}.csv"), 'w',
+                          newline='') as out:
+                    csv.writer(out).writerow(headers)
+
+                    # chunks come back in order, so append and discard them
+                    for path in pool.imap(write_chunk, tasks):
+                        with open(path, newline='') as part:
+                            shutil.copyfileobj(part, out)
+                        os.remove(path)
+
+                print(f"Wrote {table}.csv", flush=True)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,44 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import random
+from datetime import datetime, timedelta
+from itertools import accumulate
 
+# Relative posting activity for each hour of the day: quiet overnight,
+# picking up through the day and peaking in the evening.
+HOURLY_ACTIVITY = [
+    2, 1, 1, 1, 1, 2, 4, 6, 7, 7, 7, 8,
+    9, 8, 7, 7, 8, 9, 10, 11, 11, 10, 7, 4,
+]
+HOURLY_CUM_WEIGHTS = list(accumulate(HOURLY_ACTIVITY))
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
 
-    now = datetime.now()
+def get_random_datetime(year_gap=2, now=None, rng=random):
+    """Get a random datetime within the last few years.
+
+    Pass `now` and a seeded `rng` to get the same datetime every run.
+    """
+
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    random_timestamp = rng.uniform(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+def get_realistic_datetime(year_gap=2, now=None, rng=random):
+    """Get a random datetime within the last few years, shaped like real
+    posting: more of it recently, as the site grows, and more of it in the
+    daytime and evening than overnight."""
+
+    now = now or datetime.now()
+    then = get_random_datetime(year_gap, now, rng)
+
+    # taking the later of two draws leans linearly toward `now`
+    later = get_random_datetime(year_gap, now, rng)
+    day = max(then, later).replace(hour=0, minute=0, second=0, microsecond=0)
+
+    hour = rng.choices(range(24), cum_weights=HOURLY_CUM_WEIGHTS)[0]
+    moment = day + timedelta(hours=hour, seconds=rng.uniform(0, 3600))
+
+    return min(moment, now)
@@ -0,0 +1,154 @@
+"""HTTP caching for Warbler: fingerprinted static files and conditional
+GETs."""
+
+import hashlib
+import os
+
+from flask import current_app, render_template, request, session, url_for
+
+# How long browsers and proxies may keep a fingerprinted static file
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def file_hash(path):
+    """Return a short hash of the contents of the file at `path`."""
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()[:12]
+
+
+def tree_hash(*directories):
+    """Return a short hash of every file under `directories`."""
+
+    digest = hashlib.sha1()
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                digest.update(os.path.relpath(path, directory).encode())
+                digest.update(file_hash(path).encode())
+    return digest.hexdigest()[:12]
+
+
+class HttpCache:
+    """Let browsers and proxies cache what they safely can.
+
+    Static files linked with `static_url()` get `?v=<hash of the file>`
+    appended. Requested with the current hash, they're cached for a year
+    (STATIC_MAX_AGE) and never revalidated, since a changed file gets a
+    new URL. Requested without it, they're revalidated every time.
+
+    Pages rendered with `render_if_modified()` carry a weak ETag built from
+    the data they show, and get a bodiless 304 without being rendered when
+    the browser already has that version; `not_modified()` checks first,
+    for views that can skip their queries too. Anything else is sent as
+    `private, no-cache`, unless the view set its own Cache-Control.
+    """
+
+    def __init__(self, app=None):
+        self._fingerprints = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Fingerprint the app's templates and static files and hook into
+        its responses."""
+
+        # a deploy that changes how pages look changes every ETag
+        self.release = tree_hash(
+            app.static_folder, os.path.join(app.root_path,
+                                            app.template_folder))
+        self.static_folder = app.static_folder
+
+        app.add_template_global(self.static_url, 'static_url')
+        app.after_request(self._add_headers)
+
+    def fingerprint(self, filename):
+        """Return the hash of static file `filename`, or None if there's no
+        such file. Hashes are kept until the file changes."""
+
+        path = os.path.join(self.static_folder, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        key = (filename, stat.st_mtime_ns, stat.st_size)
+        fingerprint = self._fingerprints.get(key)
+        if fingerprint is None:
+            fingerprint = self._fingerprints[key] = file_hash(path)
+        return fingerprint
+
+    def static_url(self, filename):
+        """The URL of static file `filename`, fingerprinted."""
+
+        return url_for('static', filename=filename,
+                       v=self.fingerprint(filename))
+
+    def etag(self, *parts):
+        """Return an ETag for a page showing `parts` (anything with a
+        stable repr) in this release."""
+
+        return hashlib.sha1(repr((self.release,) + parts).encode()).hexdigest()
+
+    def not_modified(self, etag, public=False):
+        """Return a bodiless 304 tagged with `etag` if the browser already
+        has that version of the page, or else None.
+
+        Views whose ETag comes from cheaper lookups than the page itself
+        call this first, and only query for the page when it's None.
+        """
+
+        # a pending flash is shown once, so the page can't be reused
+        if ('_flashes' in session
+                or not request.if_none_match.contains_weak(etag)):
+            return None
+
+        return self._tag(current_app.response_class(status=304), etag, public)
+
+    def render_if_modified(self, etag, template, public=False, **context):
+        """Render `template` with `context`, tagged with `etag`; or, if the
+        browser sent that ETag, a 304 without rendering anything.
+
+        Pass `public=True` for pages shared caches may keep, which must not
+        depend on who's asking.
+        """
+
+        if '_flashes' in session:
+            return render_template(template, **context)
+
+        response = self.not_modified(etag, public)
+        if response is None:
+            response = self._tag(current_app.make_response(
+                render_template(template, **context)), etag, public)
+        return response
+
+    def _tag(self, response, etag, public):
+        response.set_etag(etag, weak=True)
+        response.cache_control.no_cache = True
+        if public:
+            response.cache_control.public = True
+        else:
+            response.cache_control.private = True
+        response.vary.add('Cookie')
+        return response
+
+    def _add_headers(self, response):
+        if request.endpoint == 'static':
+            filename = request.view_args.get('filename')
+            version = request.args.get('v')
+            if version and version == self.fingerprint(filename):
+                response.headers['Cache-Control'] = (
+                    f"public, max-age={STATIC_MAX_AGE}, immutable")
+            else:
+                response.headers['Cache-Control'] = 'public, no-cache'
+
+        elif 'Cache-Control' not in response.headers:
+            response.headers['Cache-Control'] = 'private, no-cache'
+
+        return response
@@ -0,0 +1,128 @@
+"""PostgreSQL LISTEN/NOTIFY for Warbler."""
+
+import os
+import select
+import threading
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
+
+
+class Listener:
+    """Run handlers for PostgreSQL notifications, on a thread of each
+    process's own.
+
+    Handlers are registered per channel with on(), and are called with each
+    notification's payload as it arrives; a notification is only sent once
+    the transaction that sent it commits. This is how one gunicorn worker
+    tells the others (on any host) to drop something they've cached, with
+    no query on their request path.
+
+    The listening connection is opened on the first request in each process
+    (so never before gunicorn forks) and that request waits until it's
+    listening. If the connection drops, it's reopened after RETRY seconds
+    and `on_reconnect` is called, if set, since anything sent in between
+    was missed.
+
+    Configured from the app with:
+
+    - LISTEN_DATABASE_URL: where to listen (default: SQLALCHEMY_DATABASE_URI,
+      unless DB_PGBOUNCER is set). LISTEN needs a connection of its own,
+      which pgbouncer's transaction pooling can't give, so with pgbouncer
+      point this at the database directly; otherwise nothing listens.
+    """
+
+    RETRY = 5
+
+    def __init__(self, app=None):
+        self.uri = None
+        self.handlers = {}
+        self.on_reconnect = None
+        self.logger = None
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read where to listen from `app.config`, and start listening on
+        its first request."""
+
+        default = (None if app.config.get('DB_PGBOUNCER')
+                   else app.config['SQLALCHEMY_DATABASE_URI'])
+        self.uri = (app.config.setdefault('LISTEN_DATABASE_URL', None)
+                    or default)
+        self.logger = app.logger
+        if self.uri is None:
+            app.logger.warning("LISTEN_DATABASE_URL isn't set, so nothing "
+                               "listens for notifications through pgbouncer")
+
+        app.before_request(self.start)
+
+    def on(self, channel):
+        """Decorator registering a handler for `channel`'s payloads."""
+
+        def register(handler):
+            self.handlers[channel] = handler
+            return handler
+        return register
+
+    def _reset(self):
+        """Forget the listening thread, which a forked child doesn't
+        inherit."""
+
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self, timeout=5):
+        """Start listening in this process, if it isn't already, waiting up
+        to `timeout` seconds for it to begin."""
+
+        if self._thread is not None or self.uri is None:
+            return
+
+        with self._lock:
+            if self._thread is None:
+                ready = threading.Event()
+                self._thread = threading.Thread(
+                    target=self._run, args=(ready,), name='listener',
+                    daemon=True)
+                self._thread.start()
+                ready.wait(timeout)
+
+    def _run(self, ready):
+        engine = create_engine(self.uri, poolclass=NullPool)
+
+        while True:
+            conn = None
+            try:
+                conn = engine.raw_connection()
+                conn.connection.set_session(autocommit=True)
+                cursor = conn.cursor()
+                for channel in self.handlers:
+                    cursor.execute(f'LISTEN "{channel}"')
+
+                if ready.is_set() and self.on_reconnect is not None:
+                    self.on_reconnect()
+                ready.set()
+
+                self._listen(conn.connection)
+            except Exception:
+                self.logger.exception("Stopped listening; retrying in %ss",
+                                      self.RETRY)
+            finally:
+                if conn is not None:
+                    conn.close()
+            threading.Event().wait(self.RETRY)
+
+    def _listen(self, conn):
+        """Hand each notification arriving on `conn` to its handler."""
+
+        while True:
+            if select.select([conn], [], [], self.RETRY) == ([], [], []):
+                continue
+            conn.poll()
+            while conn.notifies:
+                notify = conn.notifies.pop(0)
+                self.handlers[notify.channel](notify.payload)
@@ -0,0 +1,298 @@
+"""Prometheus metrics for Warbler."""
+
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from flask import Response, g, request, template_rendered, \
+    before_render_template
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+HELP = {
+    'warbler_requests_total':
+        ('counter', "Requests handled, by endpoint, method and status."),
+    'warbler_request_duration_seconds':
+        ('histogram', "Time to handle a request, by endpoint."),
+    'warbler_db_duration_seconds':
+        ('histogram', "Time a request spent running queries, by endpoint."),
+    'warbler_db_queries_total':
+        ('counter', "Queries run while handling requests, by endpoint."),
+    'warbler_template_render_seconds':
+        ('histogram', "Time to render a template, by template."),
+    'warbler_bcrypt_duration_seconds':
+        ('histogram', "Time to hash or check a password, by operation."),
+    'warbler_cache_hits_total':
+        ('counter', "Lookups served from a cache, by cache."),
+    'warbler_cache_misses_total':
+        ('counter', "Lookups a cache couldn't serve, by cache."),
+    'warbler_db_pool_size':
+        ('gauge', "Connections the pool keeps open."),
+    'warbler_db_pool_checked_out':
+        ('gauge', "Pool connections in use."),
+    'warbler_db_pool_overflow':
+        ('gauge', "Connections open beyond the pool size."),
+}
+
+
+class Metrics:
+    """Collect request, database, template, bcrypt and cache metrics, and
+    serve them at /metrics in the Prometheus text format.
+
+    Recording is a dict update under a lock. Each process keeps its own
+    numbers; when METRICS_DIR is set, each also writes them to a file
+    there within METRICS_FLUSH_INTERVAL seconds (default 1) of them
+    changing, at most once per interval, and
+    /metrics adds up the files from every process. So gunicorn workers
+    sharing a METRICS_DIR are reported together, whichever one is scraped.
+    Gauges only count processes that are still running.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._caches = {}
+        self._engine = None
+        self._flush_pending = False
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read settings from `app.config`, hook into its requests and
+        templates, and add the /metrics endpoint."""
+
+        self.directory = app.config.setdefault(
+            'METRICS_DIR', os.environ.get('METRICS_DIR'))
+        self.flush_interval = app.config.setdefault(
+            'METRICS_FLUSH_INTERVAL', 1.0)
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        before_render_template.connect(self._start_render, app)
+        template_rendered.connect(self._finish_render, app)
+        app.add_url_rule('/metrics', 'metrics', self.serve)
+
+    def track_cache(self, name, cache):
+        """Report the hits and misses of `cache` (a LocalCache)."""
+
+        self._caches[name] = cache
+
+    def track_engine(self, engine):
+        """Report on the connection pool of `engine`."""
+
+        self._engine = engine
+
+    def inc(self, name, labels, amount=1):
+        """Add `amount` to the counter `name` with `labels`."""
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += amount
+
+    def observe(self, name, labels, seconds):
+        """Record `seconds` in the histogram `name` with `labels`."""
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # a count per bucket, then +Inf, then the sum
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 2)
+            histogram[bisect_left(BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+
+    def _start(self):
+        g.metrics_started = time.perf_counter()
+
+    def _finish(self, response):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return response
+
+        endpoint = request.endpoint or 'unmatched'
+        labels = {'endpoint': endpoint}
+
+        self.observe('warbler_request_duration_seconds', labels,
+                     time.perf_counter() - started)
+        self.inc('warbler_requests_total',
+                 {'endpoint': endpoint, 'method': request.method,
+                  'status': str(response.status_code)})
+
+        queries = g.get('queries')
+        if queries is not None:
+            self.observe('warbler_db_duration_seconds', labels,
+                         queries.seconds)
+            self.inc('warbler_db_queries_total', labels, queries.count)
+
+        if self.directory:
+            self._schedule_flush()
+
+        return response
+
+    def _start_render(self, app, template, context):
+        g.setdefault('metrics_renders', []).append(time.perf_counter())
+
+    def _finish_render(self, app, template, context):
+        renders = g.get('metrics_renders')
+        if renders:
+            self.observe('warbler_template_render_seconds',
+                         {'template': template.name or 'string'},
+                         time.perf_counter() - renders.pop())
+
+    def snapshot(self):
+        """Return this process's counters, histograms and gauges."""
+
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(value)
+                          for key, value in self._histograms.items()}
+
+        for name, cache in self._caches.items():
+            counters[('warbler_cache_hits_total', (('cache', name),))] = \
+                cache.hits
+            counters[('warbler_cache_misses_total', (('cache', name),))] = \
+                cache.misses
+
+        gauges = {}
+        pool = self._engine.pool if self._engine is not None else None
+        if pool is not None and hasattr(pool, 'checkedout'):
+            gauges[('warbler_db_pool_size', ())] = pool.size()
+            gauges[('warbler_db_pool_checked_out', ())] = pool.checkedout()
+            gauges[('warbler_db_pool_overflow', ())] = max(pool.overflow(), 0)
+
+        return {'counters': counters, 'histograms': histograms,
+                'gauges': gauges}
+
+    def _schedule_flush(self):
+        """Flush within METRICS_FLUSH_INTERVAL, unless that's already due."""
+
+        with self._lock:
+            if self._flush_pending:
+                return
+            self._flush_pending = True
+
+        timer = threading.Timer(self.flush_interval, self.flush)
+        timer.daemon = True
+        timer.start()
+
+    def flush(self):
+        """Write this process's numbers to its file in METRICS_DIR."""
+
+        with self._lock:
+            self._flush_pending = False
+        snapshot = {kind: [[name, labels, value]
+                           for (name, labels), value in values.items()]
+                    for kind, values in self.snapshot().items()}
+
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        partial = f"{path}.{threading.get_ident()}.tmp"
+        with open(partial, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(partial, path)
+
+    def collect(self):
+        """Return every process's numbers, added up."""
+
+        if not self.directory:
+            return self.snapshot()
+
+        self.flush()
+        totals = {'counters': defaultdict(float),
+                  'histograms': {},
+                  'gauges': defaultdict(float)}
+
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            pid = os.path.basename(path)[:-len('.json')]
+            live = pid.isdigit() and _is_running(int(pid))
+
+            for name, labels, value in snapshot['counters']:
+                totals['counters'][(name, _labels(labels))] += value
+            for name, labels, value in snapshot['histograms']:
+                key = (name, _labels(labels))
+                total = totals['histograms'].setdefault(key, [0] * len(value))
+                totals['histograms'][key] = [a + b
+                                             for a, b in zip(total, value)]
+            if live:
+                for name, labels, value in snapshot['gauges']:
+                    totals['gauges'][(name, _labels(labels))] += value
+
+        return totals
+
+    def serve(self):
+        """Serve every metric in the Prometheus text format."""
+
+        return Response(render(self.collect()),
+                        mimetype='text/plain; version=0.0.4')
+
+
+def _labels(pairs):
+    return tuple(tuple(pair) for pair in pairs)
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (f'{key}="{_escape(value)}"' for key, value in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def render(collected):
+    """Format `collected` numbers in the Prometheus text format."""
+
+    series = defaultdict(list)
+    for kind in ('counters', 'gauges'):
+        for (name, labels), value in collected[kind].items():
+            series[name].append(f"{name}{_format_labels(labels)} {value:g}")
+
+    for (name, labels), histogram in collected['histograms'].items():
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), histogram[:-1]):
+            cumulative += count
+            le = (('le', bound if bound == '+Inf' else f"{bound:g}"),)
+            series[name].append(
+                f"{name}_bucket{_format_labels(labels, le)} {cumulative}")
+        series[name].append(
+            f"{name}_sum{_format_labels(labels)} {histogram[-1]:g}")
+        series[name].append(
+            f"{name}_count{_format_labels(labels)} {cumulative}")
+
+    lines = []
+    for name in sorted(series):
+        kind, text = HELP.get(name, ('untyped', name))
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(sorted(series[name]))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,285 @@
+"""Schema migrations for Warbler.
+
+MIGRATIONS lists, in order, the steps that bring a database made by an
+older version of Warbler up to the current schema. `flask db-upgrade`
+applies whichever a database hasn't had yet, each in its own transaction,
+and records it in schema_migrations; `flask db-status` lists them. A
+database made by `db.create_all()` already has the current schema, so it's
+recorded as having had every migration.
+
+Migration 0 catches up databases made before there were migrations, from
+the original four tables on; `upgrade()` refuses any database that doesn't
+have those, rather than guess at it.
+
+To change the schema, change the models, then add a migration doing the
+same to existing databases.
+"""
+
+from sqlalchemy import event
+
+from models import (db, User, Message, TimelineEntry, COUNTER_TRIGGERS,
+                    FOLLOWS_COUNTER_TRIGGER, LIKES_VERSION_TRIGGER,
+                    USERS_DELETED_TRIGGER, snowflake_workers)
+
+# The tables every Warbler database has had, since before migrations
+BASE_TABLES = ('users', 'messages', 'follows', 'likes')
+
+schema_migrations = db.Table(
+    'schema_migrations',
+    db.Column('version', db.Integer, primary_key=True),
+    db.Column('applied_at', db.DateTime, nullable=False,
+              server_default=db.text("(now() AT TIME ZONE 'utc')")),
+)
+
+# (version, function), in order
+MIGRATIONS = []
+
+
+def migration(version):
+    """Register the decorated function as migration `version`. Its
+    docstring's first line describes it."""
+
+    def register(upgrade):
+        MIGRATIONS.append((version, upgrade))
+        return upgrade
+
+    return register
+
+
+def create_index_concurrently(name, definition):
+    """Build index `name` ("ON table (columns)") without blocking writes,
+    unless it's already there.
+
+    CREATE INDEX CONCURRENTLY can't run in a transaction, so this uses a
+    connection of its own. A build that failed part way leaves an invalid
+    index behind, which is dropped and built again.
+    """
+
+    conn = db.engine.connect().execution_options(
+        isolation_level='AUTOCOMMIT')
+    try:
+        valid = conn.scalar("""
+            SELECT indisvalid FROM pg_index
+            WHERE indexrelid = to_regclass(%s)
+        """, (name,))
+        if valid is False:
+            conn.execute(f'DROP INDEX CONCURRENTLY "{name}"')
+        conn.execute(
+            f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{name}" {definition}')
+    finally:
+        conn.close()
+
+
+def has_column(table, column):
+    """Does `table` have `column`, in this migration's transaction?"""
+
+    return db.session.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema()
+            AND table_name = :table AND column_name = :column
+    """, {'table': table, 'column': column}).first() is not None
+
+
+def create_missing_indexes(*names):
+    """Build indexes `names` as the models define them, unless they're
+    there already.
+
+    They're built in the migration's transaction, not concurrently, for
+    migrations that have their tables locked anyway.
+    """
+
+    indexes = {index.name: index for table in db.metadata.tables.values()
+               for index in table.indexes}
+    conn = db.session.connection()
+    for name in names:
+        if conn.scalar("SELECT to_regclass(%s)", (name,)) is None:
+            indexes[name].create(conn)
+
+
+@migration(0)
+def before_migrations():
+    """Catch up a database made before migrations existed."""
+
+    # likes had an id of their own, and only one like per message
+    if has_column('likes', 'id'):
+        for statement in [
+            "DELETE FROM likes WHERE user_id IS NULL OR message_id IS NULL",
+            "ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_key",
+            "ALTER TABLE likes DROP CONSTRAINT likes_pkey",
+            "ALTER TABLE likes DROP COLUMN id",
+            """DELETE FROM likes AS later USING likes AS earlier
+                WHERE later.user_id = earlier.user_id
+                    AND later.message_id = earlier.message_id
+                    AND later.ctid > earlier.ctid""",
+            """ALTER TABLE likes
+                ALTER COLUMN user_id SET NOT NULL,
+                ALTER COLUMN message_id SET NOT NULL,
+                ADD PRIMARY KEY (user_id, message_id)""",
+        ]:
+            db.session.execute(statement)
+
+    for table, column, default in [
+        ('users', 'profile_version', 1),
+        ('users', 'messages_count', 0),
+        ('users', 'following_count', 0),
+        ('users', 'followers_count', 0),
+        ('users', 'likes_count', 0),
+        ('messages', 'like_count', 0),
+    ]:
+        db.session.execute(f"""
+            ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column}
+            integer NOT NULL DEFAULT {default}
+        """)
+
+    db.session.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    create_missing_indexes('ix_likes_message_id_user_id',
+                           'ix_users_username_trgm',
+                           'ix_users_search_document',
+                           'ix_messages_text_search')
+
+    User.reconcile_counts()
+    Message.reconcile_like_counts()
+    for table, trigger in COUNTER_TRIGGERS:
+        db.session.execute(trigger)
+
+    if not has_column('timelines', 'user_id'):
+        TimelineEntry.__table__.create(db.session.connection())
+        TimelineEntry.rebuild()
+
+
+@migration(1)
+def snowflake_message_ids():
+    """Switch messages to snowflake ids, rekeying the existing ones."""
+
+    for statement in [
+        "ALTER SEQUENCE messages_id_seq AS bigint OWNED BY NONE",
+        # feeds are ordered by message id now
+        "ALTER TABLE timelines DROP COLUMN IF EXISTS timestamp",
+        "ALTER TABLE likes DROP CONSTRAINT likes_message_id_fkey",
+        "ALTER TABLE timelines DROP CONSTRAINT timelines_message_id_fkey",
+        """ALTER TABLE messages
+            ALTER COLUMN id TYPE bigint,
+            ALTER COLUMN timestamp SET DEFAULT (now() AT TIME ZONE 'utc')""",
+        "ALTER TABLE likes ALTER COLUMN message_id TYPE bigint",
+        "ALTER TABLE timelines ALTER COLUMN message_id TYPE bigint",
+    ]:
+        db.session.execute(statement)
+
+    # without the foreign keys, likes and timelines are updated in bulk
+    # rather than by a cascade for each message
+    Message.rekey()
+
+    for table in ('likes', 'timelines'):
+        db.session.execute(f"""
+            ALTER TABLE {table} ADD CONSTRAINT {table}_message_id_fkey
+            FOREIGN KEY (message_id) REFERENCES messages (id)
+            ON DELETE CASCADE ON UPDATE CASCADE
+        """)
+
+
+@migration(2)
+def hot_path_indexes():
+    """Index messages by author and follows by follower."""
+
+    # profiles and the pull timeline engine: an author's newest messages
+    create_index_concurrently('ix_messages_user_id_id',
+                              "ON messages (user_id, id)")
+    # who a user follows (the primary key leads with who's followed)
+    create_index_concurrently(
+        'ix_follows_user_following_id',
+        "ON follows (user_following_id, user_being_followed_id)")
+    # a user's likes are already found by the likes primary key,
+    # (user_id, message_id)
+
+
+@migration(3)
+def likes_version():
+    """Version users by their likes and their messages' likes."""
+
+    db.session.execute("""
+        ALTER TABLE users
+        ADD COLUMN IF NOT EXISTS likes_version integer NOT NULL DEFAULT 0
+    """)
+    db.session.execute(LIKES_VERSION_TRIGGER)
+
+
+@migration(4)
+def snowflake_worker_leases():
+    """Lease snowflake worker ids rather than counting them out."""
+
+    # creating it fills it with free worker ids
+    snowflake_workers.create(db.session.connection(), checkfirst=True)
+    db.session.execute("DROP SEQUENCE IF EXISTS snowflake_worker_ids")
+
+
+@migration(5)
+def follows_counter_lock_order():
+    """Lock both users in id order when counting a follow."""
+
+    db.session.execute(FOLLOWS_COUNTER_TRIGGER)
+
+
+@migration(6)
+def users_deleted_notifications():
+    """Notify listening processes when a user is deleted."""
+
+    db.session.execute(USERS_DELETED_TRIGGER)
+
+
+def applied_versions():
+    """Return the set of migration versions this database has had,
+    creating schema_migrations if it's new."""
+
+    schema_migrations.create(db.engine, checkfirst=True)
+    return {version for (version,) in
+            db.session.execute(db.select([schema_migrations.c.version]))}
+
+
+def check_base_tables():
+    """Raise RuntimeError unless the database has the tables migration 0
+    starts from."""
+
+    missing = [table for table in BASE_TABLES if db.session.scalar(
+        "SELECT to_regclass(:table)", {'table': table}) is None]
+
+    if len(missing) == len(BASE_TABLES):
+        raise RuntimeError(
+            "This database has no Warbler tables to migrate. Make them with "
+            "db.create_all() (as seed.py does), which records every "
+            "migration as applied.")
+    if missing:
+        raise RuntimeError(
+            f"This database is missing the {', '.join(missing)} table(s), "
+            f"so it isn't a Warbler schema these migrations can upgrade.")
+
+
+def upgrade():
+    """Apply every migration this database hasn't had, in order; return
+    the versions applied.
+
+    Raises RuntimeError, changing nothing, if the database has never been
+    migrated and doesn't look like Warbler's.
+    """
+
+    applied = applied_versions()
+    if 0 not in applied:
+        check_base_tables()
+    done = []
+    for version, step in MIGRATIONS:
+        if version in applied:
+            continue
+        step()
+        db.session.execute(schema_migrations.insert().values(version=version))
+        db.session.commit()
+        done.append(version)
+    return done
+
+
+@event.listens_for(db.metadata, 'after_create')
+def stamp(target, connection, tables=(), **kwargs):
+    """Record every migration as applied on a database `create_all()` just
+    made from scratch (but not on an older one it only added tables to)."""
+
+    if Message.__table__ in tables and schema_migrations in tables:
+        connection.execute(schema_migrations.insert(), [
+            {'version': version} for version, _ in MIGRATIONS])
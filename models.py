@@ -1,18 +1,63 @@
 """SQLAlchemy models for Warbler."""
 
-from datetime import datetime
+import atexit
+import os
+import random
+import socket
+import threading
+import time
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import DDL, event, exc, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import joinedload, make_transient_to_detached
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import Passwords
+from snowflake import EPOCH, LOW_BITS, WORKERS, Snowflake
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from a replica database when one is set.
+
+    While `info['replica']` holds an engine (see replicas.py), queries run
+    on it; flushes still write to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = self.info.get('replica')
+        if replica is not None and not self._flushing:
+            return replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with RoutingSessions."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+passwords = Passwords()
+db = RoutingSQLAlchemy()
+snowflake = Snowflake()
+
+# Text search configurations. Users are searched with 'simple', which skips
+# stemming and stop words (better for usernames and place names); warbles
+# are prose, so they get English stemming.
+USER_SEARCH_CONFIG = db.text("'simple'::regconfig")
+MESSAGE_SEARCH_CONFIG = db.text("'english'::regconfig")
 
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
     __tablename__ = 'follows'
+    __table_args__ = (
+        # the primary key finds a user's followers; this, who they follow
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
 
     user_being_followed_id = db.Column(
         db.Integer,
@@ -30,24 +75,232 @@ class Follows(db.Model):
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
-    __tablename__ = 'likes' 
+    __tablename__ = 'likes'
+    __table_args__ = (
+        # the primary key finds a user's likes; this finds a message's
+        db.Index('ix_likes_message_id_user_id', 'message_id', 'user_id'),
+    )
 
-    id = db.Column(
+    user_id = db.Column(
         db.Integer,
-        primary_key=True
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade', onupdate='cascade'),
+        primary_key=True,
+    )
+
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Have `user_id` like `message_id`, unless they already do.
+
+        A single insert that skips existing rows, so repeating it is
+        harmless. Returns whether a like was added.
+        """
+
+        stmt = (insert(cls.__table__)
+                .values(user_id=user_id, message_id=message_id)
+                .on_conflict_do_nothing())
+        return db.session.execute(stmt).rowcount == 1
+
+    @classmethod
+    def remove(cls, user_id, message_id):
+        """Have `user_id` stop liking `message_id`, if they do.
+
+        Returns whether a like was removed.
+        """
+
+        removed = (cls.query
+                   .filter(cls.user_id == user_id,
+                           cls.message_id == message_id)
+                   .delete(synchronize_session=False))
+        return removed > 0
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into one user's home timeline.
+
+    Rows are written when a message is posted (fan-out-on-write), so reading
+    a home feed is a single range scan of the (user_id, message_id) primary
+    key, message ids being time-ordered.
+
+    Timelines are trimmed to their newest MAX_LENGTH entries, so storage
+    grows with users rather than with messages times followers; the push
+    feed reaches back that far and no further. Finding where to cut costs a
+    read of MAX_LENGTH keys per timeline, too much to do for every follower
+    on every post, so one fan-out in TRIM_EVERY (at random) trims, and a
+    timeline runs over by about TRIM_EVERY entries at most.
+    """
+
+    __tablename__ = 'timelines'
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_author_id', 'user_id', 'author_id'),
+        db.Index('ix_timelines_message_id', 'message_id'),
     )
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade', onupdate='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
         db.Integer,
-        db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
     )
 
+    COLUMNS = ['user_id', 'message_id', 'author_id']
+
+    MAX_LENGTH = 800
+    TRIM_EVERY = 10
+
+    @classmethod
+    def _insert_from(cls, select):
+        """Insert rows from `select`, skipping any already materialized."""
+
+        stmt = (insert(cls.__table__)
+                .from_select(cls.COLUMNS, select)
+                .on_conflict_do_nothing())
+        return db.session.execute(stmt).rowcount
+
+    @classmethod
+    def fan_out(cls, message):
+        """Push a newly flushed `message` into its author's timeline and the
+        timelines of everyone following the author, now and then trimming
+        them to MAX_LENGTH."""
+
+        values = [db.literal(message.id, db.BigInteger),
+                  db.literal(message.user_id)]
+        followers = (db.select([Follows.user_following_id] + values)
+                     .where(Follows.user_being_followed_id == message.user_id))
+        author = db.select([db.literal(message.user_id)] + values)
+
+        count = cls._insert_from(db.union_all(followers, author))
+        if random.randrange(cls.TRIM_EVERY) == 0:
+            cls.trim(db.union_all(
+                db.select([Follows.user_following_id.label('user_id')])
+                .where(Follows.user_being_followed_id == message.user_id),
+                db.select([db.literal(message.user_id).label('user_id')])))
+        return count
+
+    @classmethod
+    def backfill(cls, follower_id, followed_id):
+        """Copy `followed_id`'s newest messages into `follower_id`'s
+        timeline after a new follow, keeping it to MAX_LENGTH."""
+
+        select = (db.select([db.literal(follower_id),
+                             Message.id,
+                             Message.user_id])
+                  .where(Message.user_id == followed_id)
+                  .order_by(Message.id.desc())
+                  .limit(cls.MAX_LENGTH))
+        count = cls._insert_from(select)
+        cls.trim(db.select([db.literal(follower_id).label('user_id')]))
+        return count
+
+    @classmethod
+    def trim(cls, owners):
+        """Drop all but the newest MAX_LENGTH entries from the timelines of
+        the users selected (as `user_id`) by `owners`.
+
+        Finding where a timeline is cut reads its newest MAX_LENGTH keys,
+        off the primary key.
+        """
+
+        timelines = cls.__table__
+        owners = owners.alias('owners')
+        newer = timelines.alias('newer')
+        cutoff = (db.select([newer.c.message_id])
+                  .where(newer.c.user_id == owners.c.user_id)
+                  .order_by(newer.c.message_id.desc())
+                  .offset(cls.MAX_LENGTH)
+                  .limit(1)
+                  .lateral('cutoff'))
+        cutoffs = (db.select([owners.c.user_id, cutoff.c.message_id])
+                   .select_from(owners.join(cutoff, db.true()))
+                   .alias('cutoffs'))
+
+        return db.session.execute(
+            timelines.delete()
+            .where(timelines.c.user_id == cutoffs.c.user_id)
+            .where(timelines.c.message_id <= cutoffs.c.message_id)).rowcount
+
+    @classmethod
+    def prune(cls, follower_id, followed_id):
+        """Drop `followed_id`'s messages from `follower_id`'s timeline after
+        an unfollow."""
+
+        if follower_id == followed_id:
+            return 0
+
+        return (cls.query
+                .filter(cls.user_id == follower_id,
+                        cls.author_id == followed_id)
+                .delete(synchronize_session=False))
+
+    @classmethod
+    def remove_message(cls, message_id):
+        """Remove a deleted message from every timeline it was pushed to."""
+
+        return (cls.query
+                .filter(cls.message_id == message_id)
+                .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute every timeline from the follows and messages tables,
+        keeping the newest MAX_LENGTH entries of each.
+
+        Used after bulk loads (which bypass fan-out) or to repair drift.
+        Each user's timeline is merged from the newest MAX_LENGTH messages
+        of everyone they follow (and their own), read off the
+        (user_id, id) index, so the work is bounded by follows times
+        MAX_LENGTH however many messages there are. Returns the number of
+        entries written.
+        """
+
+        cls.query.delete(synchronize_session=False)
+
+        return db.session.execute(db.text("""
+            INSERT INTO timelines (user_id, message_id, author_id)
+            SELECT users.id, newest.id, newest.user_id
+            FROM users CROSS JOIN LATERAL (
+                SELECT recent.id, recent.user_id
+                FROM (SELECT users.id AS author_id
+                      UNION
+                      SELECT user_being_followed_id FROM follows
+                      WHERE user_following_id = users.id) AS authors
+                CROSS JOIN LATERAL (
+                    SELECT id, user_id FROM messages
+                    WHERE user_id = authors.author_id
+                    ORDER BY id DESC LIMIT :length) AS recent
+                ORDER BY recent.id DESC LIMIT :length) AS newest
+        """), {'length': cls.MAX_LENGTH}).rowcount
+
+    @classmethod
+    def feed(cls, user_id):
+        """Query for the messages in `user_id`'s timeline.
+
+        Order by TimelineEntry.message_id so the read stays on the primary
+        key.
+        """
+
+        return (Message
+                .query
+                .join(cls, cls.message_id == Message.id)
+                .options(joinedload(Message.user))
+                .filter(cls.user_id == user_id))
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,6 +347,56 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Bumped whenever the profile or password changes; cached copies of the
+    # user (see User.snapshot) are only trusted at the current version.
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    # Denormalized stats, maintained by the counter triggers below so that
+    # showing them never loads the underlying collections.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped whenever this user likes or unlikes a message, or anyone likes
+    # or unlikes one of theirs (see LIKES_VERSION_TRIGGER), so pages
+    # showing either can be tagged without loading them.
+    likes_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -119,17 +422,100 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    # Columns kept in cached snapshots: the profile, and the counters the
+    # navbar, stats and page ETags read. Counters the user changes are
+    # refreshed by the request changing them; those others change may be
+    # stale for the cache's TTL. The password hash has no business in a
+    # cache, so it's left out and loaded from the database if it's used.
+    SNAPSHOT_COLUMNS = ['id', 'email', 'username', 'image_url',
+                        'header_image_url', 'bio', 'location',
+                        'profile_version', 'likes_version',
+                        'messages_count', 'following_count',
+                        'followers_count', 'likes_count']
+
+    def snapshot(self):
+        """Return this user's cacheable columns as a plain dict."""
+
+        return {column: getattr(self, column)
+                for column in self.SNAPSHOT_COLUMNS}
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Rebuild a user from `snapshot` and attach it to the session
+        without querying the database.
+
+        Columns missing from the snapshot, and all relationships, are
+        loaded lazily on first access, and changes flush as usual.
+        """
+
+        user = cls(**snapshot)
+        make_transient_to_detached(user)
+        db.session.add(user)
+        return user
+
+    def bump_version(self):
+        """Mark the profile as changed, invalidating cached snapshots."""
+
+        self.profile_version = User.profile_version + 1
+
+    def newest_message_id(self):
+        """Return the id of this user's newest message, or None."""
+
+        return (db.session
+                .query(db.func.max(Message.id))
+                .filter(Message.user_id == self.id)
+                .scalar())
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.is_following(self)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.following_ids([other_user.id])
+
+    def following_ids(self, user_ids):
+        """Which of `user_ids` is this user following?
+
+        Returns a set of user ids, resolved with a single lookup on the
+        follows primary key however many ids are asked about.
+        """
+
+        if not user_ids:
+            return set()
+
+        followed = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == self.id,
+                            Follows.user_being_followed_id.in_(user_ids)))
+        return {user_id for (user_id,) in followed}
+
+    def following_user_ids(self):
+        """Return the ids of everyone this user follows, as a list."""
+
+        followed = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == self.id))
+        return [user_id for (user_id,) in followed]
+
+    def liked_message_ids(self, messages):
+        """Which of `messages` has this user liked?
+
+        Returns a set of message ids, resolved with one indexed query for
+        the whole page rather than loading and scanning `self.likes`.
+        """
+
+        ids = [message.id for message in messages]
+        if not ids:
+            return set()
+
+        liked = (db.session
+                 .query(Likes.message_id)
+                 .filter(Likes.user_id == self.id,
+                         Likes.message_id.in_(ids)))
+        return {message_id for (message_id,) in liked}
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -138,7 +524,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash(password)
 
         user = User(
             username=username,
@@ -159,13 +545,19 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        A stored hash made at a different bcrypt cost than the configured one
+        is transparently rehashed, since the plain password is at hand.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = passwords.check(user.password, password)
             if is_auth:
+                if passwords.needs_rehash(user.password):
+                    user.password = passwords.hash(password)
+                    db.session.commit()
                 return user
 
         return False
@@ -181,21 +573,239 @@ class User(db.Model):
         if not user:
             return False
         
-        hashed_pwd = bcrypt.generate_password_hash(new).decode('UTF-8')
+        hashed_pwd = passwords.hash(new)
         
         user.password = hashed_pwd
+        user.bump_version()
         db.session.commit()
         return user
-        
+
+    @classmethod
+    def reconcile_counts(cls):
+        """Recount every user's stats from the source tables.
+
+        Only rows that have drifted are rewritten; returns how many were.
+        """
+
+        # one grouped pass per source table, rather than a count per user
+        def tally(column):
+            return (db.select([column.label('user_id'),
+                               db.func.count().label('total')])
+                    .group_by(column)
+                    .alias())
+
+        tallies = {
+            cls.messages_count: tally(Message.user_id),
+            cls.following_count: tally(Follows.user_following_id),
+            cls.followers_count: tally(Follows.user_being_followed_id),
+            cls.likes_count: tally(Likes.user_id),
+        }
+
+        joined = cls.__table__
+        for sub in tallies.values():
+            joined = joined.outerjoin(sub, sub.c.user_id == cls.id)
+
+        actual = (db.select([cls.id] + [
+                      db.func.coalesce(sub.c.total, 0).label(column.key)
+                      for column, sub in tallies.items()])
+                  .select_from(joined)
+                  .alias())
+
+        counts = {column: actual.c[column.key] for column in tallies}
+        drifted = db.or_(*[column != count for column, count in counts.items()])
+
+        return (cls.query
+                .filter(cls.id == actual.c.id, drifted)
+                .update(counts, synchronize_session=False))
+
+    @classmethod
+    def search_document(cls):
+        """The tsvector over username, bio and location that user search
+        matches words against (and that ix_users_search_document indexes)."""
+
+        columns = cls.__table__.c
+        text = (db.func.coalesce(columns.username, '') + ' ' +
+                db.func.coalesce(columns.bio, '') + ' ' +
+                db.func.coalesce(columns.location, ''))
+        return db.func.to_tsvector(USER_SEARCH_CONFIG, text)
+
+    @classmethod
+    def search(cls, term):
+        """Query for users matching `term`, most relevant first.
+
+        Usernames match on any substring (served by the trigram index);
+        username, bio and location also match on whole words (served by
+        the full-text index). Ranking favours close username matches.
+        """
+
+        pattern = '%{}%'.format(term.replace('\\', '\\\\')
+                                    .replace('%', '\\%')
+                                    .replace('_', '\\_'))
+        words = db.func.plainto_tsquery(USER_SEARCH_CONFIG, term)
+        document = cls.search_document()
+        rank = (db.func.similarity(cls.username, term) +
+                db.func.ts_rank(document, words))
+
+        return (cls.query
+                .filter(cls.username.ilike(pattern) |
+                        document.op('@@')(words))
+                .order_by(rank.desc(), cls.id))
+
+
+event.listen(User.__table__, 'before_create',
+             DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+
+db.Index('ix_users_username_trgm', User.username,
+         postgresql_using='gin',
+         postgresql_ops={'username': 'gin_trgm_ops'})
+
+db.Index('ix_users_search_document', User.search_document(),
+         postgresql_using='gin')
+
+
+# Which process holds each snowflake worker id, and until when (naive
+# UTC); see lease_worker_id
+snowflake_workers = db.Table(
+    'snowflake_workers',
+    db.Column('worker_id', db.SmallInteger, primary_key=True,
+              autoincrement=False),
+    db.Column('holder', db.Text),
+    db.Column('expires_at', db.DateTime, nullable=False,
+              server_default=db.text("'-infinity'")),
+)
+
+# How long a process holds its worker id without renewing it
+WORKER_LEASE_SECONDS = 60
+
+FREE_WORKER_IDS = DDL(f"""
+    INSERT INTO snowflake_workers (worker_id)
+    SELECT generate_series(0, {WORKERS - 1})
+    ON CONFLICT DO NOTHING
+""")
+
+event.listen(snowflake_workers, 'after_create', FREE_WORKER_IDS)
+
+# Numbers rows inserted without an id, such as by bulk loads, until
+# Message.rekey() replaces them with snowflakes
+legacy_message_ids = db.Sequence('messages_id_seq', metadata=db.metadata)
+
+_lease_lock = threading.Lock()
+
+
+def worker_holder():
+    """Who this process is, in snowflake_workers."""
+
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def lease_worker_id():
+    """Renew this process's lease on its snowflake worker id, or lease
+    one that's free.
+
+    Leases are held in snowflake_workers, on a connection of their own so
+    they stick whatever becomes of the transaction that needed an id.
+    A lease that has run out is renewed if nobody else has taken its
+    worker id since; otherwise the least recently expired free one is
+    taken. Raises RuntimeError if every worker id is leased.
+    """
+
+    with _lease_lock:
+        if not snowflake.needs_lease():
+            return
+
+        params = {'holder': worker_holder(),
+                  'worker_id': snowflake.worker_id,
+                  'seconds': WORKER_LEASE_SECONDS}
+        started = time.monotonic()
+        conn = db.engine.connect().execution_options(autocommit=True)
+        try:
+            worker_id = None
+            if snowflake.worker_id is not None:
+                worker_id = conn.scalar(db.text("""
+                    UPDATE snowflake_workers
+                    SET expires_at = (now() AT TIME ZONE 'utc')
+                                     + :seconds * interval '1 second'
+                    WHERE worker_id = :worker_id AND holder = :holder
+                    RETURNING worker_id
+                """), params)
+            if worker_id is None:
+                worker_id = conn.scalar(db.text("""
+                    UPDATE snowflake_workers
+                    SET holder = :holder,
+                        expires_at = (now() AT TIME ZONE 'utc')
+                                     + :seconds * interval '1 second'
+                    WHERE worker_id = (
+                        SELECT worker_id FROM snowflake_workers
+                        WHERE expires_at < (now() AT TIME ZONE 'utc')
+                        ORDER BY expires_at, worker_id
+                        LIMIT 1
+                        FOR UPDATE SKIP LOCKED)
+                    RETURNING worker_id
+                """), params)
+        finally:
+            conn.close()
+
+        if worker_id is None:
+            raise RuntimeError(f"All {WORKERS} snowflake worker ids are "
+                               f"leased; no message ids can be made")
+        snowflake.lease(worker_id, WORKER_LEASE_SECONDS, started)
+
+
+def release_worker_id():
+    """Give up this process's worker id, if it has one, so it's free
+    straight away rather than when the lease runs out."""
+
+    if snowflake.worker_id is None or snowflake.lease_until is None:
+        return
+
+    try:
+        with db.engine.connect() as conn:
+            conn.execution_options(autocommit=True).execute(db.text("""
+                UPDATE snowflake_workers SET holder = NULL,
+                    expires_at = '-infinity'
+                WHERE worker_id = :worker_id AND holder = :holder
+            """), worker_id=snowflake.worker_id, holder=worker_holder())
+    except exc.DBAPIError:
+        # it's free when the lease runs out anyway
+        pass
+
+
+atexit.register(release_worker_id)
+
+
+def next_message_id(context):
+    """Default for Message.id: a snowflake, leasing or renewing this
+    process's worker id when it needs to."""
+
+    if snowflake.needs_lease():
+        lease_worker_id()
+
+    return snowflake.next_id()
+
 
 class Message(db.Model):
-    """An individual message ("warble")."""
+    """An individual message ("warble").
+
+    Ids are snowflakes (see snowflake.py), so ordering by id orders by
+    creation time.
+    """
 
     __tablename__ = 'messages'
+    __table_args__ = (
+        # one author's messages, newest first
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+    )
+    __mapper_args__ = {
+        # read the server's timestamp back in the INSERT itself
+        'eager_defaults': True,
+    }
 
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=next_message_id,
+        server_default=legacy_message_ids.next_value(),
     )
 
     text = db.Column(
@@ -206,7 +816,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        server_default=db.text("(now() AT TIME ZONE 'utc')"),
     )
 
     user_id = db.Column(
@@ -215,14 +825,374 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Maintained by a counter trigger, like the User stats
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
+    @classmethod
+    def reconcile_like_counts(cls):
+        """Recount every message's likes from the likes table.
+
+        Only rows that have drifted are rewritten; returns how many were.
+        """
+
+        tally = (db.select([Likes.message_id,
+                            db.func.count().label('total')])
+                 .group_by(Likes.message_id)
+                 .alias())
+        actual = (db.select([cls.id,
+                             db.func.coalesce(tally.c.total, 0)
+                             .label('like_count')])
+                  .select_from(cls.__table__.outerjoin(
+                      tally, tally.c.message_id == cls.id))
+                  .alias())
+
+        return (cls.query
+                .filter(cls.id == actual.c.id,
+                        cls.like_count != actual.c.like_count)
+                .update({cls.like_count: actual.c.like_count},
+                        synchronize_session=False))
+
+    # Ids this low are from before snowflakes, when messages.id was a
+    # serial integer column, or from legacy_message_ids
+    LEGACY_ID_MAX = 2 ** 31 - 1
+
+    @classmethod
+    def rekey(cls):
+        """Replace legacy ids with snowflakes made from each message's
+        timestamp, and point likes and timeline entries at the new ids.
+
+        Rows with the same millisecond are numbered in the low bits, in
+        the order of their old ids. Returns how many messages were rekeyed.
+        """
+
+        millis = db.cast(
+            db.func.floor(db.extract('epoch', cls.timestamp - EPOCH) * 1000),
+            db.BigInteger)
+        number = db.func.row_number().over(partition_by=millis,
+                                           order_by=cls.id)
+        legacy = (db.select([cls.id,
+                             millis * (1 << LOW_BITS) + number - 1])
+                  .where(cls.id <= cls.LEGACY_ID_MAX))
+
+        rekeys = db.Table('message_rekeys', db.MetaData(),
+                          db.Column('old_id', db.BigInteger,
+                                    primary_key=True),
+                          db.Column('new_id', db.BigInteger),
+                          prefixes=['TEMPORARY'])
+        conn = db.session.connection()
+        rekeys.create(conn)
+
+        count = conn.execute(rekeys.insert().from_select(
+            ['old_id', 'new_id'], legacy)).rowcount
+        conn.execute(cls.__table__.update()
+                     .where(cls.id == rekeys.c.old_id)
+                     .values(id=rekeys.c.new_id))
+
+        # the foreign keys cascade the new ids, but bulk loads drop them
+        for table in (Likes.__table__, TimelineEntry.__table__):
+            conn.execute(table.update()
+                         .where(table.c.message_id == rekeys.c.old_id)
+                         .values(message_id=rekeys.c.new_id))
+
+        rekeys.drop(conn)
+        return count
+
+    @classmethod
+    def by_authors(cls, author_ids):
+        """Query for the messages by any of `author_ids`.
+
+        The ids are sent as a single array parameter however many there
+        are, and Postgres plans from how many that is: for a few authors
+        it reads each one's range of the (user_id, id) index, and for many
+        it walks the primary key back from the newest message, skipping the
+        rest, until it has a page.
+        """
+
+        return (cls.query
+                .options(joinedload(cls.user))
+                .filter(cls.user_id == db.any_(
+                    db.cast(list(author_ids), db.ARRAY(db.Integer)))))
+
+    # Where by_followed switches plans; about where the two cost the same
+    # on a seeded database of 100k authors with 20 messages each
+    FEW_AUTHORS = 500
+
+    @classmethod
+    def by_followed(cls, user_id, following_count):
+        """Query for the messages by user `user_id` and everyone they
+        follow, looking up who that is in the database.
+
+        Postgres can't tell from a subquery how many authors it will find,
+        so the caller passes the user's following_count and the query is
+        written for that many. Following up to FEW_AUTHORS, it's a join
+        reading each author's range of the (user_id, id) index; following
+        more, it's a filter on a walk back along the primary key from the
+        newest message, which fills a page sooner.
+        """
+
+        followed = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == user_id))
+        query = cls.query.options(joinedload(cls.user))
+
+        if following_count <= cls.FEW_AUTHORS:
+            authors = followed.union_all(
+                db.session.query(db.literal(user_id)))
+            return query.filter(cls.user_id.in_(authors))
+
+        return query.filter(db.or_(
+            cls.user_id == user_id,
+            followed.filter(Follows.user_being_followed_id == cls.user_id)
+                    .exists()))
+
+    @classmethod
+    def search_document(cls):
+        """The tsvector over message text that ix_messages_text_search
+        indexes."""
+
+        return db.func.to_tsvector(MESSAGE_SEARCH_CONFIG, cls.__table__.c.text)
+
+    @classmethod
+    def search(cls, term, followed_by=None):
+        """Query for messages whose text matches `term`.
+
+        Matching goes through the GIN index on the text's tsvector, which
+        Postgres keeps up to date as messages are inserted and deleted.
+        If `followed_by` is a user id, only messages from people that user
+        follows are included. Callers choose the order (usually newest
+        first, via keyset pagination).
+        """
+
+        words = db.func.plainto_tsquery(MESSAGE_SEARCH_CONFIG, term)
+        query = (cls.query
+                 .options(joinedload(cls.user))
+                 .filter(cls.search_document().op('@@')(words)))
+
+        if followed_by is not None:
+            followed = (db.session
+                        .query(Follows.user_being_followed_id)
+                        .filter(Follows.user_following_id == followed_by))
+            query = query.filter(cls.user_id.in_(followed))
+
+        return query
+
+
+db.Index('ix_messages_text_search', Message.search_document(),
+         postgresql_using='gin')
+
+
+def counter_trigger(table, counters, target='users'):
+    """Build the DDL for a trigger keeping stat columns on `target` (User
+    stats by default) in step with inserts and deletes on `table`.
+
+    `counters` maps a foreign key column on `table` to the `target` column
+    it counts. Doing this in the database keeps the counts right for every
+    write path (views, relationship appends, bulk loads, cascades) and in
+    the same transaction as the write itself. It replaces any trigger of
+    the same name, so migrations can run it again.
+
+    A row updating more than one `target` row locks them in id order
+    first, so two writes touching the same rows the other way round (A
+    following B as B follows A) wait for each other rather than deadlock.
+    It takes the same NO KEY UPDATE lock the updates do, which doesn't
+    wait on the KEY SHARE locks the foreign key checks hold.
+    """
+
+    def updates(row, op):
+        statements = [
+            f"UPDATE {target} SET {counter} = {counter} {op} 1 "
+            f"WHERE id = {row}.{column};"
+            for column, counter in counters.items()]
+        if len(counters) > 1:
+            ids = ", ".join(f"{row}.{column}" for column in counters)
+            statements.insert(0, f"PERFORM 1 FROM {target} WHERE id IN "
+                                 f"({ids}) ORDER BY id FOR NO KEY UPDATE;")
+        return "\n".join(statements)
+
+    return DDL(f"""
+        CREATE OR REPLACE FUNCTION count_{table}_for_{target}() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                {updates('NEW', '+')}
+            ELSE
+                {updates('OLD', '-')}
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS count_{table}_for_{target} ON {table};
+        CREATE TRIGGER count_{table}_for_{target}
+        AFTER INSERT OR DELETE ON {table}
+        FOR EACH ROW EXECUTE PROCEDURE count_{table}_for_{target}();
+    """)
+
+
+FOLLOWS_COUNTER_TRIGGER = counter_trigger(
+    'follows', {'user_following_id': 'following_count',
+                'user_being_followed_id': 'followers_count'})
+
+# (table, trigger DDL), each made along with its table
+COUNTER_TRIGGERS = [
+    (Message.__table__, counter_trigger(
+        'messages', {'user_id': 'messages_count'})),
+    (Follows.__table__, FOLLOWS_COUNTER_TRIGGER),
+    (Likes.__table__, counter_trigger(
+        'likes', {'user_id': 'likes_count'})),
+    (Likes.__table__, counter_trigger(
+        'likes', {'message_id': 'like_count'}, target='messages')),
+]
+
+for table, trigger in COUNTER_TRIGGERS:
+    event.listen(table, 'after_create', trigger)
+
+# Bumps likes_version for the liker and the message's author. Named to fire
+# before the counter triggers (they go in name order), it locks both users
+# in id order first, so two people liking each other's messages at once
+# don't deadlock. (The author is gone when the likes are deleted along with
+# their message.)
+LIKES_VERSION_TRIGGER = DDL("""
+    CREATE OR REPLACE FUNCTION bump_likes_version() RETURNS trigger AS $$
+    DECLARE
+        liker integer;
+        author integer;
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            liker := NEW.user_id;
+            SELECT user_id INTO author FROM messages WHERE id = NEW.message_id;
+        ELSE
+            liker := OLD.user_id;
+            SELECT user_id INTO author FROM messages WHERE id = OLD.message_id;
+        END IF;
+        PERFORM 1 FROM users WHERE id IN (liker, author)
+        ORDER BY id FOR UPDATE;
+        UPDATE users SET likes_version = likes_version + 1
+        WHERE id IN (liker, author);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS bump_likes_version ON likes;
+    CREATE TRIGGER bump_likes_version
+    AFTER INSERT OR DELETE ON likes
+    FOR EACH ROW EXECUTE PROCEDURE bump_likes_version();
+""")
+
+event.listen(Likes.__table__, 'after_create', LIKES_VERSION_TRIGGER)
+
+# Tells every process listening on 'users_deleted' which user was deleted,
+# once the deletion commits, so they stop trusting cached snapshots of them
+# (see load_current_user in app.py).
+USERS_DELETED_TRIGGER = DDL("""
+    CREATE OR REPLACE FUNCTION notify_users_deleted() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('users_deleted', OLD.id::text);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS notify_users_deleted ON users;
+    CREATE TRIGGER notify_users_deleted
+    AFTER DELETE ON users
+    FOR EACH ROW EXECUTE PROCEDURE notify_users_deleted();
+""")
+
+event.listen(User.__table__, 'after_create', USERS_DELETED_TRIGGER)
+
+
+# Connection pool settings, and their defaults (see connect_db)
+POOL_DEFAULTS = {
+    'DB_POOL_SIZE': 5,
+    'DB_MAX_OVERFLOW': 10,
+    'DB_POOL_TIMEOUT': 30,
+    'DB_POOL_RECYCLE': 1800,
+    'DB_POOL_PRE_PING': True,
+    'DB_PGBOUNCER': False,
+}
+
+
+def engine_options(config):
+    """Return the SQLAlchemy engine options for the pool settings in
+    `config`."""
+
+    if config['DB_PGBOUNCER']:
+        url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+        # psycopg2 binds parameters itself and never prepares statements
+        # on the server, where they'd be lost between transactions
+        if url.get_driver_name() != 'psycopg2':
+            raise ValueError(
+                f"DB_PGBOUNCER needs the psycopg2 driver, not "
+                f"{url.get_driver_name()}: it mustn't use server-side "
+                f"prepared statements")
+
+    return {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+
+
+def describe_pool(config):
+    """One line summing up the pool settings in `config`, for the log."""
+
+    options = config['SQLALCHEMY_ENGINE_OPTIONS']
+    recycle = options['pool_recycle']
+    return (f"{make_url(config['SQLALCHEMY_DATABASE_URI'])!r}: "
+            f"pool size {options['pool_size']}, "
+            f"overflow {options['max_overflow']}, "
+            f"timeout {options['pool_timeout']}s, "
+            f"recycle {f'{recycle}s' if recycle >= 0 else 'never'}, "
+            f"pre-ping {'on' if options['pool_pre_ping'] else 'off'}, "
+            f"pgbouncer {'on' if config['DB_PGBOUNCER'] else 'off'}")
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
 
-    You should call this in your Flask app.
+    You should call this in your Flask app. Each process keeps its own
+    connection pool, configured from the app with:
+
+    - DB_POOL_SIZE: connections kept open (default 5).
+    - DB_MAX_OVERFLOW: connections opened beyond those under load, and
+      closed again after (default 10).
+    - DB_POOL_TIMEOUT: seconds to wait for a connection when all are in use,
+      before failing the request (default 30).
+    - DB_POOL_RECYCLE: seconds after which a connection is replaced, to stay
+      ahead of idle timeouts in the server or network; -1 for never
+      (default 1800).
+    - DB_POOL_PRE_PING: check each connection as it's taken from the pool,
+      replacing it if it's gone dead (default True).
+    - DB_PGBOUNCER: connect through pgbouncer in transaction pooling mode
+      (default False). Each transaction may then get a different server
+      connection, so nothing may rely on session state: no server-side
+      prepared statements (psycopg2 makes none; other drivers are refused),
+      SET, advisory locks, LISTEN or temporary tables outliving a
+      transaction.
+
+    A deployment opens up to (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections
+    per worker process; keep that within the server's max_connections, or
+    put pgbouncer in between. Engine options in SQLALCHEMY_ENGINE_OPTIONS
+    override these.
     """
 
+    for key, default in POOL_DEFAULTS.items():
+        app.config.setdefault(key, default)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        **engine_options(app.config),
+        **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}),
+    }
+
     db.app = app
     db.init_app(app)
+    passwords.init_app(app)
+
+    app.logger.info("Database %s", describe_pool(app.config))
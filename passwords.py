@@ -0,0 +1,181 @@
+"""Password hashing for Warbler, run on a bounded worker pool."""
+
+import fcntl
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_bcrypt import Bcrypt
+
+
+class PasswordsBusy(Exception):
+    """Too many hashing jobs are already waiting; try again shortly."""
+
+
+class HostSemaphore:
+    """A semaphore shared by every process on this host.
+
+    Each of `count` slots is a file in `directory`, held with flock() while
+    in use. The kernel drops a lock when its holder exits, so a crashed
+    process can't leak a slot. Files are opened afresh for each acquire:
+    flock() locks belong to the open file, which forked processes share.
+    """
+
+    def __init__(self, directory, count):
+        self.directory = directory
+        self.count = count
+
+    def acquire(self, timeout):
+        """Take a free slot, waiting up to `timeout` seconds for one; return
+        it (for release()), or None if none came free."""
+
+        os.makedirs(self.directory, exist_ok=True)
+        deadline = time.monotonic() + timeout
+        while True:
+            for slot in range(self.count):
+                fd = os.open(os.path.join(self.directory, f"slot-{slot}"),
+                             os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except BlockingIOError:
+                    os.close(fd)
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0.01)
+
+    def release(self, fd):
+        """Give back a slot acquire() returned."""
+
+        os.close(fd)
+
+
+class Passwords:
+    """Hash and check passwords with bcrypt, bounded per process and per
+    host.
+
+    Every hash or check holds one of the host's BCRYPT_HOST_SLOTS while it
+    runs, shared by all the processes on the host through lock files. So
+    however many gunicorn workers there are, at most that many cores go to
+    bcrypt at once. A call that can't get a slot within BCRYPT_SLOT_WAIT
+    seconds raises PasswordsBusy, and the login gets a 503.
+
+    Within a process, jobs run on a thread pool. bcrypt releases the GIL
+    while it works, so with threaded workers (gunicorn's gthread) a pool
+    sized to the worker's threads runs their logins in parallel. Once
+    `max_pending` jobs are queued or running in the process, further calls
+    raise PasswordsBusy straight away. A sync worker only ever has one job
+    in flight, so there only the host slots apply.
+
+    Configured from the app with:
+
+    - BCRYPT_LOG_ROUNDS: cost for new hashes (default 12). Existing hashes
+      at another cost are rehashed on the next successful login.
+    - BCRYPT_WORKERS: pool size (default: number of CPUs).
+    - BCRYPT_MAX_PENDING: jobs allowed in flight (default: 8 per worker).
+    - BCRYPT_HOST_SLOTS: jobs allowed to run at once across the host
+      (default: number of CPUs).
+    - BCRYPT_SLOT_WAIT: seconds to wait for a host slot (default 1).
+    - BCRYPT_LOCK_DIR: where the host slots' lock files go; processes
+      sharing it share the slots (default: warbler-bcrypt in the temporary
+      directory).
+
+    Set `on_timing` to a function and it's called with ('hash' or 'check',
+    seconds) after each job.
+    """
+
+    def __init__(self, app=None):
+        self.rounds = 12
+        self.workers = os.cpu_count() or 1
+        self.max_pending = self.workers * 8
+        self.slot_wait = 1
+        self.host_slots = HostSemaphore(
+            os.path.join(tempfile.gettempdir(), 'warbler-bcrypt'),
+            os.cpu_count() or 1)
+        self._bcrypt = Bcrypt()
+        self._reset()
+        self.on_timing = None
+        os.register_at_fork(after_in_child=self._reset)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read pool and cost settings from `app.config`."""
+
+        self.rounds = app.config.setdefault('BCRYPT_LOG_ROUNDS', self.rounds)
+        self.workers = app.config.setdefault('BCRYPT_WORKERS', self.workers)
+        self.max_pending = app.config.setdefault('BCRYPT_MAX_PENDING',
+                                                 self.workers * 8)
+        self.slot_wait = app.config.setdefault('BCRYPT_SLOT_WAIT',
+                                               self.slot_wait)
+        self.host_slots = HostSemaphore(
+            app.config.setdefault('BCRYPT_LOCK_DIR',
+                                  self.host_slots.directory),
+            app.config.setdefault('BCRYPT_HOST_SLOTS', self.host_slots.count))
+        self._executor = None
+
+    def _reset(self):
+        """Forget the thread pool, which a forked child doesn't inherit the
+        threads of."""
+
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def hash(self, password):
+        """Return a bcrypt hash of `password` at the configured cost."""
+
+        hashed = self._run('hash', self._bcrypt.generate_password_hash,
+                           password, self.rounds)
+        return hashed.decode('UTF-8')
+
+    def check(self, hashed, password):
+        """Does `password` match the bcrypt hash `hashed`?"""
+
+        return self._run('check', self._bcrypt.check_password_hash,
+                         hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made at a cost other than the configured one?"""
+
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def _run(self, operation, fn, *args):
+        """Run `fn(*args)` on the pool and wait for its result."""
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='bcrypt')
+                self._slots = threading.BoundedSemaphore(self.max_pending)
+
+        if not self._slots.acquire(blocking=False):
+            raise PasswordsBusy()
+
+        try:
+            return self._executor.submit(self._timed, operation, fn,
+                                         *args).result()
+        finally:
+            self._slots.release()
+
+    def _timed(self, operation, fn, *args):
+        """Run `fn(*args)` in a host slot, reporting how long it took to
+        `on_timing`."""
+
+        slot = self.host_slots.acquire(self.slot_wait)
+        if slot is None:
+            raise PasswordsBusy()
+
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.host_slots.release(slot)
+            if self.on_timing is not None:
+                self.on_timing(operation, time.perf_counter() - started)
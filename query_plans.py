@@ -0,0 +1,114 @@
+"""Check that Warbler's hot queries are planned onto indexes.
+
+Each function registered with @hot_query builds a query that busy pages
+run, for a given user. `seq_scans()` EXPLAINs them all and reports any
+that would read a whole table. Postgres rightly scans tables that are
+tiny, so check against a database of realistic size: a seeded one with
+`flask check-query-plans`, or the fixture in test_query_plans.py.
+"""
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+
+# one page and the row after it, as the views fetch
+PAGE = 101
+
+# name -> function of a User, returning a Query
+HOT_QUERIES = {}
+
+
+def hot_query(build):
+    """Register `build` as a hot query, under its function name."""
+
+    HOT_QUERIES[build.__name__] = build
+    return build
+
+
+@hot_query
+def profile_messages(user):
+    return (Message.query
+            .filter(Message.user_id == user.id)
+            .order_by(Message.id.desc())
+            .limit(PAGE))
+
+
+@hot_query
+def newest_message(user):
+    return (db.session
+            .query(db.func.max(Message.id))
+            .filter(Message.user_id == user.id))
+
+
+@hot_query
+def home_timeline(user):
+    return (TimelineEntry.feed(user.id)
+            .order_by(TimelineEntry.message_id.desc())
+            .limit(PAGE))
+
+
+@hot_query
+def pull_timeline(user):
+    return (Message.by_followed(user.id, user.following_count)
+            .order_by(Message.id.desc())
+            .limit(PAGE))
+
+
+@hot_query
+def pull_timeline_cached(user):
+    return (Message.by_authors(user.following_user_ids() + [user.id])
+            .order_by(Message.id.desc())
+            .limit(PAGE))
+
+
+@hot_query
+def following(user):
+    return (db.session
+            .query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user.id))
+
+
+@hot_query
+def followers(user):
+    return (db.session
+            .query(Follows.user_following_id)
+            .filter(Follows.user_being_followed_id == user.id))
+
+
+@hot_query
+def liked_messages(user):
+    return (db.session
+            .query(Message.id, Message.like_count, User.profile_version)
+            .join(Likes, Likes.message_id == Message.id)
+            .join(User, User.id == Message.user_id)
+            .filter(Likes.user_id == user.id)
+            .order_by(Message.id.desc())
+            .limit(PAGE))
+
+
+def plan(query):
+    """Return the JSON plan Postgres makes for `query`."""
+
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    conn = db.session.connection()
+    return conn.scalar(f"EXPLAIN (FORMAT JSON) {compiled}",
+                       compiled.params)[0]['Plan']
+
+
+def scanned_tables(node):
+    """Yield the tables read by sequential scans anywhere in plan `node`."""
+
+    if node['Node Type'] == 'Seq Scan':
+        yield node['Relation Name']
+    for child in node.get('Plans', []):
+        yield from scanned_tables(child)
+
+
+def seq_scans(user):
+    """EXPLAIN every hot query for `user`; return {query name: tables
+    scanned} for those with sequential scans."""
+
+    found = {}
+    for name, build in HOT_QUERIES.items():
+        tables = sorted(set(scanned_tables(plan(build(user)))))
+        if tables:
+            found[name] = tables
+    return found
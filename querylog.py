@@ -0,0 +1,168 @@
+"""Per-request SQL query counting for Warbler."""
+
+import re
+import time
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request
+from markupsafe import escape
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PLACEHOLDER = re.compile(r'%\(\w+\)s|\?|\$\d+')
+PLACEHOLDER_LIST = re.compile(r'\?(?:\s*,\s*\?)+')
+WHITESPACE = re.compile(r'\s+')
+
+
+class QueryBudgetExceeded(Exception):
+    """A request ran more queries than its budget allows."""
+
+
+def statement_shape(statement):
+    """Reduce `statement` to its shape: the same SQL whatever its
+    parameters, and however many values are in an IN list."""
+
+    shape = PLACEHOLDER.sub('?', statement)
+    shape = PLACEHOLDER_LIST.sub('?, ...', shape)
+    return WHITESPACE.sub(' ', shape).strip()
+
+
+class RequestQueries:
+    """The queries one request has run so far."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = Counter()
+
+    def add(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, threshold):
+        """Return [(shape, times)] for shapes run `threshold` or more
+        times, most repeated first. Each is likely an N+1."""
+
+        return [(shape, times) for shape, times in self.shapes.most_common()
+                if times >= threshold]
+
+
+class QueryLog:
+    """Count the queries each request runs and spot N+1 patterns.
+
+    Every request's query count and database time are sent back in the
+    X-Query-Count and X-Query-Time headers. A statement run
+    QUERY_REPEAT_THRESHOLD or more times in one request (differing only in
+    its parameters) is logged as a likely N+1 and counted in
+    X-Query-Repeats.
+
+    Configured from the app with:
+
+    - QUERY_REPEAT_THRESHOLD: repeats that flag an N+1 (default 3).
+    - QUERY_BUDGET: most queries any request may run (default: no limit).
+    - QUERY_BUDGETS: {endpoint: most queries}, overriding QUERY_BUDGET.
+    - QUERY_BUDGET_STRICT: raise QueryBudgetExceeded for requests over
+      budget, rather than only logging them (default: app.testing).
+    - QUERY_OVERLAY: add a summary panel to HTML pages (default: app.debug).
+    """
+
+    def __init__(self, app=None):
+        self._listening = False
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read settings from `app.config` and hook into its requests."""
+
+        app.config.setdefault('QUERY_REPEAT_THRESHOLD', 3)
+        app.config.setdefault('QUERY_BUDGET', None)
+        app.config.setdefault('QUERY_BUDGETS', {})
+        app.config.setdefault('QUERY_BUDGET_STRICT', None)
+        app.config.setdefault('QUERY_OVERLAY', None)
+
+        app.before_request(self._start)
+        app.after_request(self._report)
+
+        if not self._listening:
+            event.listen(Engine, 'before_cursor_execute', self._before_execute)
+            event.listen(Engine, 'after_cursor_execute', self._after_execute)
+            self._listening = True
+
+    @staticmethod
+    def current():
+        """The RequestQueries for this request, or None outside one."""
+
+        if not has_request_context():
+            return None
+        return g.get('queries')
+
+    def _start(self):
+        g.queries = RequestQueries()
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+
+        queries = self.current()
+        if queries is not None:
+            queries.add(statement, elapsed)
+
+    def _report(self, response):
+        queries = self.current()
+        if queries is None:
+            return response
+
+        config = current_app.config
+        repeated = queries.repeated(config['QUERY_REPEAT_THRESHOLD'])
+
+        response.headers['X-Query-Count'] = str(queries.count)
+        response.headers['X-Query-Time'] = f"{queries.seconds * 1000:.1f}ms"
+        response.headers['X-Query-Repeats'] = str(len(repeated))
+
+        logger = current_app.logger
+        for shape, times in repeated:
+            logger.warning("Likely N+1 in %s: ran %d times: %s",
+                           request.endpoint, times, shape)
+
+        budget = config['QUERY_BUDGETS'].get(request.endpoint,
+                                             config['QUERY_BUDGET'])
+        if budget is not None and queries.count > budget:
+            message = (f"{request.endpoint} ran {queries.count} queries, "
+                       f"over its budget of {budget}")
+            strict = config['QUERY_BUDGET_STRICT']
+            if strict or (strict is None and current_app.testing):
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+
+        overlay = config['QUERY_OVERLAY']
+        if overlay is None:
+            overlay = current_app.debug
+        if (overlay and response.mimetype == 'text/html'
+                and not response.direct_passthrough):
+            _add_overlay(response, queries, repeated)
+
+        return response
+
+
+def _add_overlay(response, queries, repeated):
+    """Add a panel summarizing `queries` to the bottom of an HTML page."""
+
+    rows = ''.join(f"<li>&times;{times} <code>{escape(shape)}</code></li>"
+                   for shape, times in repeated)
+    panel = (
+        '<div id="query-log" style="position:fixed;bottom:0;right:0;'
+        'z-index:9999;max-width:50%;max-height:40%;overflow:auto;'
+        'padding:.5em;background:#fff;border:1px solid #ccc;font-size:12px">'
+        f"<b>{queries.count} queries, {queries.seconds * 1000:.1f}ms</b>"
+        f"<ul>{rows}</ul></div>")
+
+    body = response.get_data(as_text=True)
+    if '</body>' in body:
+        body = body.replace('</body>', panel + '</body>', 1)
+        response.set_data(body)
@@ -0,0 +1,84 @@
+"""Read replica routing for Warbler."""
+
+import random
+import time
+
+from flask import current_app, request, session
+from sqlalchemy import create_engine
+
+# When the session's user last wrote, plus REPLICA_PIN_SECONDS
+PRIMARY_UNTIL_KEY = 'primary_until'
+
+# Methods that don't change anything
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def read_only(view):
+    """Mark `view` as only reading, so its GETs may be served from a
+    replica. Goes under @app.route."""
+
+    view.read_only = True
+    return view
+
+
+class Replicas:
+    """Send the reads of @read_only views to replica databases.
+
+    Each GET or HEAD of a view marked @read_only picks one of the replicas
+    at random and runs its queries there (see RoutingSession); everything
+    else uses the primary. Replicas lag the primary a little, so a session
+    that makes a request with any other method (a write) is pinned to the
+    primary for REPLICA_PIN_SECONDS afterwards, and reads its own writes.
+
+    Caches filled from a replica are only as fresh as it is, which is fine
+    while its lag stays under the pin.
+
+    Configured from the app with:
+
+    - REPLICA_DATABASE_URIS: the replicas' database URIs (default: none,
+      which sends everything to the primary). Their pools take the same
+      settings as the primary's (see connect_db).
+    - REPLICA_PIN_SECONDS: how long a session reads from the primary after
+      a write (default 5).
+    """
+
+    def __init__(self, db, app=None):
+        self.db = db
+        self.engines = []
+        self.pin_seconds = 5
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read settings from `app.config`, create the replica engines
+        and hook into its requests."""
+
+        uris = app.config.setdefault('REPLICA_DATABASE_URIS', [])
+        self.pin_seconds = app.config.setdefault('REPLICA_PIN_SECONDS',
+                                                 self.pin_seconds)
+        options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+        self.engines = [create_engine(uri, **options) for uri in uris]
+
+        app.before_request(self._route)
+        app.after_request(self._pin)
+        app.teardown_request(self._unroute)
+
+    def pinned(self):
+        """Must this request's session read from the primary?"""
+
+        return session.get(PRIMARY_UNTIL_KEY, 0) > time.time()
+
+    def _route(self):
+        view = current_app.view_functions.get(request.endpoint)
+        if (self.engines and request.method in SAFE_METHODS
+                and getattr(view, 'read_only', False) and not self.pinned()):
+            self.db.session.info['replica'] = random.choice(self.engines)
+
+    def _pin(self, response):
+        if self.engines and request.method not in SAFE_METHODS:
+            session[PRIMARY_UNTIL_KEY] = time.time() + self.pin_seconds
+        return response
+
+    def _unroute(self, exc):
+        self.db.session.info.pop('replica', None)
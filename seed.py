@@ -1,20 +1,15 @@
 """Seed database with sample data from CSV Files."""
 
-from csv import DictReader
 from app import db
-from models import User, Message, Follows
+from bulk_load import load_csvs
 
 
 db.drop_all()
 db.create_all()
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
-
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
-
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
-
-db.session.commit()
+load_csvs({
+    'users': 'generator/users.csv',
+    'messages': 'generator/messages.csv',
+    'follows': 'generator/follows.csv',
+    'likes': 'generator/likes.csv',
+})
@@ -0,0 +1,124 @@
+"""Time-sortable message ids ("snowflakes") for Warbler.
+
+An id packs the milliseconds since EPOCH, the id of the worker process
+that made it and a per-millisecond sequence number into 53 bits:
+
+    | 41 bits: milliseconds | 8 bits: worker | 4 bits: sequence |
+
+so ids sort by creation time, and processes with different worker ids
+never make the same one. 53 bits is all a JavaScript number holds exactly,
+so ids survive the JSON API intact; 41 bits of milliseconds last until 2079.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+EPOCH = datetime(2010, 1, 1)
+
+WORKER_BITS = 8
+SEQUENCE_BITS = 4
+# the bits below the milliseconds
+LOW_BITS = WORKER_BITS + SEQUENCE_BITS
+
+WORKERS = 1 << WORKER_BITS
+
+MILLISECOND = timedelta(milliseconds=1)
+
+
+def to_millis(dt):
+    """Milliseconds from EPOCH to naive UTC datetime `dt`."""
+
+    return (dt - EPOCH) // MILLISECOND
+
+
+def make_id(millis, low):
+    """The id for `millis` with `low` (worker and sequence) in its low
+    bits."""
+
+    return millis << LOW_BITS | low
+
+
+def id_time(snowflake):
+    """The (UTC, millisecond) time id `snowflake` was made."""
+
+    return EPOCH + (snowflake >> LOW_BITS) * MILLISECOND
+
+
+class Snowflake:
+    """Make ids for one process.
+
+    `worker_id` must be set to a number below WORKERS, not used by any
+    other live process, before the first id; `lease()` sets it along with
+    when the process stops owning it, after which no more ids are made
+    until it's leased again. Forked children (gunicorn workers of a
+    preloaded app) forget it and must lease their own.
+    """
+
+    def __init__(self):
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self.worker_id = None
+        # time.monotonic() when the lease runs out; None for never
+        self.lease_until = None
+        self.lease_seconds = None
+        self._millis = -1
+        self._sequence = 0
+
+    def lease(self, worker_id, seconds, started=None):
+        """Use `worker_id` for `seconds` from `started` (time.monotonic(),
+        by default now); start it before asking for the lease, so it runs
+        out here no later than wherever it was granted."""
+
+        if started is None:
+            started = time.monotonic()
+
+        with self._lock:
+            if worker_id != self.worker_id and self._millis >= 0:
+                # ids from another worker id in the same millisecond could
+                # sort before the last one
+                self._millis += 1
+                self._sequence = -1
+            self.worker_id = worker_id
+            self.lease_seconds = seconds
+            self.lease_until = started + seconds
+
+    def needs_lease(self):
+        """Is there no worker id, or has its lease less than half to go?"""
+
+        if self.worker_id is None:
+            return True
+        if self.lease_until is None:
+            return False
+        return self.lease_until - time.monotonic() < self.lease_seconds / 2
+
+    def next_id(self):
+        """Return a new id, greater than any this process made before."""
+
+        if self.worker_id is None:
+            raise RuntimeError("Snowflake has no worker id")
+        if (self.lease_until is not None
+                and time.monotonic() >= self.lease_until):
+            raise RuntimeError(
+                f"Snowflake's lease on worker id {self.worker_id} ran out")
+
+        now = to_millis(datetime.utcnow())
+        with self._lock:
+            # never step back, even if the clock does
+            millis = max(now, self._millis)
+            if millis == self._millis:
+                self._sequence += 1
+                if self._sequence >> SEQUENCE_BITS:
+                    # this millisecond is used up: borrow the next one
+                    millis += 1
+                    self._sequence = 0
+            else:
+                self._sequence = 0
+            self._millis = millis
+
+            return make_id(millis,
+                           self.worker_id << SEQUENCE_BITS | self._sequence)
@@ -8,15 +8,101 @@ async function handleLikes(evt){
     evt.preventDefault();
     if(evt.target.tagName == 'BUTTON'){
         let msgId = $(this).attr('id');
-        await $.post(`/messages/${msgId}/like`);
+        let liked = evt.target.classList.contains('btn-primary');
 
-        evt.target.classList.toggle('btn-primary');
-        evt.target.classList.toggle('btn-secondary');
+        // PUT likes and DELETE unlikes, so a double click can't undo itself
+        let state = await $.ajax({
+            url: `/api/messages/${msgId}/like`,
+            method: liked ? 'DELETE' : 'PUT',
+            dataType: 'json'
+        });
+
+        $(evt.target)
+            .toggleClass('btn-primary', state.liked)
+            .toggleClass('btn-secondary', !state.liked)
+            .find('.like-count').text(state.like_count);
         updateNumLikes();
     }
     return;
 }
-$('#messages-form button').on('click', handleLikes)
+$('#messages').on('click', '#messages-form button', handleLikes)
+
+function formatDate(timestamp){
+    // timestamps are UTC, shown like the server does: 05 March 2024
+    return new Date(timestamp + 'Z').toLocaleDateString('en-GB', {
+        day: '2-digit', month: 'long', year: 'numeric', timeZone: 'UTC'
+    });
+}
+
+function renderMessage(message, user, viewerId){
+    // the same markup as templates/messages/message.html
+    let $item = $('<li class="list-group-item">');
+    let profile = `/users/${message.user_id}`;
+
+    $item.append(
+        $('<a class="message-link">').attr('href', `/messages/${message.id}`),
+        $('<a>').attr('href', profile).append(
+            $('<img alt="" class="timeline-image">').attr('src', user.image_url)),
+        $('<div class="message-area">').append(
+            $('<a>').attr('href', profile).text(`@${user.username}`),
+            $('<span class="text-muted">').text(formatDate(message.timestamp)),
+            $('<p>').text(message.text)),
+        $('<form method="POST" id="messages-form">')
+            .attr('action', `/messages/${message.id}/like`)
+            .append(
+                $('<button class="btn btn-sm">')
+                    .attr('id', message.id)
+                    .addClass(message.liked ? 'btn-primary' : 'btn-secondary')
+                    .prop('disabled', message.user_id === viewerId)
+                    .append(
+                        '<i class="fa fa-thumbs-up" style="pointer-events: none;"></i> ',
+                        $('<span class="like-count" style="pointer-events: none;">')
+                            .text(message.like_count))));
+    return $item;
+}
+
+function renderMessages(page){
+    let viewerId = $('#messages').data('viewer');
+    return page.messages.map(
+        message => renderMessage(message, page.users[message.user_id], viewerId));
+}
+
+async function loadMore(evt){
+    if(evt){
+        evt.preventDefault();
+    }
+    let $link = $('#load-more');
+    if($link.data('loading')){
+        return;
+    }
+    $link.data('loading', true);
+
+    let page = await $.getJSON($link.data('api'));
+    $('#messages').append(renderMessages(page));
+
+    if(page.next_cursor){
+        for(let attr of ['href', 'data-api']){
+            let url = new URL($link.attr(attr), location.href);
+            url.searchParams.set('before', page.next_cursor);
+            $link.attr(attr, url.pathname + url.search);
+        }
+        $link.data('api', $link.attr('data-api'));
+        $link.data('loading', false);
+    } else {
+        $link.remove();
+    }
+    return;
+}
+
+// pages with an API counterpart load more as they're scrolled to the end
+if($('#load-more').data('api')){
+    $('#load-more').on('click', loadMore);
+    new IntersectionObserver(function(entries){
+        if(entries.some(entry => entry.isIntersecting)){
+            loadMore();
+        }
+    }).observe($('#load-more')[0]);
+}
 
 async function showNewMessage(evt){
     evt.preventDefault();
@@ -32,11 +118,36 @@ $('#new-msg-link').on('click', showNewMessage);
 async function postNewMessage(e){
     if(e.target.id === "submit-new-post"){
         e.preventDefault();
-        
-        $.post('/messages/new', $( "#new-msg-form" ).serialize() );
+
+        let page;
+        try {
+            page = await $.ajax({
+                url: '/messages/new',
+                method: 'POST',
+                data: $( "#new-msg-form" ).serialize(),
+                dataType: 'json'
+            });
+        } catch(err) {
+            // show the form again, with its errors
+            let errors = (err.responseJSON && err.responseJSON.errors) || {};
+            $('#new-msg-form .text-danger').remove();
+            for(let error of errors.text || ['Something went wrong.']){
+                $('#new-msg-txt').before(
+                    $('<span class="text-danger">').text(error));
+            }
+            return;
+        }
 
         $('#close-new-msg-form').trigger("click");
-        location.reload(true);
+        $('#new-msg-txt').val('');
+
+        // add it to the top of the list if it belongs there, rather than
+        // reloading the page
+        if($('#messages').is('[data-prepend-posts]')){
+            $('#messages').prepend(renderMessages(page));
+        } else {
+            location.href = `/users/${page.messages[0].user_id}`;
+        }
 
         return;
     }
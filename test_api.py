@@ -0,0 +1,213 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, PAGE_SIZE
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ApiTestCase(TestCase):
+    """Test the JSON timeline and message endpoints."""
+
+    def setUp(self):
+        """Create a reader following an author with a page and a bit of
+        messages."""
+
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        reader = User.signup("reader", "reader@test.com", "password", None)
+        author = User.signup("author", "author@test.com", "password", None)
+        db.session.flush()
+        reader.following.append(author)
+
+        start = datetime(2020, 1, 1)
+        for i in range(PAGE_SIZE + 5):
+            author.messages.append(
+                Message(text=f"Post {i}", timestamp=start + timedelta(i)))
+        db.session.commit()
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        self.reader_id = reader.id
+        self.author_id = author.id
+        self.newest_id = author.messages[-1].id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+
+    def test_login_required(self):
+        resp = self.client.get('/api/timeline')
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.get_json(), {'error': "Login required."})
+
+    def test_timeline_pages(self):
+        self.login()
+        db.session.add(Likes(user_id=self.reader_id, message_id=self.newest_id))
+        db.session.commit()
+
+        page = self.client.get('/api/timeline').get_json()
+        self.assertEqual(len(page['messages']), PAGE_SIZE)
+        self.assertEqual(page['messages'][0],
+                         {'id': self.newest_id,
+                          'text': f"Post {PAGE_SIZE + 4}",
+                          'timestamp': '2020-04-14T00:00:00',
+                          'user_id': self.author_id,
+                          'like_count': 1,
+                          'liked': True})
+        self.assertFalse(page['messages'][1]['liked'])
+        # each author once, however many messages they have on the page
+        self.assertEqual(page['users'],
+                         {str(self.author_id): {
+                             'username': 'author',
+                             'image_url': '/static/images/default-pic.png'}})
+
+        rest = self.client.get('/api/timeline',
+                               query_string={'before': page['next_cursor']})
+        rest = rest.get_json()
+        self.assertEqual([m['text'] for m in rest['messages']],
+                         [f"Post {i}" for i in range(4, -1, -1)])
+        self.assertIsNone(rest['next_cursor'])
+
+    def test_pull_timeline(self):
+        """Does the pull engine page through the same timeline as push,
+        with cached ids and with either plan for looking them up?"""
+
+        self.login()
+        cache_max = app.config['FOLLOWEE_CACHE_MAX']
+        pages = {}
+        for engine, cache, few in (('push', cache_max, 500),
+                                   ('pull', cache_max, 500),
+                                   ('pull', 0, 500),
+                                   ('pull', 0, 0)):
+            app.config['TIMELINE_ENGINE'] = engine
+            app.config['FOLLOWEE_CACHE_MAX'] = cache
+            Message.FEW_AUTHORS = few
+            try:
+                first = self.client.get('/api/timeline').get_json()
+                rest = self.client.get('/api/timeline', query_string={
+                    'before': first['next_cursor']}).get_json()
+            finally:
+                app.config['TIMELINE_ENGINE'] = 'push'
+                app.config['FOLLOWEE_CACHE_MAX'] = cache_max
+                Message.FEW_AUTHORS = 500
+            pages[engine, cache, few] = first['messages'] + rest['messages']
+
+        push = pages.pop(('push', cache_max, 500))
+        self.assertEqual(len(push), PAGE_SIZE + 5)
+        for page in pages.values():
+            self.assertEqual(page, push)
+
+    def test_pull_timeline_sees_follows(self):
+        self.login()
+        app.config['TIMELINE_ENGINE'] = 'pull'
+        try:
+            self.client.get('/api/timeline')
+
+            other = User.signup("other", "other@test.com", "password", None)
+            other.messages.append(Message(text="Newest"))
+            db.session.commit()
+            self.client.post(f"/users/follow/{other.id}")
+
+            page = self.client.get('/api/timeline').get_json()
+        finally:
+            app.config['TIMELINE_ENGINE'] = 'push'
+        self.assertEqual(page['messages'][0]['text'], "Newest")
+
+    def test_user_messages(self):
+        self.login()
+        page = self.client.get(f"/api/users/{self.author_id}/messages")
+        self.assertEqual(len(page.get_json()['messages']), PAGE_SIZE)
+
+        resp = self.client.get(f"/api/users/{self.reader_id}/messages")
+        self.assertEqual(resp.get_json()['messages'], [])
+
+        resp = self.client.get('/api/users/0/messages')
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.get_json(), {'error': "Not found."})
+
+    def test_message(self):
+        resp = self.client.get(f"/api/messages/{self.newest_id}")
+        message, = resp.get_json()['messages']
+        self.assertEqual(message['id'], self.newest_id)
+        self.assertFalse(message['liked'])
+
+    def test_load_more_links_api(self):
+        self.login()
+        resp = self.client.get('/')
+        self.assertIn('data-api="/api/timeline?before=', resp.get_data(
+            as_text=True))
+
+    def test_add_message_json(self):
+        self.login()
+        resp = self.client.post('/messages/new', data={'text': "Hello"},
+                                headers={'Accept': 'application/json'})
+        self.assertEqual(resp.status_code, 201)
+        message, = resp.get_json()['messages']
+        self.assertEqual(message['text'], "Hello")
+        self.assertEqual(message['user_id'], self.reader_id)
+
+        resp = self.client.post('/messages/new', data={'text': ""},
+                                headers={'Accept': 'application/json'})
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('text', resp.get_json()['errors'])
+
+    def test_like_idempotent(self):
+        self.login()
+        url = f"/api/messages/{self.newest_id}/like"
+
+        for _ in range(2):
+            resp = self.client.put(url)
+            self.assertEqual(resp.get_json(), {'id': self.newest_id,
+                                               'liked': True,
+                                               'like_count': 1})
+        self.assertEqual(Likes.query.count(), 1)
+
+        for _ in range(2):
+            resp = self.client.delete(url)
+            self.assertEqual(resp.get_json(), {'id': self.newest_id,
+                                               'liked': False,
+                                               'like_count': 0})
+        self.assertEqual(Likes.query.count(), 0)
+
+    def test_like_runs_no_timeline(self):
+        self.login()
+        resp = self.client.put(f"/api/messages/{self.newest_id}/like")
+        self.assertEqual(resp.status_code, 200)
+        # the insert and the tally, with the user lookup and no more
+        self.assertLessEqual(int(resp.headers['X-Query-Count']), 3)
+
+    def test_like_missing_message(self):
+        self.login()
+        resp = self.client.put('/api/messages/0/like')
+        self.assertEqual(resp.status_code, 404)
+
+        resp = self.client.put(f"/api/messages/{self.newest_id}/like")
+        self.assertEqual(resp.status_code, 200)
+
+    def test_like_login_required(self):
+        resp = self.client.put(f"/api/messages/{self.newest_id}/like")
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(Likes.query.count(), 0)
@@ -0,0 +1,172 @@
+"""Asset pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import re
+import shutil
+import tempfile
+from unittest import TestCase
+
+import brotli
+from flask import Flask
+
+from assets import Assets, VENDOR, build, rewrite_css_urls
+from http_cache import HttpCache, file_hash
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'templates')
+
+# Bootstrap 4 markup that Bootstrap 5 dropped or renamed
+BOOTSTRAP_4 = re.compile(
+    r'\b(btn-block|[mp][lr]-(auto|\d)|data-(toggle|target|dismiss)=)')
+
+
+class AssetsTestCase(TestCase):
+    """Test building and serving bundles."""
+
+    def setUp(self):
+        """Make a static folder with a stylesheet, a script and an image."""
+
+        self.static = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.static, 'css'))
+        os.makedirs(os.path.join(self.static, 'images'))
+
+        self.write('css/site.css',
+                   '/* header */\nbody {\n  background: url("../images/bg.png");\n}\n')
+        self.write('one.js', 'var one = 1\n')
+        self.write('two.js', '// two\nvar two = 2;\n')
+        self.write('images/bg.png', 'png')
+
+        self.bundles = {'site.css': ['css/site.css'],
+                        'site.js': ['one.js', 'two.js']}
+
+        # an explicit root_path, as Flask 1.0 can't find this module's
+        # under pytest's assertion rewriting
+        self.app = Flask(__name__, static_folder=self.static,
+                         static_url_path='/static',
+                         root_path=os.path.dirname(os.path.abspath(__file__)))
+        self.assets = Assets(self.app, HttpCache(self.app))
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.static)
+
+    def write(self, path, text):
+        with open(os.path.join(self.static, path), 'w') as f:
+            f.write(text)
+
+    def read(self, path, mode='r'):
+        with open(os.path.join(self.static, path), mode) as f:
+            return f.read()
+
+    def test_rewrite_css_urls(self):
+        bg = file_hash(os.path.join(self.static, 'images/bg.png'))
+
+        self.assertEqual(
+            rewrite_css_urls("a{background:url(../images/bg.png)}",
+                             'css/site.css', self.static),
+            f'a{{background:url("/static/images/bg.png?v={bg}")}}')
+        self.assertEqual(
+            rewrite_css_urls("a{background:url('/static/images/bg.png#x')}",
+                             'css/site.css', self.static),
+            f'a{{background:url("/static/images/bg.png?v={bg}#x")}}')
+
+        # left alone
+        for css in ("a{background:url(data:image/png;base64,AAAA)}",
+                    "a{background:url(https://example.com/bg.png)}"):
+            self.assertEqual(rewrite_css_urls(css, 'css/site.css',
+                                              self.static), css)
+
+    def test_build(self):
+        manifest = build(self.static, self.bundles)
+
+        self.assertEqual(set(manifest), {'site.css', 'site.js'})
+        self.assertRegex(manifest['site.js'], r'^site\.[0-9a-f]{12}\.js$')
+
+        css = self.read(f"dist/{manifest['site.css']}")
+        self.assertNotIn('header', css)
+        self.assertIn('/static/images/bg.png?v=', css)
+
+        js = self.read(f"dist/{manifest['site.js']}")
+        self.assertEqual(js, 'var one=1;\nvar two=2;')
+
+        data = self.read(f"dist/{manifest['site.js']}", 'rb')
+        self.assertEqual(gzip.decompress(
+            self.read(f"dist/{manifest['site.js']}.gz", 'rb')), data)
+        self.assertEqual(brotli.decompress(
+            self.read(f"dist/{manifest['site.js']}.br", 'rb')), data)
+
+    def test_rebuild_removes_old_bundles(self):
+        old = build(self.static, self.bundles)['site.js']
+        self.write('two.js', 'var two = 22;\n')
+        new = build(self.static, self.bundles)['site.js']
+
+        self.assertNotEqual(old, new)
+        built = os.listdir(os.path.join(self.static, 'dist'))
+        self.assertIn(new, built)
+        self.assertNotIn(old, built)
+        self.assertNotIn(old + '.gz', built)
+
+    def test_serve_precompressed(self):
+        filename = build(self.static, self.bundles)['site.js']
+        url = f"/static/dist/{filename}"
+
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertEqual(resp.mimetype, 'application/javascript')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        resp.close()
+
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        resp.close()
+
+        resp = self.client.get(url)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.get_data(as_text=True),
+                         'var one=1;\nvar two=2;')
+        resp.close()
+
+    def test_asset_urls(self):
+        with self.app.test_request_context():
+            # unbuilt, and nothing vendored: CDN copies of the vendored
+            # sources, then each of ours
+            self.assertEqual(self.assets.cdn_urls('app.js'), [
+                VENDOR['jquery/jquery.min.js'],
+                VENDOR['bootstrap/bootstrap.bundle.min.js']])
+            self.assertEqual(len(self.assets.asset_urls('app.js')), 1)
+
+            self.write('app.js', '')
+            self.assertIn('/static/app.js?v=', self.assets.asset_urls(
+                'app.js')[-1])
+
+            # a fetched vendor file is served from here
+            os.makedirs(os.path.join(self.static, 'vendor', 'jquery'))
+            self.write('vendor/jquery/jquery.min.js', '')
+            self.assertEqual(self.assets.cdn_urls('app.js'),
+                             [VENDOR['bootstrap/bootstrap.bundle.min.js']])
+            self.assertIn('/static/vendor/jquery/jquery.min.js?v=',
+                          self.assets.asset_urls('app.js')[0])
+
+            build(self.static, {'app.js': ['one.js']})
+            urls = self.assets.asset_urls('app.js')
+            self.assertEqual(len(urls), 1)
+            self.assertRegex(urls[0], r'^/static/dist/app\.[0-9a-f]{12}\.js$')
+            self.assertEqual(self.assets.cdn_urls('app.js'), [])
+
+    def test_templates_match_vendored_bootstrap(self):
+        for path in VENDOR.values():
+            if 'bootstrap' in path:
+                self.assertIn('bootstrap@5.', path)
+
+        for root, dirs, files in os.walk(TEMPLATES):
+            for name in files:
+                with open(os.path.join(root, name)) as f:
+                    self.assertIsNone(BOOTSTRAP_4.search(f.read()),
+                                      os.path.join(root, name))
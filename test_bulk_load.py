@@ -0,0 +1,196 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bulk_load.py
+
+
+import os
+import shutil
+import tempfile
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest import TestCase, mock
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+from snowflake import id_time
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from bulk_load import load_csvs
+
+db.create_all()
+
+
+USERS = """email,username,image_url,password,bio,header_image_url,location
+a@test.com,alice,/a.png,HASHED,"Likes tea,
+and commas",/h.png,Here
+b@test.com,bob,/b.png,HASHED,,/h.png,There
+"""
+
+
+class BulkLoadTestCase(TestCase):
+    """Test loading CSVs with COPY."""
+
+    def setUp(self):
+        """Empty the tables and write small CSVs to a temp directory."""
+
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+        db.session.remove()
+
+        self.dir = tempfile.mkdtemp()
+        self.paths = {}
+
+        self.write('users', USERS)
+        self.write('follows', "user_being_followed_id,user_following_id\n"
+                              "{a},{b}\n")
+        self.write('messages', "text,timestamp,user_id\n"
+                               "hello,2017-01-21 11:04:53,{a}\n"
+                               "again,2017-01-22 11:04:53,{a}\n"
+                               "hi,2017-01-23 11:04:53,{b}\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        db.session.rollback()
+
+    def write(self, table, text):
+        """Write `text` as the CSV for `table`, filling in the ids the
+        users will load with from their sequence."""
+
+        first = db.session.execute(
+            "SELECT last_value + CASE WHEN is_called THEN 1 ELSE 0 END "
+            "FROM users_id_seq").scalar()
+        db.session.remove()
+
+        path = os.path.join(self.dir, f"{table}.csv")
+        with open(path, 'w') as f:
+            f.write(text.format(a=first, b=first + 1))
+        self.paths[table] = path
+
+    def load(self, **kwargs):
+        """load_csvs(), quietly, keeping its restore file in the temp
+        directory."""
+
+        with redirect_stdout(StringIO()):
+            return load_csvs(self.paths,
+                             restore_file=self.restore_file, **kwargs)
+
+    @property
+    def restore_file(self):
+        return os.path.join(self.dir, 'restore.sql')
+
+    def schema(self):
+        """The indexes, constraints and enabled triggers of the tables."""
+
+        return [{name for (name,) in db.session.execute(sql)} for sql in (
+            "SELECT indexname FROM pg_indexes "
+            "WHERE schemaname = current_schema()",
+            "SELECT conname FROM pg_constraint",
+            "SELECT tgname FROM pg_trigger "
+            "WHERE NOT tgisinternal AND tgenabled <> 'D'",
+        )]
+
+    def test_load_csvs(self):
+        """Are rows, counters, timelines, indexes and sequences right?"""
+
+        with redirect_stdout(StringIO()) as out:
+            counts = load_csvs(self.paths)
+
+        self.assertEqual(counts, {'users': 2, 'messages': 3, 'follows': 1})
+        self.assertIn("rows/sec", out.getvalue())
+
+        alice = User.query.filter_by(username='alice').one()
+        bob = User.query.filter_by(username='bob').one()
+        self.assertEqual(alice.bio, "Likes tea,\nand commas")
+        self.assertEqual(alice.messages_count, 2)
+        self.assertEqual(alice.followers_count, 1)
+        self.assertEqual(bob.following_count, 1)
+
+        # bob follows alice, so his timeline holds all three messages
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=bob.id).count(),
+                         3)
+
+        indexes = {name for (name,) in db.session.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'users'")}
+        self.assertIn('ix_users_username_trgm', indexes)
+        self.assertIn('users_username_key', indexes)
+
+        # sequences continue after the loaded ids
+        carol = User(email="c@test.com", username="carol",
+                     image_url="/c.png", password="HASHED")
+        db.session.add(carol)
+        db.session.commit()
+        self.assertEqual(carol.id, bob.id + 1)
+
+    def test_indexes_back_before_rebuild(self):
+        """Are the loaded tables' indexes rebuilt before timelines are?"""
+
+        indexes = []
+        rebuild = TimelineEntry.rebuild
+
+        def spy():
+            indexes.extend(name for (name,) in db.session.execute(
+                "SELECT indexname FROM pg_indexes "
+                "WHERE schemaname = current_schema()"))
+            return rebuild()
+
+        with mock.patch.object(TimelineEntry, 'rebuild', spy):
+            self.load()
+
+        self.assertIn('ix_follows_user_following_id', indexes)
+        self.assertIn('ix_messages_user_id_id', indexes)
+
+    def test_messages_rekeyed(self):
+        """Do loaded messages get snowflake ids, with likes following?"""
+
+        # likes refer to messages by line number
+        self.write('likes', "user_id,message_id\n{b},1\n")
+        self.load()
+
+        hello = Message.query.filter_by(text='hello').one()
+        self.assertGreater(hello.id, Message.LEGACY_ID_MAX)
+        self.assertEqual(id_time(hello.id), hello.timestamp)
+        self.assertEqual([m.text for m in Message.query.order_by(Message.id)],
+                         ['hello', 'again', 'hi'])
+
+        like = Likes.query.one()
+        self.assertEqual(like.message_id, hello.id)
+        self.assertEqual(hello.like_count, 1)
+
+    def test_likes_need_empty_messages(self):
+        self.write('likes', "user_id,message_id\n{b},1\n")
+        self.load()
+        before = self.schema()
+
+        Likes.query.delete()
+        User.query.filter_by(username='alice').delete()
+        db.session.commit()
+        self.assertRaises(ValueError, self.load)
+        del self.paths['messages']
+        self.assertRaises(ValueError, self.load)
+
+        self.assertEqual(self.schema(), before)
+        self.assertFalse(os.path.exists(self.restore_file))
+
+    def test_failed_load_restores(self):
+        """Does a failed COPY leave the indexes, constraints and triggers
+        as they were?"""
+
+        before = self.schema()
+        self.write('follows', "user_being_followed_id,user_following_id\n"
+                              "{a},not a number\n")
+
+        with self.assertRaises(Exception):
+            self.load()
+
+        self.assertEqual(self.schema(), before)
+        self.assertFalse(os.path.exists(self.restore_file))
+
+        # a restore file left over blocks the next load
+        open(self.restore_file, 'w').close()
+        self.assertRaises(RuntimeError, self.load)
@@ -0,0 +1,44 @@
+"""LocalCache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+import time
+from unittest import TestCase
+
+from cache import LocalCache
+
+
+class LocalCacheTestCase(TestCase):
+    """Test the in-process LRU/TTL cache."""
+
+    def test_get_set_delete(self):
+        cache = LocalCache()
+        cache.set('a', 1)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('b', 'missing'), 'missing')
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+
+    def test_entries_expire(self):
+        cache = LocalCache(ttl=0.01)
+        cache.set('a', 1)
+        time.sleep(0.02)
+
+        self.assertIsNone(cache.get('a'))
+
+    def test_least_recently_used_evicted(self):
+        cache = LocalCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
@@ -0,0 +1,57 @@
+"""Connection pool configuration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_db_pool.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, POOL_DEFAULTS, engine_options, describe_pool
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+
+
+class DbPoolTestCase(TestCase):
+    """Test connection pool settings."""
+
+    def config(self, **settings):
+        return {'SQLALCHEMY_DATABASE_URI': "postgresql:///warbler-test",
+                **POOL_DEFAULTS, **settings}
+
+    def test_engine_options(self):
+        options = engine_options(self.config(DB_POOL_SIZE=2,
+                                             DB_POOL_PRE_PING=False))
+
+        self.assertEqual(options['pool_size'], 2)
+        self.assertEqual(options['max_overflow'], 10)
+        self.assertFalse(options['pool_pre_ping'])
+
+    def test_pgbouncer_driver(self):
+        engine_options(self.config(DB_PGBOUNCER=True))
+
+        with self.assertRaises(ValueError):
+            engine_options(self.config(
+                DB_PGBOUNCER=True,
+                SQLALCHEMY_DATABASE_URI="postgresql+pg8000:///warbler-test"))
+
+    def test_app_engine_pool(self):
+        pool = db.engine.pool
+
+        self.assertEqual(pool.size(), app.config['DB_POOL_SIZE'])
+        self.assertEqual(pool._recycle, app.config['DB_POOL_RECYCLE'])
+        self.assertEqual(pool._pre_ping, app.config['DB_POOL_PRE_PING'])
+
+    def test_describe_pool_hides_password(self):
+        config = self.config(
+            SQLALCHEMY_DATABASE_URI="postgresql://warbler:secret@db/warbler",
+            DB_POOL_RECYCLE=-1)
+        config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(config)
+        description = describe_pool(config)
+
+        self.assertNotIn('secret', description)
+        self.assertIn('pool size 5', description)
+        self.assertIn('recycle never', description)
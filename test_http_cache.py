@@ -0,0 +1,191 @@
+"""HTTP caching tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_http_cache.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, http_cache, CURR_USER_KEY
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class HttpCacheTestCase(TestCase):
+    """Test static fingerprints and conditional GETs."""
+
+    def setUp(self):
+        """Create a reader and an author with a message."""
+
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        reader = User.signup("reader", "reader@test.com", "password", None)
+        author = User.signup("author", "author@test.com", "password", None)
+        db.session.flush()
+        author.messages.append(Message(text="Hello"))
+        db.session.commit()
+
+        self.reader_id = reader.id
+        self.author_id = author.id
+        self.message_id = author.messages[0].id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+
+    def test_fingerprinted_static(self):
+        with app.test_request_context():
+            url = http_cache.static_url('app.js')
+        self.assertIn('?v=', url)
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+
+        # without the current fingerprint it has to be revalidated
+        for url in ('/static/app.js', '/static/app.js?v=stale'):
+            resp = self.client.get(url)
+            self.assertEqual(resp.headers['Cache-Control'], 'public, no-cache')
+
+    def test_pages_not_cached_by_default(self):
+        resp = self.client.get('/login')
+        self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+
+    def test_message_not_modified(self):
+        url = f"/messages/{self.message_id}"
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('public', resp.headers['Cache-Control'])
+        etag = resp.headers['ETag']
+
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b'')
+        self.assertEqual(resp.headers['ETag'], etag)
+
+        # a logged-in viewer sees follow buttons, so gets another version
+        self.login()
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('private', resp.headers['Cache-Control'])
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_message_modified_by_follow(self):
+        self.login()
+        url = f"/messages/{self.message_id}"
+        etag = self.client.get(url).headers['ETag']
+
+        self.client.post(f"/users/follow/{self.author_id}")
+
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'Unfollow', resp.data)
+
+    def test_profile_modified_by_like(self):
+        self.login()
+        url = f"/users/{self.author_id}"
+        etag = self.client.get(url).headers['ETag']
+
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        self.client.post(f"/messages/{self.message_id}/like")
+
+        # the page showing the flash isn't tagged: it's only right once
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('ETag', resp.headers)
+
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_profile_not_modified_before_page_query(self):
+        self.login()
+        url = f"/users/{self.author_id}"
+        etag = self.client.get(url).headers['ETag']
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            resp = self.client.get(url, headers={'If-None-Match': etag})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(resp.status_code, 304)
+        self.assertFalse([statement for statement in statements
+                          if 'messages.text' in statement])
+
+    def test_profile_modified_by_others_likes(self):
+        self.login()
+        url = f"/users/{self.author_id}"
+        etag = self.client.get(url).headers['ETag']
+
+        other = User.signup("other", "other@test.com", "password", None)
+        db.session.flush()
+        Likes.add(other.id, self.message_id)
+        db.session.commit()
+
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_likes_modified_by_like_count(self):
+        self.login()
+        self.client.post(f"/messages/{self.message_id}/like")
+        self.client.get('/')  # show the flash
+
+        url = f"/users/{self.reader_id}/likes"
+        etag = self.client.get(url).headers['ETag']
+
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        other = User.signup("other", "other@test.com", "password", None)
+        db.session.flush()
+        Likes.add(other.id, self.message_id)
+        db.session.commit()
+
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_likes_modified_by_author_profile(self):
+        self.login()
+        self.client.post(f"/messages/{self.message_id}/like")
+        self.client.get('/')  # show the flash
+
+        url = f"/users/{self.reader_id}/likes"
+        etag = self.client.get(url).headers['ETag']
+
+        author = User.query.get(self.author_id)
+        author.username = "renamed"
+        author.bump_version()
+        db.session.commit()
+
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'@renamed', resp.data)
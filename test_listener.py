@@ -0,0 +1,61 @@
+"""LISTEN/NOTIFY listener tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_listener.py
+
+
+import os
+import threading
+from unittest import TestCase
+
+from flask import Flask
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from listener import Listener
+
+
+class ListenerTestCase(TestCase):
+    """Test handing notifications to handlers."""
+
+    def setUp(self):
+        self.app = Flask('test_listener',
+                         root_path=os.path.dirname(os.path.abspath(__file__)))
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = (
+            app.config['SQLALCHEMY_DATABASE_URI'])
+        self.listener = Listener(self.app)
+
+    def test_notifications(self):
+        """Are payloads handed over once the sending transaction commits?"""
+
+        heard = []
+        arrived = threading.Event()
+
+        @self.listener.on('test_channel')
+        def handle(payload):
+            heard.append(payload)
+            arrived.set()
+
+        self.listener.start()
+
+        db.session.execute("SELECT pg_notify('test_channel', '42')")
+        self.assertFalse(arrived.wait(0.2))
+        db.session.commit()
+
+        self.assertTrue(arrived.wait(5))
+        self.assertEqual(heard, ['42'])
+
+    def test_pgbouncer_needs_direct_url(self):
+        """Does nothing listen through pgbouncer unless told where to?"""
+
+        self.app.config['DB_PGBOUNCER'] = True
+        self.listener.init_app(self.app)
+        self.assertIsNone(self.listener.uri)
+
+        self.app.config['LISTEN_DATABASE_URL'] = "postgresql:///direct"
+        self.listener.init_app(self.app)
+        self.assertEqual(self.listener.uri, "postgresql:///direct")
@@ -0,0 +1,56 @@
+"""Load harness tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_load_harness.py
+
+
+import os
+import sys
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'benchmarks'))
+
+from load_harness import Recorder, percentile
+
+
+class LoadHarnessTestCase(TestCase):
+    """Test the load harness's statistics."""
+
+    def test_percentile(self):
+        ordered = list(range(1, 101))
+
+        self.assertEqual(percentile(ordered, 50), 50)
+        self.assertEqual(percentile(ordered, 95), 95)
+        self.assertEqual(percentile(ordered, 99), 99)
+        self.assertEqual(percentile(ordered, 100), 100)
+        self.assertEqual(percentile(ordered, 0), 1)
+
+        # nearest rank rounds up, never interpolates
+        self.assertEqual(percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(percentile([1, 2, 3, 4], 51), 3)
+        self.assertEqual(percentile([7], 99), 7)
+
+    def test_recorder_summary(self):
+        recorder = Recorder()
+        for ms in (40, 10, 30, 20):
+            recorder.add('homepage', ms / 1000, True)
+        recorder.add('api_like', 0.5, False)
+
+        stats = recorder.summary(elapsed=2)
+
+        self.assertEqual(list(stats), ['api_like', 'homepage'])
+
+        homepage = stats['homepage']
+        self.assertEqual(homepage['requests'], 4)
+        self.assertEqual(homepage['errors'], 0)
+        self.assertEqual(homepage['throughput'], 2)
+        self.assertAlmostEqual(homepage['mean_ms'], 25)
+        self.assertAlmostEqual(homepage['p50_ms'], 20)
+        self.assertAlmostEqual(homepage['p95_ms'], 40)
+        self.assertAlmostEqual(homepage['max_ms'], 40)
+
+        self.assertEqual(stats['api_like']['errors'], 1)
+        self.assertEqual(stats['api_like']['throughput'], 0.5)
@@ -5,11 +5,15 @@
 # python -m unittest test_user_model.py
 
 import os
+import time
 from unittest import TestCase
 from sqlalchemy import exc
 
-from models import db, User, Message, Follows
-from datetime import datetime
+from models import (db, User, Message, Follows, Likes, TimelineEntry,
+                    snowflake, snowflake_workers, lease_worker_id,
+                    release_worker_id, worker_holder)
+from datetime import datetime, timedelta
+from snowflake import id_time
 
 # Set up env. variable to use test database
 # set up before before importing our app
@@ -47,3 +51,177 @@ class MessageModelTestCase(TestCase):
         self.assertIsInstance(msg.user, User)
         self.assertEqual(str(self.test), f"<User #{self.test.id}: {self.test.username}, {self.test.email}>")
         self.assertIsInstance(msg.timestamp, datetime)
+
+    def test_like_count(self):
+        """Is like_count kept up to date, with many likers per message?"""
+
+        msg = Message(text='test')
+        self.test.messages.append(msg)
+        u2 = User.signup('u2', 'u2@gmail.com', 'testpassword', None)
+        u3 = User.signup('u3', 'u3@gmail.com', 'testpassword', None)
+        db.session.commit()
+
+        self.assertTrue(Likes.add(u2.id, msg.id))
+        self.assertTrue(Likes.add(u3.id, msg.id))
+        self.assertFalse(Likes.add(u3.id, msg.id))
+        db.session.commit()
+        db.session.refresh(msg)
+        self.assertEqual(msg.like_count, 2)
+
+        self.assertTrue(Likes.remove(u2.id, msg.id))
+        self.assertFalse(Likes.remove(u2.id, msg.id))
+        db.session.commit()
+        db.session.refresh(msg)
+        self.assertEqual(msg.like_count, 1)
+
+        # a liker's account going away takes their like with it
+        db.session.delete(u3)
+        db.session.commit()
+        db.session.refresh(msg)
+        self.assertEqual(msg.like_count, 0)
+
+    def test_reconcile_like_counts(self):
+        """Does reconcile_like_counts repair counts that have drifted?"""
+
+        msg = Message(text='test')
+        self.test.messages.append(msg)
+        u2 = User.signup('u2', 'u2@gmail.com', 'testpassword', None)
+        db.session.commit()
+        Likes.add(u2.id, msg.id)
+        msg.like_count = 5
+        db.session.commit()
+
+        self.assertEqual(Message.reconcile_like_counts(), 1)
+        db.session.commit()
+        db.session.refresh(msg)
+        self.assertEqual(msg.like_count, 1)
+        self.assertEqual(Message.reconcile_like_counts(), 0)
+
+    def test_ids_and_timestamps(self):
+        """Does each message get its own time-ordered id and timestamp?"""
+
+        first = Message(text='first')
+        self.test.messages.append(first)
+        db.session.commit()
+        second = Message(text='second')
+        self.test.messages.append(second)
+        db.session.commit()
+
+        self.assertGreater(second.id, first.id)
+        self.assertGreater(second.timestamp, first.timestamp)
+        self.assertLess(abs(id_time(second.id) - second.timestamp).seconds, 5)
+
+    def test_rekey(self):
+        """Does rekey give legacy ids snowflakes, carrying likes along?"""
+
+        msg = Message(id=5, text='old', timestamp=datetime(2017, 1, 21, 11),
+                      user_id=self.test.id)
+        db.session.add(msg)
+        db.session.commit()
+        Likes.add(self.test.id, 5)
+        db.session.commit()
+
+        self.assertEqual(Message.rekey(), 1)
+        db.session.commit()
+
+        msg = Message.query.filter_by(text='old').one()
+        self.assertEqual(id_time(msg.id), datetime(2017, 1, 21, 11))
+        self.assertEqual(Likes.query.one().message_id, msg.id)
+        self.assertEqual(Message.rekey(), 0)
+
+    def test_timelines_trimmed(self):
+        """Do fan-out, backfill and rebuild keep timelines to MAX_LENGTH?"""
+
+        follower = User.signup('u2', 'u2@gmail.com', 'testpassword', None)
+        db.session.commit()
+        newest = lambda user: [entry.message_id for entry in TimelineEntry
+                               .query.filter_by(user_id=user.id)
+                               .order_by(TimelineEntry.message_id.desc())]
+
+        length = TimelineEntry.MAX_LENGTH
+        TimelineEntry.MAX_LENGTH, TimelineEntry.TRIM_EVERY = 3, 1
+        try:
+            messages = []
+            for i in range(5):
+                msg = Message(text=f'post {i}')
+                self.test.messages.append(msg)
+                db.session.flush()
+                TimelineEntry.fan_out(msg)
+                messages.insert(0, msg.id)
+            self.assertEqual(newest(self.test), messages[:3])
+
+            db.session.add(Follows(user_being_followed_id=self.test.id,
+                                   user_following_id=follower.id))
+            self.assertEqual(TimelineEntry.backfill(follower.id,
+                                                    self.test.id), 3)
+            self.assertEqual(newest(follower), messages[:3])
+
+            own = Message(text='own post', user_id=follower.id)
+            db.session.add(own)
+            db.session.flush()
+            TimelineEntry.fan_out(own)
+            self.assertEqual(newest(follower), [own.id] + messages[:2])
+
+            self.assertEqual(TimelineEntry.rebuild(), 6)
+            self.assertEqual(newest(follower), [own.id] + messages[:2])
+            self.assertEqual(newest(self.test), messages[:3])
+        finally:
+            TimelineEntry.MAX_LENGTH, TimelineEntry.TRIM_EVERY = length, 10
+            db.session.rollback()
+
+    def lease_row(self):
+        return db.session.execute(snowflake_workers.select().where(
+            snowflake_workers.c.worker_id == snowflake.worker_id)).first()
+
+    def test_worker_id_leased(self):
+        """Is a worker id leased, renewed and released in snowflake_workers?"""
+
+        release_worker_id()
+        snowflake._reset()
+        self.test.messages.append(Message(text='leases a worker id'))
+        db.session.commit()
+
+        lease = self.lease_row()
+        self.assertEqual(lease.holder, worker_holder())
+        self.assertGreater(lease.expires_at, datetime.utcnow())
+
+        # renewed, even once it's run out, if nobody took it
+        worker_id = snowflake.worker_id
+        db.session.execute(snowflake_workers.update()
+                           .where(snowflake_workers.c.worker_id == worker_id)
+                           .values(expires_at=datetime(2000, 1, 1)))
+        db.session.commit()
+        snowflake.lease_until = time.monotonic()
+        lease_worker_id()
+        self.assertEqual(snowflake.worker_id, worker_id)
+        self.assertGreater(self.lease_row().expires_at, datetime.utcnow())
+
+        # replaced if somebody did
+        db.session.execute(snowflake_workers.update()
+                           .where(snowflake_workers.c.worker_id == worker_id)
+                           .values(holder='elsewhere'))
+        db.session.commit()
+        snowflake.lease_until = time.monotonic()
+        lease_worker_id()
+        self.assertNotEqual(snowflake.worker_id, worker_id)
+
+        release_worker_id()
+        db.session.commit()
+        self.assertIsNone(self.lease_row().holder)
+
+    def test_no_worker_id_free(self):
+        """Are ids refused when every worker id is leased?"""
+
+        release_worker_id()
+        snowflake._reset()
+        db.session.execute(snowflake_workers.update().values(
+            holder='elsewhere',
+            expires_at=datetime.utcnow() + timedelta(minutes=1)))
+        db.session.commit()
+        try:
+            with self.assertRaises(RuntimeError):
+                lease_worker_id()
+        finally:
+            db.session.execute(snowflake_workers.update().values(
+                holder=None, expires_at=datetime(2000, 1, 1)))
+            db.session.commit()
@@ -9,7 +9,7 @@ import os
 from unittest import TestCase
 
 from flask import get_flashed_messages
-from models import db, connect_db, Message, User, Follows
+from models import db, connect_db, Message, User, Follows, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,7 +21,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, fragment_cache, CURR_USER_KEY
 
 
 # Create our tables (we do this here, so we only create the tables
@@ -257,4 +257,105 @@ class MessageViewTestCase(TestCase):
 
                 self.assertEqual(resp.status_code, 302)
                 flashed_msgs = get_flashed_messages()
-                self.assertIn(f"Access unauthorized.", flashed_msgs)
\ No newline at end of file
+                self.assertIn(f"Access unauthorized.", flashed_msgs)
+
+    def test_add_message_fans_out_to_followers(self):
+        self.setup_follow()
+        with app.test_request_context('/messages/new'):
+            app.preprocess_request()
+            with app.test_client() as c:
+                with c.session_transaction() as session:
+                    session[CURR_USER_KEY] = self.testuser.id
+                c.post('/messages/new', data={'text': 'Fanned out'})
+
+                msg = Message.query.filter_by(text='Fanned out').one()
+                self.assertIn(msg, TimelineEntry.feed(self.testuser.id))
+                self.assertIn(msg, TimelineEntry.feed(self.u1.id))
+                self.assertIn(msg, TimelineEntry.feed(self.u2.id))
+                self.assertNotIn(msg, TimelineEntry.feed(self.u3.id))
+
+    def test_delete_message_removes_from_timelines(self):
+        self.setup_follow()
+        with app.test_request_context('/messages/new'):
+            app.preprocess_request()
+            with app.test_client() as c:
+                with c.session_transaction() as session:
+                    session[CURR_USER_KEY] = self.testuser.id
+                c.post('/messages/new', data={'text': 'Short lived'})
+                msg_id = Message.query.filter_by(text='Short lived').one().id
+
+                c.post(f'/messages/{msg_id}/delete')
+
+                self.assertEqual(TimelineEntry.query.filter_by(message_id=msg_id).count(), 0)
+
+    def test_message_fragments_cached(self):
+        self.setup_likes_msgs()
+        with app.test_request_context('/'):
+            app.preprocess_request()
+            with app.test_client() as c:
+                with c.session_transaction() as session:
+                    session[CURR_USER_KEY] = self.testuser.id
+                html = c.get(f'/users/{self.u1.id}').get_data(as_text=True)
+
+                key = (self.m1.id, self.u1.profile_version)
+                self.assertIn('@test1', fragment_cache.get(key))
+                # like state is rendered per viewer, around the fragment
+                self.assertIn('btn-primary', html)
+
+                # a profile edit moves the author's fragments to new keys
+                self.u1.username = 'renamed'
+                self.u1.bump_version()
+                db.session.commit()
+                html = c.get(f'/users/{self.u1.id}').get_data(as_text=True)
+
+                self.assertIn('@renamed', html)
+                self.assertNotIn('@test1', html)
+
+    def test_delete_message_drops_fragment(self):
+        with app.test_request_context('/messages/new'):
+            app.preprocess_request()
+            with app.test_client() as c:
+                with c.session_transaction() as session:
+                    session[CURR_USER_KEY] = self.testuser.id
+                c.post('/messages/new', data={'text': 'Cached then gone'})
+                msg = Message.query.filter_by(text='Cached then gone').one()
+                key = (msg.id, self.testuser.profile_version)
+
+                c.get(f'/users/{self.testuser.id}')
+                self.assertIsNotNone(fragment_cache.get(key))
+
+                c.post(f'/messages/{msg.id}/delete')
+                self.assertIsNone(fragment_cache.get(key))
+
+    def test_search_messages(self):
+        self.setup_follow()
+        m1 = Message(text='Watching the birds migrate', user_id=self.u3.id)
+        m2 = Message(text='A bird migrated over my house', user_id=self.u5.id)
+        m3 = Message(text='Nothing to see here', user_id=self.u3.id)
+        db.session.add_all([m1, m2, m3])
+        db.session.commit()
+        with app.test_request_context('/messages/search'):
+            app.preprocess_request()
+            with app.test_client() as c:
+                with c.session_transaction() as session:
+                    session[CURR_USER_KEY] = self.testuser.id
+                html = c.get('/messages/search?q=migrating bird').get_data(as_text=True)
+
+                self.assertIn(m1.text, html)
+                self.assertIn(m2.text, html)
+                self.assertNotIn(m3.text, html)
+                # newest first
+                self.assertLess(html.index(m2.text), html.index(m1.text))
+
+                html = c.get('/messages/search?q=migrating bird&following=1').get_data(as_text=True)
+
+                self.assertIn(m1.text, html)
+                self.assertNotIn(m2.text, html)
+
+    def test_search_messages_unauthorized(self):
+        with app.test_request_context('/messages/search'):
+            app.preprocess_request()
+            with app.test_client() as c:
+                resp = c.get('/messages/search?q=bird')
+
+                self.assertEqual(resp.status_code, 302)
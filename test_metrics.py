@@ -0,0 +1,100 @@
+"""Metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from flask import Flask
+
+from cache import LocalCache
+from metrics import Metrics
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+
+db.create_all()
+
+
+class MetricsViewTestCase(TestCase):
+    """Test the /metrics endpoint of the app."""
+
+    def test_metrics(self):
+        """Are requests, templates, the pool and caches reported?"""
+
+        client = app.test_client()
+        client.get('/')
+        body = client.get('/metrics').get_data(as_text=True)
+
+        self.assertIn("# TYPE warbler_requests_total counter", body)
+        self.assertIn('warbler_requests_total{endpoint="homepage",'
+                      'method="GET",status="200"}', body)
+        self.assertIn('warbler_request_duration_seconds_bucket'
+                      '{endpoint="homepage",le="+Inf"}', body)
+        self.assertIn('warbler_template_render_seconds_count'
+                      '{template="home-anon.html"}', body)
+        self.assertIn('warbler_db_pool_checked_out ', body)
+        self.assertIn('warbler_cache_hits_total{cache="users"}', body)
+
+
+class MetricsTestCase(TestCase):
+    """Test collecting metrics across processes."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        # an explicit root_path, as Flask 1.0 can't find this module's
+        # under pytest's assertion rewriting
+        app = Flask(__name__,
+                    root_path=os.path.dirname(os.path.abspath(__file__)))
+        app.config['METRICS_DIR'] = self.directory
+        self.metrics = Metrics(app)
+
+        self.cache = LocalCache()
+        self.metrics.track_cache('things', self.cache)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_histogram_buckets(self):
+        """Are observations counted in cumulative buckets?"""
+
+        self.metrics.observe('latency', {'endpoint': 'a'}, 0.003)
+        self.metrics.observe('latency', {'endpoint': 'a'}, 0.3)
+        self.metrics.observe('latency', {'endpoint': 'a'}, 30)
+        body = self.metrics.serve().get_data(as_text=True)
+
+        self.assertIn('latency_bucket{endpoint="a",le="0.0025"} 0', body)
+        self.assertIn('latency_bucket{endpoint="a",le="0.005"} 1', body)
+        self.assertIn('latency_bucket{endpoint="a",le="0.5"} 2', body)
+        self.assertIn('latency_bucket{endpoint="a",le="+Inf"} 3', body)
+        self.assertIn('latency_count{endpoint="a"} 3', body)
+        self.assertIn('latency_sum{endpoint="a"} 30.303', body)
+
+    def test_adds_up_processes(self):
+        """Are other processes' counters added in, but not the gauges of
+        ones that have exited?"""
+
+        self.metrics.inc('hits', {'page': 'home'}, 2)
+        self.cache.get('missing')
+
+        # a worker that has since exited
+        with open(os.path.join(self.directory, '999999999.json'), 'w') as f:
+            json.dump({'counters': [['hits', [['page', 'home']], 3]],
+                       'histograms': [],
+                       'gauges': [['warbler_db_pool_checked_out', [], 5]]},
+                      f)
+
+        body = self.metrics.serve().get_data(as_text=True)
+
+        self.assertIn('hits{page="home"} 5', body)
+        self.assertIn('warbler_cache_misses_total{cache="things"} 1', body)
+        self.assertNotIn('warbler_db_pool_checked_out', body)
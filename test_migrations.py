@@ -0,0 +1,172 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+#
+# Upgrading from before migrations uses a second database,
+# warbler-test-baseline, which is remade each time.
+
+
+import os
+import subprocess
+import sys
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from models import db
+from snowflake import id_time
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import migrations
+
+BASELINE_URL = "postgresql:///warbler-test-baseline"
+
+# Warbler's tables as they were before there were migrations
+BASELINE_SCHEMA = """
+    CREATE TABLE users (
+        id serial PRIMARY KEY,
+        email text NOT NULL UNIQUE,
+        username text NOT NULL UNIQUE,
+        image_url text,
+        header_image_url text,
+        bio text,
+        location text,
+        password text NOT NULL
+    );
+    CREATE TABLE follows (
+        user_being_followed_id integer REFERENCES users ON DELETE CASCADE,
+        user_following_id integer REFERENCES users ON DELETE CASCADE,
+        PRIMARY KEY (user_being_followed_id, user_following_id)
+    );
+    CREATE TABLE messages (
+        id serial PRIMARY KEY,
+        text varchar(140) NOT NULL,
+        timestamp timestamp NOT NULL,
+        user_id integer NOT NULL REFERENCES users ON DELETE CASCADE
+    );
+    CREATE TABLE likes (
+        id serial PRIMARY KEY,
+        user_id integer REFERENCES users ON DELETE CASCADE,
+        message_id integer UNIQUE REFERENCES messages ON DELETE CASCADE
+    );
+"""
+
+db.create_all()
+
+
+def schema(conn):
+    """The columns, indexes, constraints and triggers of a database."""
+
+    def rows(query):
+        return {tuple(row) for row in conn.execute(query)}
+
+    return {
+        'columns': rows("""
+            SELECT table_name, column_name, data_type, is_nullable,
+                column_default
+            FROM information_schema.columns
+            WHERE table_schema = 'public'
+        """),
+        'indexes': rows("""
+            SELECT indexdef FROM pg_indexes WHERE schemaname = 'public'
+        """),
+        'constraints': rows("""
+            SELECT conrelid::regclass::text, pg_get_constraintdef(oid)
+            FROM pg_constraint WHERE connamespace = 'public'::regnamespace
+        """),
+        'triggers': rows("""
+            SELECT tgrelid::regclass::text, tgname FROM pg_trigger
+            WHERE NOT tgisinternal
+        """),
+    }
+
+
+class MigrationsTestCase(TestCase):
+    """Test applying migrations."""
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def index_exists(self, name):
+        return db.session.scalar("SELECT to_regclass(:name)",
+                                 {'name': name}) is not None
+
+    def test_new_database_up_to_date(self):
+        self.assertEqual(migrations.applied_versions(),
+                         {version for version, _ in migrations.MIGRATIONS})
+        self.assertEqual(migrations.upgrade(), [])
+
+    def test_upgrade(self):
+        db.session.execute("DROP INDEX ix_follows_user_following_id")
+        db.session.execute(migrations.schema_migrations.delete()
+                           .where(migrations.schema_migrations.c.version == 2))
+        db.session.commit()
+        self.assertFalse(self.index_exists('ix_follows_user_following_id'))
+
+        self.assertEqual(migrations.upgrade(), [2])
+        self.assertTrue(self.index_exists('ix_follows_user_following_id'))
+        self.assertIn(2, migrations.applied_versions())
+
+    def test_unknown_schema_refused(self):
+        db.session.execute("ALTER TABLE follows RENAME TO follows_renamed")
+        try:
+            with self.assertRaises(RuntimeError):
+                migrations.check_base_tables()
+        finally:
+            db.session.rollback()
+
+    def test_upgrade_from_before_migrations(self):
+        conn = db.engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT')
+        conn.execute('DROP DATABASE IF EXISTS "warbler-test-baseline"')
+        conn.execute('CREATE DATABASE "warbler-test-baseline"')
+        conn.close()
+
+        baseline = create_engine(BASELINE_URL)
+        try:
+            with baseline.begin() as conn:
+                conn.execute(BASELINE_SCHEMA)
+                conn.execute("""
+                    INSERT INTO users (email, username, password)
+                    VALUES ('a@test.com', 'a', 'x'), ('b@test.com', 'b', 'x');
+                    -- b follows a, and likes a's message
+                    INSERT INTO follows VALUES (1, 2);
+                    INSERT INTO messages (text, timestamp, user_id)
+                    VALUES ('Old', '2017-01-21 11:00', 1);
+                    INSERT INTO likes (user_id, message_id) VALUES (2, 1);
+                """)
+
+            upgrade = subprocess.run(
+                [sys.executable, '-m', 'flask', 'db-upgrade'],
+                env=dict(os.environ, DATABASE_URL=BASELINE_URL,
+                         FLASK_APP='app.py'),
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True, text=True)
+            self.assertEqual(upgrade.returncode, 0, upgrade.stderr)
+
+            with baseline.connect() as conn, db.engine.connect() as current:
+                self.assertEqual(schema(conn), schema(current))
+
+                self.assertEqual(conn.execute("""
+                    SELECT username, messages_count, following_count,
+                        followers_count, likes_count
+                    FROM users ORDER BY id
+                """).fetchall(), [('a', 1, 0, 1, 0), ('b', 0, 1, 0, 1)])
+
+                message_id, like_count = conn.execute(
+                    "SELECT id, like_count FROM messages").first()
+                self.assertEqual(id_time(message_id),
+                                 datetime(2017, 1, 21, 11))
+                self.assertEqual(like_count, 1)
+                self.assertEqual(conn.scalar("SELECT message_id FROM likes"),
+                                 message_id)
+                self.assertEqual(conn.execute("""
+                    SELECT user_id, message_id FROM timelines ORDER BY user_id
+                """).fetchall(), [(1, message_id), (2, message_id)])
+        finally:
+            baseline.dispose()
@@ -0,0 +1,106 @@
+"""Password hashing pool tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_passwords.py
+
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from passwords import HostSemaphore, Passwords, PasswordsBusy
+
+
+class PasswordsTestCase(TestCase):
+    """Test bcrypt hashing on the worker pool."""
+
+    def setUp(self):
+        self.passwords = Passwords()
+        self.passwords.rounds = 4
+
+    def test_hash_and_check(self):
+        hashed = self.passwords.hash('testpassword')
+
+        self.assertTrue(hashed.startswith('$2b$04$'))
+        self.assertTrue(self.passwords.check(hashed, 'testpassword'))
+        self.assertFalse(self.passwords.check(hashed, 'wrongpassword'))
+        self.assertRaises(ValueError, self.passwords.hash, None)
+
+    def test_needs_rehash(self):
+        hashed = self.passwords.hash('testpassword')
+
+        self.assertFalse(self.passwords.needs_rehash(hashed))
+        self.passwords.rounds = 5
+        self.assertTrue(self.passwords.needs_rehash(hashed))
+        self.assertTrue(self.passwords.needs_rehash('not a hash'))
+
+    def test_busy_when_queue_full(self):
+        self.passwords.workers = 1
+        self.passwords.max_pending = 1
+        started, release = threading.Event(), threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+
+        blocker = threading.Thread(target=self.passwords._run, args=('hash', slow))
+        blocker.start()
+        started.wait(5)
+        try:
+            self.assertRaises(PasswordsBusy, self.passwords.hash, 'testpassword')
+        finally:
+            release.set()
+            blocker.join()
+
+        self.assertTrue(self.passwords.hash('testpassword'))
+
+    def test_on_timing(self):
+        timings = []
+        self.passwords.on_timing = lambda *timing: timings.append(timing)
+
+        hashed = self.passwords.hash('testpassword')
+        self.passwords.check(hashed, 'testpassword')
+
+        self.assertEqual([operation for operation, _ in timings],
+                         ['hash', 'check'])
+        self.assertTrue(all(seconds > 0 for _, seconds in timings))
+
+    def test_busy_when_host_slots_taken(self):
+        """Do separate Passwords (as in separate processes) share the
+        host's slots?"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.passwords.host_slots = HostSemaphore(directory, 1)
+            other = Passwords()
+            other.rounds = 4
+            other.host_slots = HostSemaphore(directory, 1)
+            other.slot_wait = 0.05
+            started, release = threading.Event(), threading.Event()
+
+            def slow():
+                started.set()
+                release.wait(5)
+
+            blocker = threading.Thread(target=self.passwords._run,
+                                       args=('hash', slow))
+            blocker.start()
+            started.wait(5)
+            try:
+                self.assertRaises(PasswordsBusy, other.hash, 'testpassword')
+            finally:
+                release.set()
+                blocker.join()
+
+            self.assertTrue(other.hash('testpassword'))
+
+    def test_pool_reset_after_fork(self):
+        self.passwords.hash('testpassword')
+
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if self.passwords._executor is None else 1)
+        _, status = os.waitpid(pid, 0)
+
+        self.assertTrue(os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0)
+        self.assertIsNotNone(self.passwords._executor)
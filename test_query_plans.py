@@ -0,0 +1,92 @@
+"""Query plan tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from query_plans import HOT_QUERIES, seq_scans
+
+db.create_all()
+
+USERS = 5000
+MESSAGES_PER_USER = 8
+FOLLOWS_PER_USER = 4
+
+
+class QueryPlansTestCase(TestCase):
+    """Test that the hot queries use indexes on a large fixture."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Fill the tables enough that scanning them would cost."""
+
+        for model in (Likes, Message, Follows, User):
+            model.query.delete()
+
+        db.session.execute("""
+            INSERT INTO users (email, username, password)
+            SELECT 'plan' || n || '@test.com', 'plan' || n, 'unused'
+            FROM generate_series(1, :users) n
+        """, {'users': USERS})
+        db.session.execute("""
+            INSERT INTO messages (text, timestamp, user_id)
+            SELECT 'Warble', timezone('utc', now()) - n * interval '1 hour', id
+            FROM users CROSS JOIN generate_series(1, :messages) n
+        """, {'messages': MESSAGES_PER_USER})
+        Message.rekey()
+
+        # everyone follows the next few users along, and likes the
+        # newest message of each
+        db.session.execute("""
+            INSERT INTO follows (user_being_followed_id, user_following_id)
+            SELECT followed.id, users.id
+            FROM users CROSS JOIN LATERAL (
+                SELECT id FROM users AS later WHERE later.id > users.id
+                ORDER BY id LIMIT :follows) AS followed
+        """, {'follows': FOLLOWS_PER_USER})
+        db.session.execute("""
+            INSERT INTO likes (user_id, message_id)
+            SELECT user_following_id, max(messages.id)
+            FROM follows JOIN messages
+                ON messages.user_id = follows.user_being_followed_id
+            GROUP BY user_following_id, user_being_followed_id
+        """)
+
+        TimelineEntry.rebuild()
+        db.session.commit()
+        db.session.execute("ANALYZE")
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        for model in (Likes, Message, Follows, User):
+            model.query.delete()
+        db.session.commit()
+
+    def setUp(self):
+        self.reader = User.query.filter_by(username='plan100').one()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_hot_queries_use_indexes(self):
+        self.assertEqual(seq_scans(self.reader), {})
+
+    def test_seq_scan_reported(self):
+        """Would the check notice a missing index?"""
+
+        db.session.execute("DROP INDEX ix_messages_user_id_id")
+        scans = seq_scans(self.reader)
+        db.session.rollback()
+
+        self.assertEqual(scans['profile_messages'], ['messages'])
+        self.assertLess(len(scans), len(HOT_QUERIES))
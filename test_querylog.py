@@ -0,0 +1,112 @@
+"""Query log tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_querylog.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, TimelineEntry
+from querylog import QueryBudgetExceeded, statement_shape
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class QueryLogTestCase(TestCase):
+    """Test per-request query counting."""
+
+    def setUp(self):
+        """Create a user following several authors who've posted."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.client = app.test_client()
+
+        self.user = User.signup("reader", "reader@test.com", "password", None)
+        db.session.flush()
+
+        for i in range(5):
+            author = User.signup(f"author{i}", f"author{i}@test.com",
+                                 "password", None)
+            db.session.flush()
+            self.user.following.append(author)
+            author.messages.append(Message(text=f"Post {i}"))
+
+        db.session.commit()
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        self.user_id = self.user.id
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['TESTING'] = False
+        app.config['QUERY_BUDGETS'] = {}
+        app.config['QUERY_BUDGET_STRICT'] = None
+        app.config['QUERY_OVERLAY'] = None
+
+    def login(self, client):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def test_statement_shape(self):
+        """Do statements differing only in parameters share a shape?"""
+
+        self.assertEqual(
+            statement_shape("SELECT * FROM users\n WHERE id = %(id_1)s"),
+            "SELECT * FROM users WHERE id = ?")
+        self.assertEqual(
+            statement_shape("SELECT * FROM users WHERE id IN "
+                            "(%(id_1)s, %(id_2)s, %(id_3)s)"),
+            statement_shape("SELECT * FROM users WHERE id IN "
+                            "(%(id_1)s, %(id_2)s)"))
+
+    def test_headers(self):
+        """Are query counts reported, with no N+1 on the home timeline?"""
+
+        with self.client as c:
+            self.login(c)
+            resp = c.get("/")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Post 4", str(resp.data))
+            self.assertGreater(int(resp.headers['X-Query-Count']), 0)
+            self.assertTrue(resp.headers['X-Query-Time'].endswith("ms"))
+            self.assertEqual(resp.headers['X-Query-Repeats'], "0")
+
+    def test_budget(self):
+        """Does going over a budget fail the request under test?"""
+
+        app.config['TESTING'] = True
+        app.config['QUERY_BUDGETS'] = {'homepage': 1}
+
+        with self.client as c:
+            self.login(c)
+            with self.assertRaises(QueryBudgetExceeded):
+                c.get("/")
+
+            app.config['QUERY_BUDGETS'] = {'homepage': 20}
+            self.assertEqual(c.get("/").status_code, 200)
+
+    def test_overlay(self):
+        """Is the summary panel added to pages when turned on?"""
+
+        app.config['QUERY_OVERLAY'] = True
+
+        with self.client as c:
+            self.login(c)
+            resp = c.get("/")
+
+            self.assertIn('id="query-log"', str(resp.data))
+            self.assertIn(f"{resp.headers['X-Query-Count']} queries",
+                          str(resp.data))
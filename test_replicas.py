@@ -0,0 +1,128 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+#
+# They use a second database, warbler-test-replica, as a stand-in replica;
+# it's created if it doesn't exist. Nothing copies data into it, so what a
+# page shows says which database it was read from.
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from models import db, Message, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, replicas, CURR_USER_KEY
+from replicas import PRIMARY_UNTIL_KEY
+
+REPLICA_URL = "postgresql:///warbler-test-replica"
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ReplicasTestCase(TestCase):
+    """Test sending read-only views to a replica."""
+
+    @classmethod
+    def setUpClass(cls):
+        conn = db.engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT')
+        if not conn.scalar("SELECT 1 FROM pg_database WHERE datname = %s",
+                           ('warbler-test-replica',)):
+            conn.execute('CREATE DATABASE "warbler-test-replica"')
+        conn.close()
+
+        cls.replica = create_engine(REPLICA_URL)
+        db.metadata.create_all(cls.replica)
+        replicas.engines = [cls.replica]
+
+    @classmethod
+    def tearDownClass(cls):
+        replicas.engines = []
+        cls.replica.dispose()
+
+    def setUp(self):
+        Message.query.delete()
+        User.query.delete()
+
+        author = User.signup("author", "author@test.com", "password", None)
+        author.messages.append(Message(text="On the primary"))
+        db.session.commit()
+        self.author_id = author.id
+        self.primary_msg_id = author.messages[0].id
+
+        # the same author on the replica, with a message of its own
+        self.replica_msg_id = self.primary_msg_id + 1
+        with self.replica.begin() as conn:
+            conn.execute("DELETE FROM messages")
+            conn.execute("DELETE FROM users")
+            conn.execute("""
+                INSERT INTO users (id, email, username, password)
+                VALUES (%s, 'replica@test.com', 'author', 'unused')
+            """, (self.author_id,))
+            conn.execute("""
+                INSERT INTO messages (id, text, user_id)
+                VALUES (%s, 'Only on the replica', %s)
+            """, (self.replica_msg_id, self.author_id))
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_reads_from_replica(self):
+        resp = self.client.get(f"/messages/{self.replica_msg_id}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"Only on the replica", resp.data)
+
+        resp = self.client.get(f"/api/messages/{self.primary_msg_id}")
+        self.assertEqual(resp.status_code, 404)
+
+    def test_writes_go_to_primary(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author_id
+
+        resp = self.client.post("/messages/new", data={"text": "Just posted"})
+        self.assertEqual(resp.status_code, 302)
+
+        msg = Message.query.filter_by(text="Just posted").one()
+        self.assertEqual(
+            self.replica.scalar("SELECT count(*) FROM messages WHERE id = %s",
+                                (msg.id,)), 0)
+
+    def test_read_your_writes(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author_id
+
+        self.client.post("/messages/new", data={"text": "Just posted"})
+        msg_id = Message.query.filter_by(text="Just posted").one().id
+
+        # pinned to the primary, which has the new message
+        resp = self.client.get(f"/messages/{msg_id}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"Just posted", resp.data)
+
+        with self.client.session_transaction() as sess:
+            sess[PRIMARY_UNTIL_KEY] = 0
+
+        # back on the replica, which doesn't
+        resp = self.client.get(f"/messages/{msg_id}")
+        self.assertEqual(resp.status_code, 404)
+
+    def test_other_views_use_primary(self):
+        """Views not marked read_only aren't routed, even for GETs."""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author_id
+
+        resp = self.client.get("/users/profile")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"author@test.com", resp.data)
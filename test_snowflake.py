@@ -0,0 +1,82 @@
+"""Snowflake id tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_snowflake.py
+
+import time
+from datetime import datetime
+from unittest import TestCase
+from unittest.mock import patch
+
+from snowflake import (EPOCH, SEQUENCE_BITS, WORKERS, Snowflake, id_time,
+                       make_id, to_millis)
+
+NOW = datetime(2024, 3, 5, 12, 30, 15, 250000)
+
+
+class SnowflakeTestCase(TestCase):
+    """Test making time-sortable ids."""
+
+    def setUp(self):
+        self.snowflake = Snowflake()
+        self.snowflake.worker_id = 3
+
+    def next_id(self, now=NOW):
+        with patch('snowflake.datetime') as clock:
+            clock.utcnow.return_value = now
+            return self.snowflake.next_id()
+
+    def test_layout(self):
+        snowflake = self.next_id()
+
+        self.assertEqual(id_time(snowflake), NOW)
+        self.assertEqual(snowflake, make_id(to_millis(NOW), 3 << SEQUENCE_BITS))
+        # exact as a JavaScript number
+        self.assertLess(make_id(to_millis(datetime(2079, 1, 1)), WORKERS - 1),
+                        2 ** 53)
+        self.assertEqual(to_millis(EPOCH), 0)
+
+    def test_ids_increase(self):
+        ids = [self.next_id() for _ in range(40)]
+
+        self.assertEqual(ids, sorted(set(ids)))
+        # out of sequence numbers, the rest borrow from later milliseconds
+        self.assertEqual(id_time(ids[15]), NOW)
+        self.assertGreater(id_time(ids[16]), NOW)
+
+        # a clock stepping back doesn't make older ids
+        self.assertGreater(self.next_id(datetime(2024, 1, 1)), ids[-1])
+
+    def test_workers_differ(self):
+        other = Snowflake()
+        other.worker_id = 4
+
+        with patch('snowflake.datetime') as clock:
+            clock.utcnow.return_value = NOW
+            self.assertNotEqual(self.snowflake.next_id(), other.next_id())
+
+    def test_needs_worker_id(self):
+        with self.assertRaises(RuntimeError):
+            Snowflake().next_id()
+
+    def test_lease(self):
+        snowflake = Snowflake()
+        self.assertTrue(snowflake.needs_lease())
+
+        started = time.monotonic()
+        snowflake.lease(5, 60, started)
+        self.assertFalse(snowflake.needs_lease())
+        self.assertEqual(snowflake.worker_id, 5)
+
+        # renewed at half time, and refused once it's over
+        snowflake.lease(5, 60, started - 31)
+        self.assertTrue(snowflake.needs_lease())
+        snowflake.lease(5, 60, started - 60)
+        with self.assertRaises(RuntimeError):
+            snowflake.next_id()
+
+    def test_new_worker_id_keeps_order(self):
+        before = self.next_id()
+        self.snowflake.lease(0, 60)
+        self.assertGreater(self.next_id(), before)
@@ -6,10 +6,11 @@
 
 
 import os
+import threading
 from unittest import TestCase
 from sqlalchemy import exc
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, passwords
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -112,4 +113,176 @@ class UserModelTestCase(TestCase):
 
         # Check that User.authenticate returns false with invalid credentials
         self.assertFalse(User.authenticate('wronguser', 'testpassword'))
-        self.assertFalse(User.authenticate('testusername', 'wrongpassword'))
\ No newline at end of file
+        self.assertFalse(User.authenticate('testusername', 'wrongpassword'))
+
+    def test_user_stat_counters(self):
+        """Are the denormalized stat counters kept in step with writes?"""
+        u2 = User(
+            email="test2@test.com",
+            username="testuser2",
+            password="HASHED_PASSWORD2"
+        )
+        db.session.add(u2)
+        self.u.followers.append(u2)
+        msg = Message(text="counted", user_id=self.u.id)
+        db.session.add(msg)
+        db.session.commit()
+        u2.likes.append(msg)
+        db.session.commit()
+
+        self.assertEqual(self.u.messages_count, 1)
+        self.assertEqual(self.u.followers_count, 1)
+        self.assertEqual(self.u.following_count, 0)
+        self.assertEqual(u2.following_count, 1)
+        self.assertEqual(u2.likes_count, 1)
+
+        db.session.delete(msg)
+        db.session.commit()
+
+        self.assertEqual(self.u.messages_count, 0)
+        self.assertEqual(u2.likes_count, 0)
+
+    def test_opposite_follows_dont_deadlock(self):
+        """Can two users follow, and unfollow, each other at once?"""
+        u2 = User(
+            email="test2@test.com",
+            username="testuser2",
+            password="HASHED_PASSWORD2"
+        )
+        db.session.add(u2)
+        db.session.commit()
+        pairs = [(self.u.id, u2.id), (u2.id, self.u.id)]
+
+        def race(statement):
+            """Run `statement` for both pairs at once, on two connections."""
+            barrier = threading.Barrier(len(pairs))
+            errors = []
+
+            def run(followed_id, following_id):
+                with db.engine.begin() as conn:
+                    barrier.wait()
+                    try:
+                        conn.execute(statement, (followed_id, following_id))
+                    except exc.DBAPIError as error:
+                        errors.append(error)
+                        raise
+
+            threads = [threading.Thread(target=run, args=pair)
+                       for pair in pairs]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+
+        # hold each counter update open long enough for the other
+        # connection to get in between
+        db.session.execute("""
+            CREATE FUNCTION slow_update() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_sleep(0.1);
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER slow_update BEFORE UPDATE ON users
+            FOR EACH ROW EXECUTE PROCEDURE slow_update();
+        """)
+        db.session.commit()
+        try:
+            race("INSERT INTO follows (user_being_followed_id, "
+                 "user_following_id) VALUES (%s, %s)")
+            race("DELETE FROM follows WHERE user_being_followed_id = %s "
+                 "AND user_following_id = %s")
+        finally:
+            db.session.execute("""
+                DROP TRIGGER slow_update ON users;
+                DROP FUNCTION slow_update();
+            """)
+            db.session.commit()
+
+        db.session.expire_all()
+        for user in (self.u, u2):
+            self.assertEqual(user.following_count, 0)
+            self.assertEqual(user.followers_count, 0)
+
+    def test_likes_version(self):
+        """Do likes and unlikes bump the liker's and author's versions?"""
+        u2 = User(
+            email="test2@test.com",
+            username="testuser2",
+            password="HASHED_PASSWORD2"
+        )
+        db.session.add(u2)
+        msg = Message(text="liked", user_id=self.u.id)
+        db.session.add(msg)
+        db.session.commit()
+        self.assertEqual(self.u.newest_message_id(), msg.id)
+
+        u2.likes.append(msg)
+        db.session.commit()
+        self.assertEqual((self.u.likes_version, u2.likes_version), (1, 1))
+
+        u2.likes.remove(msg)
+        db.session.commit()
+        self.assertEqual((self.u.likes_version, u2.likes_version), (2, 2))
+
+        # liking your own message bumps you once
+        self.u.likes.append(msg)
+        db.session.commit()
+        self.assertEqual(self.u.likes_version, 3)
+
+    def test_reconcile_counts(self):
+        """Does reconcile_counts repair counters that have drifted?"""
+        db.session.add(Message(text="counted", user_id=self.u.id))
+        db.session.commit()
+        User.query.filter_by(id=self.u.id).update({User.messages_count: 42})
+        db.session.commit()
+
+        self.assertEqual(User.reconcile_counts(), 1)
+        db.session.commit()
+
+        self.assertEqual(self.u.messages_count, 1)
+        self.assertEqual(User.reconcile_counts(), 0)
+
+    def test_liked_message_ids(self):
+        """Does liked_message_ids resolve likes for just the given page?"""
+        m1 = Message(text="liked", user_id=self.u.id)
+        m2 = Message(text="not liked", user_id=self.u.id)
+        m3 = Message(text="liked, off the page", user_id=self.u.id)
+        db.session.add_all([m1, m2, m3])
+        self.u.likes.extend([m1, m3])
+        db.session.commit()
+
+        self.assertEqual(self.u.liked_message_ids([m1, m2]), {m1.id})
+        self.assertEqual(self.u.liked_message_ids([]), set())
+
+    def test_following_ids(self):
+        """Does following_ids resolve follow state for many users at once?"""
+        others = [User(email=f"other{i}@test.com",
+                       username=f"other{i}",
+                       password="HASHED_PASSWORD") for i in range(3)]
+        db.session.add_all(others)
+        self.u.following.extend(others[:2])
+        db.session.commit()
+
+        ids = [other.id for other in others]
+        self.assertEqual(self.u.following_ids(ids), set(ids[:2]))
+        self.assertEqual(others[0].following_ids([self.u.id]), set())
+        self.assertEqual(self.u.following_ids([]), set())
+
+    def test_authenticate_rehashes_on_cost_change(self):
+        """Is a hash at a stale bcrypt cost upgraded on successful login?"""
+        user = User.signup('rehashme', 'rehash@gmail.com', 'testpassword', None)
+        db.session.commit()
+        old_rounds = passwords.rounds
+        passwords.rounds = 4
+        try:
+            self.assertFalse(User.authenticate('rehashme', 'wrongpassword'))
+            self.assertFalse(user.password.startswith('$2b$04$'))
+
+            self.assertEqual(User.authenticate('rehashme', 'testpassword'), user)
+            self.assertTrue(user.password.startswith('$2b$04$'))
+            self.assertEqual(User.authenticate('rehashme', 'testpassword'), user)
+        finally:
+            passwords.rounds = old_rounds
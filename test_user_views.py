@@ -1,14 +1,15 @@
 """User view routes tests"""
 import os
+import time
 from unittest import TestCase
 from flask import g, get_flashed_messages
 from sqlalchemy import exc
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, TimelineEntry
 
 os.environ['DATABASE_URL'] = 'postgresql:///warbler-test'
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, deleted_users
 app.config['WTF_CSRF_ENABLED'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
@@ -440,4 +441,164 @@ class UserViewsTestCase(TestCase):
 
                 self.assertEqual(resp.status_code, 302)
                 flashed_msgs = get_flashed_messages()
-                self.assertIn('Access unauthorized.', flashed_msgs)
\ No newline at end of file
+                self.assertIn('Access unauthorized.', flashed_msgs)
+
+    def test_add_follow_backfills_timeline(self):
+        msg = Message(text='posted before the follow', user_id=self.u5.id)
+        db.session.add(msg)
+        db.session.commit()
+        with app.test_request_context(f'/users/follow/{self.u5.id}'):
+            app.preprocess_request()
+            with app.test_client() as c:
+                with c.session_transaction() as session:
+                    session[CURR_USER_KEY] = self.test.id
+                c.post(f'/users/follow/{self.u5.id}')
+
+                self.assertIn(msg, TimelineEntry.feed(self.test.id))
+
+                resp = c.get('/')
+                self.assertIn('posted before the follow', str(resp.data))
+
+    def test_stop_following_prunes_timeline(self):
+        self.setup_follow()
+        msg = Message(text='soon unfollowed', user_id=self.u3.id)
+        db.session.add(msg)
+        db.session.commit()
+        TimelineEntry.rebuild()
+        db.session.commit()
+        self.assertIn(msg, TimelineEntry.feed(self.test.id))
+        with app.test_request_context(f'/users/stop-following/{self.u3.id}'):
+            app.preprocess_request()
+            with app.test_client() as c:
+                with c.session_transaction() as session:
+                    session[CURR_USER_KEY] = self.test.id
+                c.post(f'/users/stop-following/{self.u3.id}')
+
+                self.assertNotIn(msg, TimelineEntry.feed(self.test.id))
+
+    def test_show_user_profile_pagination(self):
+        msgs = [Message(text=f'warble number {i}', user_id=self.test.id) for i in range(105)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        with app.test_request_context(f'/users/{self.test.id}'):
+            app.preprocess_request()
+            with app.test_client() as c:
+                with c.session_transaction() as session:
+                    session[CURR_USER_KEY] = self.test.id
+                resp = c.get(f'/users/{self.test.id}')
+                html = resp.get_data(as_text=True)
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn('warble number 104<', html)
+                self.assertNotIn('warble number 4<', html)
+                self.assertIn('id="load-more"', html)
+
+                cursor = msgs[5].id
+                resp = c.get(f'/users/{self.test.id}?before={cursor}')
+                html = resp.get_data(as_text=True)
+
+                self.assertIn('warble number 4<', html)
+                self.assertIn('warble number 0<', html)
+                self.assertNotIn('warble number 5<', html)
+                self.assertNotIn('id="load-more"', html)
+
+    def test_show_user_profile_bad_cursor(self):
+        with app.test_request_context(f'/users/{self.test.id}'):
+            app.preprocess_request()
+            with app.test_client() as c:
+                with c.session_transaction() as session:
+                    session[CURR_USER_KEY] = self.test.id
+                resp = c.get(f'/users/{self.test.id}?before=yesterday')
+
+                self.assertEqual(resp.status_code, 400)
+
+    def test_list_users_search_bio_and_location(self):
+        """Search should match whole words in bio and location too"""
+        self.u5.bio = 'Birdwatcher and espresso snob'
+        self.u6.location = 'Reykjavik'
+        db.session.commit()
+        with app.test_request_context('/users'):
+            app.preprocess_request()
+            with app.test_client() as c:
+                with c.session_transaction() as session:
+                    session[CURR_USER_KEY] = self.test.id
+                html = c.get('/users?q=espresso').get_data(as_text=True)
+
+                self.assertIn(f'@{self.u5.username}', html)
+                self.assertNotIn(f'@{self.u6.username}', html)
+
+                html = c.get('/users?q=reykjavik').get_data(as_text=True)
+
+                self.assertIn(f'@{self.u6.username}', html)
+                self.assertNotIn(f'@{self.u5.username}', html)
+
+    def test_list_users_search_ranking(self):
+        """Closer username matches should be listed first"""
+        db.session.add_all([
+            User(username='warblerfan', password='testpassword', email='fan@gmail.com'),
+            User(username='warbler', password='testpassword', email='warbler@gmail.com'),
+        ])
+        db.session.commit()
+
+        users = User.search('warbler').all()
+
+        self.assertEqual([u.username for u in users], ['warbler', 'warblerfan'])
+        self.assertEqual(User.search('100%').all(), [])
+
+    def test_logged_in_user_snapshot_cache(self):
+        """g.user comes from the snapshot cache until the profile changes"""
+        with app.test_client() as c:
+            c.post('/login', data={'username': 'testuser', 'password': 'testpassword'})
+
+            # changed behind the cache's back: same version, so still cached
+            User.query.filter_by(id=self.test.id).update({'image_url': '/static/images/new.png'})
+            db.session.commit()
+            html = c.get('/').get_data(as_text=True)
+            self.assertNotIn('/static/images/new.png', html)
+
+            # a profile edit bumps the version and refreshes the snapshot
+            c.post('/users/profile', data={'username': 'testupdated',
+                                           'password': 'testpassword'})
+            html = c.get('/').get_data(as_text=True)
+            self.assertIn('@testupdated', html)
+            self.assertIn('/static/images/new.png', html)
+
+    def test_logged_in_user_snapshot_counters(self):
+        """Counters the user changes show at once, though snapshots cache
+        them"""
+        with app.test_client() as c:
+            c.post('/login', data={'username': 'testuser', 'password': 'testpassword'})
+            c.get('/')
+            self.assertEqual(g.user.following_count, 0)
+
+            c.post(f'/users/follow/{self.u1.id}')
+            c.get('/')
+            self.assertEqual(g.user.following_count, 1)
+
+    def test_logged_in_user_deleted_elsewhere(self):
+        """A user deleted by another worker is logged out, not served from
+        their cached snapshot"""
+        with app.test_client() as c:
+            c.post('/login', data={'username': 'testuser', 'password': 'testpassword'})
+            user_id = self.test.id
+
+            # deleted behind the cache's back, as another worker would
+            db.session.delete(self.test)
+            db.session.commit()
+
+            # the listener hears of it on its own thread
+            deadline = time.monotonic() + 5
+            while not deleted_users.get(user_id) and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+            resp = c.get(f'/users/{self.u1.id}')
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, 'http://localhost/')
+            with c.session_transaction() as session:
+                self.assertNotIn(CURR_USER_KEY, session)
+
+            resp = c.post('/messages/new', data={'text': 'still here?'},
+                          follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Access unauthorized.', resp.get_data(as_text=True))
+            self.assertEqual(Message.query.count(), 0)